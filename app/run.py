@@ -7,15 +7,19 @@ from routers.chatbot_router import chatbot_router
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from prometheus_client import make_asgi_app
 from contextlib import asynccontextmanager
 from models.database import init_db, engine
 from models.embedding import Base
+from utils.http_client import close_async_http_client
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
     init_db()
     Base.metadata.create_all(bind=engine)
     yield
+    # Đóng các connection keep-alive tới service embed/rerank
+    await close_async_http_client()
 
 # Add CORS middleware
 origins = [
@@ -35,6 +39,9 @@ app.add_middleware(
 
 app.include_router(chatbot_router)
 
+# Metrics Prometheus (connection pool, ...)
+app.mount("/metrics", make_asgi_app())
+
 
 if __name__ == "__main__":
     uvicorn.run("run:app", host="0.0.0.0", port=8002, reload=True)
@@ -303,6 +303,7 @@ if prompt := st.chat_input("Nhập câu hỏi của bạn..."):
             relevant_documents.append(doc)
             seen_ids.add(doc['id'])
     
+    # Câu hỏi gốc chỉ được retrieve và rerank khi câu đã viết lại không có kết quả
     if not relevant_documents:
         documents = ai_chatbot_service.document_retriever.run(
             query_text=prompt,
@@ -314,7 +315,8 @@ if prompt := st.chat_input("Nhập câu hỏi của bạn..."):
                 relevant_documents.append(doc)
                 seen_ids.add(doc['id'])
     
-    relevant_documents = sorted(relevant_documents, key=lambda doc: doc['cross_score'], reverse=False) if relevant_documents else []
+    # Tài liệu dự phòng khi API rerank lỗi không có cross_score, xếp trước các tài liệu đã chấm
+    relevant_documents = sorted(relevant_documents, key=lambda doc: doc['cross_score'] if doc['cross_score'] is not None else float('-inf'), reverse=False) if relevant_documents else []
     
     for chunk in asyncio.run(ai_chatbot_service.answer_generator.run(
         messages=[
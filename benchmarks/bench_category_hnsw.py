@@ -0,0 +1,76 @@
+"""
+So sánh độ trễ và recall của truy vấn semantic có lọc category
+trước (index HNSW toàn cục + lọc) và sau (partial HNSW index theo category, iterative scan).
+
+Chạy: python benchmarks/bench_category_hnsw.py [--queries 50] [--k 25] [--queries-file questions.txt]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+from sqlalchemy import select, text
+from models.database import engine, KNOWN_CATEGORIES
+from models.embedding import Embedding
+from benchmarks.common import (
+    percentile, recall_at_k, timed, load_query_vectors, exact_neighbors, print_table
+)
+
+
+def search(connection, query_vector: list, category: str, k: int, mode: str) -> list:
+    with connection.begin():
+        if mode == "global_index":
+            # Biểu thức category || '' khiến planner không khớp được điều kiện của partial index,
+            # tương đương trạng thái chỉ có index toàn cục
+            condition = Embedding.category.concat("") == category
+        else:
+            condition = Embedding.category == category
+        if mode.endswith("iterative"):
+            connection.execute(text("SELECT set_config('hnsw.iterative_scan', 'strict_order', true)"))
+        rows = connection.execute(
+            select(Embedding.chunk_id)
+            .where(condition)
+            .order_by(Embedding.embedding.l2_distance(query_vector))
+            .limit(k)
+        ).fetchall()
+    return [row.chunk_id for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark partial HNSW index theo category")
+    parser.add_argument("--queries", type=int, default=50, help="Số truy vấn cho mỗi category")
+    parser.add_argument("--k", type=int, default=25)
+    parser.add_argument("--queries-file", default=None, help="File câu hỏi giữ lại (mỗi dòng một câu)")
+    parser.add_argument("--iterative", action="store_true",
+                        help="Đo thêm chế độ hnsw.iterative_scan (pgvector >= 0.8)")
+    args = parser.parse_args()
+
+    modes = ["global_index", "partial_index"]
+    if args.iterative:
+        modes += ["global_index_iterative", "partial_index_iterative"]
+
+    table = []
+    with engine.connect() as connection:
+        for category in KNOWN_CATEGORIES:
+            query_vectors = load_query_vectors(connection, category, args.queries, args.queries_file)
+            connection.commit()
+            ground_truth = [exact_neighbors(connection, vector, category, args.k) for vector in query_vectors]
+            for mode in modes:
+                latencies, recalls, returned = [], [], []
+                for vector, expected in zip(query_vectors, ground_truth):
+                    found, elapsed_ms = timed(search, connection, vector, category, args.k, mode)
+                    latencies.append(elapsed_ms)
+                    recalls.append(recall_at_k(found, expected))
+                    returned.append(len(found))
+                table.append([
+                    category, mode,
+                    percentile(latencies, 50), percentile(latencies, 95),
+                    sum(recalls) / len(recalls) if recalls else float("nan"),
+                    sum(returned) / len(returned) if returned else float("nan"),
+                ])
+
+    print_table(["category", "mode", "p50_ms", "p95_ms", f"recall@{args.k}", "avg_rows"], table)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Đánh giá lượt ColBERT trước cross-encoder: với mỗi giá trị N, ứng viên của hybrid search được chấm
+MaxSim bằng vector ColBERT tính sẵn, chỉ N ứng viên tốt nhất được gửi sang `/rerank`.
+
+Chất lượng được so với baseline gửi toàn bộ ứng viên sang cross-encoder: recall@5 của top 5 baseline
+và tỷ lệ giữ đúng top 1. Độ trễ p50/p95 tính cho lượt ColBERT + cross-encoder; thời gian embed ColBERT
+của câu truy vấn (một lần cho mỗi câu, có cache) được báo riêng.
+
+Cần chạy scripts/backfill_colbert_vectors.py trước.
+
+Chạy: python benchmarks/bench_colbert_prefilter.py --queries-file questions.txt [--category All]
+      [--top-n-values 10,15,20,30]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+from services.chatbot.document_retriever import DocumentRetriever
+from benchmarks.common import percentile, recall_at_k, timed, print_table
+
+
+def cross_encoder_top(retriever: DocumentRetriever, query: str, documents: list, k: int = 5) -> list:
+    scores = retriever._request_rerank_scores([[query, doc.page_content] for doc in documents])
+    if scores is None:
+        raise RuntimeError("API rerank lỗi")
+    ranked = sorted(zip(documents, scores), key=lambda item: item[1], reverse=True)
+    return [doc.id for doc, _ in ranked[:k]]
+
+
+def pruned_top(retriever: DocumentRetriever, query: str, documents: list, top_n: int) -> list:
+    pruned = retriever.colbert_scorer.prune(query, documents, top_n=top_n)
+    return cross_encoder_top(retriever, query, pruned)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark lượt ColBERT trước cross-encoder")
+    parser.add_argument("--queries-file", required=True, help="File câu hỏi (mỗi dòng một câu)")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--category", default="All")
+    parser.add_argument("--top-n-values", default="10,15,20,30")
+    args = parser.parse_args()
+
+    with open(args.queries_file, encoding="utf-8") as f:
+        questions = [line.strip() for line in f if line.strip()][:args.queries]
+    top_n_values = [int(value) for value in args.top_n_values.split(",")]
+
+    retriever = DocumentRetriever()
+    samples, colbert_query_ms = [], []
+    for question in questions:
+        candidates = retriever._documents_from_dicts(
+            retriever.hybrid_search(question, category=args.category)
+        )
+        _, elapsed_ms = timed(retriever.embedder.run_colbert, question)
+        colbert_query_ms.append(elapsed_ms)
+        samples.append((question, candidates))
+
+    baseline, baseline_ms = [], []
+    for question, candidates in samples:
+        top, elapsed_ms = timed(cross_encoder_top, retriever, question, candidates)
+        baseline.append(top)
+        baseline_ms.append(elapsed_ms)
+
+    average_candidates = sum(len(candidates) for _, candidates in samples) / max(len(samples), 1)
+    table = [["all", average_candidates, 1.0, 1.0, percentile(baseline_ms, 50), percentile(baseline_ms, 95)]]
+    for top_n in top_n_values:
+        latencies, recalls, top1 = [], [], []
+        for (question, candidates), expected in zip(samples, baseline):
+            found, elapsed_ms = timed(pruned_top, retriever, question, list(candidates), top_n)
+            latencies.append(elapsed_ms)
+            recalls.append(recall_at_k(found, expected))
+            top1.append(1.0 if found[:1] == expected[:1] else 0.0)
+        table.append([
+            top_n, min(top_n, average_candidates),
+            sum(recalls) / len(recalls) if recalls else float("nan"),
+            sum(top1) / len(top1) if top1 else float("nan"),
+            percentile(latencies, 50), percentile(latencies, 95),
+        ])
+
+    print(f"embed ColBERT câu truy vấn: p50 = {percentile(colbert_query_ms, 50):.1f}ms, "
+          f"p95 = {percentile(colbert_query_ms, 95):.1f}ms")
+    print_table(["top_n", "pairs", "recall@5", "top1", "p50_ms", "p95_ms"], table)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Quét hnsw.ef_search trên một tập truy vấn giữ lại, đo recall@K so với tìm kiếm chính xác
+và độ trễ p50/p95 của truy vấn semantic, để chọn giá trị ef_search cho DocumentRetriever.run.
+
+Chạy: python benchmarks/bench_ef_search.py --queries-file questions.txt [--category mba]
+      [--ef-values 10,20,40,64,100,200,400] [--k 25]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+from sqlalchemy import select, text
+from models.database import engine
+from models.embedding import Embedding
+from benchmarks.common import (
+    percentile, recall_at_k, timed, load_query_vectors, exact_neighbors,
+    category_condition, print_table
+)
+
+
+def search(connection, query_vector: list, category: str, k: int, ef_search: int) -> list:
+    with connection.begin():
+        connection.execute(
+            text("SELECT set_config('hnsw.ef_search', :value, true)"), {"value": str(ef_search)}
+        )
+        rows = connection.execute(
+            select(Embedding.chunk_id)
+            .where(category_condition(category))
+            .order_by(Embedding.embedding.l2_distance(query_vector))
+            .limit(k)
+        ).fetchall()
+    return [row.chunk_id for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark recall/độ trễ theo hnsw.ef_search")
+    parser.add_argument("--queries-file", default=None, help="File câu hỏi giữ lại (mỗi dòng một câu)")
+    parser.add_argument("--queries", type=int, default=100, help="Số truy vấn tối đa")
+    parser.add_argument("--category", default="All")
+    parser.add_argument("--k", type=int, default=25)
+    parser.add_argument("--ef-values", default="10,20,40,64,100,200,400")
+    parser.add_argument("--repeat", type=int, default=3, help="Số lần lặp mỗi truy vấn khi đo độ trễ")
+    args = parser.parse_args()
+
+    ef_values = [int(value) for value in args.ef_values.split(",")]
+    table = []
+    with engine.connect() as connection:
+        query_vectors = load_query_vectors(connection, args.category, args.queries, args.queries_file)
+        connection.commit()
+        ground_truth = [exact_neighbors(connection, vector, args.category, args.k) for vector in query_vectors]
+
+        for ef_search in ef_values:
+            latencies, recalls = [], []
+            for vector, expected in zip(query_vectors, ground_truth):
+                for _ in range(args.repeat):
+                    found, elapsed_ms = timed(search, connection, vector, args.category, args.k, ef_search)
+                    latencies.append(elapsed_ms)
+                recalls.append(recall_at_k(found, expected))
+            table.append([
+                ef_search,
+                sum(recalls) / len(recalls) if recalls else float("nan"),
+                percentile(latencies, 50),
+                percentile(latencies, 95),
+            ])
+
+    print(f"category = {args.category}, số truy vấn = {len(query_vectors)}, k = {args.k}")
+    print_table(["ef_search", f"recall@{args.k}", "p50_ms", "p95_ms"], table)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+So sánh các backend suy luận của server embed/rerank (PyTorch, ONNX Runtime int8 trên CPU):
+- thông lượng encode (câu/giây) và rerank (cặp/giây);
+- độ khớp với backend đầu tiên trong --backends: cosine của vector dense, tương quan Spearman và
+  sai lệch lớn nhất của điểm rerank, tỷ lệ trùng top 1 theo từng câu hỏi.
+
+Đoạn văn được lấy ngẫu nhiên từ bảng embeddings. Các backend được nạp lần lượt để không giữ hai bộ model
+trong bộ nhớ cùng lúc.
+
+Chạy: python benchmarks/bench_inference_backends.py --queries-file questions.txt [--backends torch,onnx]
+      [--passages 64] [--use-gpu False]
+"""
+import sys
+import os
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+sys.path.append(os.path.join(ROOT_DIR, "services", "rerank_embedding"))
+
+import argparse
+import gc
+import numpy as np
+from scipy.stats import spearmanr
+from sqlalchemy import text
+from models.database import engine
+from model_loader import load_models, resolve_use_gpu
+from benchmarks.common import timed, print_table
+
+
+def load_passages(n: int) -> list:
+    with engine.connect() as connection:
+        rows = connection.execute(
+            text("SELECT page_content FROM embeddings ORDER BY random() LIMIT :n"), {"n": n}
+        ).fetchall()
+    return [row.page_content for row in rows]
+
+
+def as_list(scores) -> list:
+    return [float(score) for score in scores] if isinstance(scores, list) else [float(scores)]
+
+
+def run_backend(backend: str, use_gpu: bool, passages: list, sentence_pairs: list, args) -> dict:
+    embedder, reranker = load_models(backend, use_gpu)
+    # Lượt chạy đầu để khởi tạo kernel/bộ nhớ, không tính vào thời gian
+    embedder.encode(passages[:2], batch_size=2, max_length=args.max_length)
+    reranker.compute_score(sentence_pairs[:2], normalize=False)
+
+    encode_ms, rerank_ms = 0.0, 0.0
+    for _ in range(args.repeats):
+        output, elapsed_ms = timed(
+            embedder.encode, passages, batch_size=args.batch_size, max_length=args.max_length
+        )
+        encode_ms += elapsed_ms
+        scores, elapsed_ms = timed(
+            reranker.compute_score, sentence_pairs, batch_size=args.batch_size, normalize=False
+        )
+        rerank_ms += elapsed_ms
+
+    del embedder, reranker
+    gc.collect()
+    return {
+        "dense": np.asarray(output["dense_vecs"], dtype=np.float32),
+        "scores": np.asarray(as_list(scores), dtype=np.float32),
+        "encode_per_s": len(passages) * args.repeats / (encode_ms / 1000),
+        "rerank_per_s": len(sentence_pairs) * args.repeats / (rerank_ms / 1000),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark backend PyTorch / ONNX của server embed/rerank")
+    parser.add_argument("--queries-file", required=True, help="File câu hỏi (mỗi dòng một câu)")
+    parser.add_argument("--queries", type=int, default=8)
+    parser.add_argument("--passages", type=int, default=64)
+    parser.add_argument("--backends", default="torch,onnx")
+    parser.add_argument("--use-gpu", default="False", help="auto | True | False")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--max-length", type=int, default=512)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    with open(args.queries_file, encoding="utf-8") as f:
+        questions = [line.strip() for line in f if line.strip()][:args.queries]
+    passages = load_passages(args.passages)
+    sentence_pairs = [[question, passage] for question in questions for passage in passages]
+    use_gpu = resolve_use_gpu(args.use_gpu)
+
+    results = {}
+    for backend in args.backends.split(","):
+        results[backend] = run_backend(backend, use_gpu, passages, sentence_pairs, args)
+
+    reference = results[args.backends.split(",")[0]]
+    reference_scores = reference["scores"].reshape(len(questions), len(passages))
+    rows = []
+    for backend, result in results.items():
+        cosine = np.sum(result["dense"] * reference["dense"], axis=1)
+        scores = result["scores"].reshape(len(questions), len(passages))
+        top1 = np.mean(scores.argmax(axis=1) == reference_scores.argmax(axis=1))
+        rows.append([
+            backend,
+            result["encode_per_s"],
+            result["rerank_per_s"],
+            float(cosine.mean()),
+            float(cosine.min()),
+            float(spearmanr(result["scores"], reference["scores"]).statistic),
+            float(np.abs(result["scores"] - reference["scores"]).max()),
+            float(top1),
+        ])
+    print(f"{len(passages)} đoạn văn, {len(sentence_pairs)} cặp rerank, GPU: {use_gpu}")
+    print_table(
+        ["backend", "encode/s", "rerank/s", "dense cos mean", "dense cos min", "spearman", "max |Δ|", "top1"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+So sánh lượt semantic search qua pgvector (HNSW) với vector replica trong tiến trình
+(services/chatbot/vector_replica.py): recall@K so với tìm kiếm chính xác và độ trễ p50/p95.
+
+Với replica, đo riêng thời gian tìm kiếm trong bộ nhớ và thời gian tìm kiếm + đọc nội dung chunk
+theo khóa chính (đúng như DocumentRetriever khi dùng replica). Replica được dựng/cập nhật trước khi đo.
+
+Chạy: python benchmarks/bench_vector_replica.py [--dir data/vector_replica] [--category All]
+      [--nprobe-values 1,4,8,16,32] [--queries-file questions.txt]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+from sqlalchemy import select, any_, bindparam, Integer
+from sqlalchemy.dialects.postgresql import ARRAY
+from models.database import engine
+from models.embedding import Embedding
+from services.chatbot.document_retriever import vector_search_statement
+from services.chatbot.vector_replica import refresh_replica, load_replica, VECTOR_REPLICA_DIR
+from benchmarks.common import (
+    percentile, recall_at_k, timed, load_query_vectors, exact_neighbors,
+    category_condition, print_table
+)
+
+
+def sql_search(connection, query_vector: list, category: str, k: int) -> list:
+    with connection.begin():
+        rows = connection.execute(vector_search_statement(
+            query_vector,
+            [category_condition(category)],
+            columns=(Embedding.chunk_id, Embedding.page_content, Embedding.content_hash),
+            limit=k,
+        )).fetchall()
+    return [row.chunk_id for row in rows]
+
+
+def replica_search(connection, replica, query_vector: list, category: str, k: int, nprobe: int) -> list:
+    chunk_ids, _ = replica.search(query_vector, k, category, nprobe=nprobe)
+    with connection.begin():
+        connection.execute(
+            select(Embedding.chunk_id, Embedding.page_content, Embedding.content_hash)
+            .where(Embedding.chunk_id == any_(bindparam("chunk_ids", chunk_ids, type_=ARRAY(Integer))))
+        ).fetchall()
+    return chunk_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pgvector và vector replica trong tiến trình")
+    parser.add_argument("--dir", default=VECTOR_REPLICA_DIR)
+    parser.add_argument("--category", default="All")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--queries-file", default=None)
+    parser.add_argument("--k", type=int, default=25)
+    parser.add_argument("--nprobe-values", default="1,4,8,16,32")
+    args = parser.parse_args()
+
+    nprobe_values = [int(value) for value in args.nprobe_values.split(",")]
+    table = []
+    with engine.connect() as connection:
+        stats = refresh_replica(connection, directory=args.dir)
+        connection.commit()
+        replica = load_replica(args.dir)
+        print(f"replica: {stats}")
+
+        query_vectors = load_query_vectors(connection, args.category, args.queries, args.queries_file)
+        connection.commit()
+        ground_truth = [exact_neighbors(connection, vector, args.category, args.k) for vector in query_vectors]
+
+        def measure(name: str, nprobe, fn) -> None:
+            latencies, recalls = [], []
+            for vector, expected in zip(query_vectors, ground_truth):
+                found, elapsed_ms = timed(fn, vector)
+                latencies.append(elapsed_ms)
+                recalls.append(recall_at_k(found, expected))
+            table.append([
+                name, nprobe,
+                sum(recalls) / len(recalls) if recalls else float("nan"),
+                percentile(latencies, 50), percentile(latencies, 95),
+            ])
+
+        measure("pgvector", "-", lambda vector: sql_search(connection, vector, args.category, args.k))
+        # Không có IVF (corpus nhỏ) thì replica quét toàn bộ, nprobe không có tác dụng
+        for nprobe in (nprobe_values if replica.has_ivf else [None]):
+            measure("replica", nprobe or "-", lambda vector: replica.search(
+                vector, args.k, args.category, nprobe=nprobe
+            )[0])
+            measure("replica+fetch", nprobe or "-", lambda vector: replica_search(
+                connection, replica, vector, args.category, args.k, nprobe
+            ))
+
+    print_table(["path", "nprobe", f"recall@{args.k}", "p50_ms", "p95_ms"], table)
+
+
+if __name__ == "__main__":
+    main()
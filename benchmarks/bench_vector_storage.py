@@ -0,0 +1,93 @@
+"""
+So sánh index HNSW theo dạng lưu vector (vector / halfvec / bit): kích thước index, thời gian build,
+recall@K (sau khi chấm lại bằng vector đầy đủ) so với tìm kiếm chính xác và độ trễ p50/p95.
+
+Index còn thiếu sẽ được tạo (và đo thời gian build) trước khi đo truy vấn.
+
+Chạy: python benchmarks/bench_vector_storage.py [--storages vector,halfvec,bit] [--category All]
+      [--rescore-factors 1,2,4,8] [--queries-file questions.txt]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+from sqlalchemy import text
+from models.database import engine, ensure_vector_indexes, vector_index_name, KNOWN_CATEGORIES
+from services.chatbot.document_retriever import vector_search_statement
+from benchmarks.common import (
+    percentile, recall_at_k, timed, load_query_vectors, exact_neighbors,
+    category_condition, print_table
+)
+
+
+def total_index_size(connection, storage: str) -> float:
+    sizes = [
+        connection.execute(text(
+            "SELECT coalesce(pg_relation_size(to_regclass(:index_name)), 0)"
+        ), {"index_name": vector_index_name(storage, category)}).scalar()
+        for category in [None] + KNOWN_CATEGORIES
+    ]
+    return sum(sizes) / (1024 * 1024)
+
+
+def search(connection, query_vector: list, category: str, k: int, storage: str, rescore_factor: int) -> list:
+    with connection.begin():
+        rows = connection.execute(vector_search_statement(
+            query_vector,
+            [category_condition(category)],
+            limit=k,
+            storage=storage,
+            rescore_factor=rescore_factor,
+        )).fetchall()
+    return [row.chunk_id for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark index vector float32/halfvec/bit")
+    parser.add_argument("--storages", default="vector,halfvec,bit")
+    parser.add_argument("--category", default="All")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--queries-file", default=None)
+    parser.add_argument("--k", type=int, default=25)
+    parser.add_argument("--rescore-factors", default="1,2,4,8")
+    args = parser.parse_args()
+
+    storages = args.storages.split(",")
+    rescore_factors = [int(value) for value in args.rescore_factors.split(",")]
+    table = []
+    with engine.connect() as connection:
+        build_seconds = {}
+        for storage in storages:
+            with connection.begin():
+                build_seconds[storage] = sum(ensure_vector_indexes(connection, storage=storage).values())
+
+        query_vectors = load_query_vectors(connection, args.category, args.queries, args.queries_file)
+        connection.commit()
+        ground_truth = [exact_neighbors(connection, vector, args.category, args.k) for vector in query_vectors]
+
+        for storage in storages:
+            size_mb = total_index_size(connection, storage)
+            connection.commit()
+            for rescore_factor in (rescore_factors if storage != "vector" else [1]):
+                latencies, recalls = [], []
+                for vector, expected in zip(query_vectors, ground_truth):
+                    found, elapsed_ms = timed(
+                        search, connection, vector, args.category, args.k, storage, rescore_factor
+                    )
+                    latencies.append(elapsed_ms)
+                    recalls.append(recall_at_k(found, expected))
+                table.append([
+                    storage, rescore_factor, size_mb, build_seconds[storage],
+                    sum(recalls) / len(recalls) if recalls else float("nan"),
+                    percentile(latencies, 50), percentile(latencies, 95),
+                ])
+
+    print("build_s chỉ tính các index được tạo trong lần chạy này")
+    print_table(
+        ["storage", "rescore", "index_mb", "build_s", f"recall@{args.k}", "p50_ms", "p95_ms"], table
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Các hàm dùng chung cho các script benchmark truy xuất"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time
+from typing import Callable, List, Sequence, Tuple
+import numpy as np
+from sqlalchemy import select, func, text
+from models.embedding import Embedding
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    return float(np.percentile(values, q)) if len(values) else float("nan")
+
+
+def recall_at_k(found: Sequence[int], expected: Sequence[int]) -> float:
+    if not expected:
+        return 1.0
+    return len(set(found) & set(expected)) / len(expected)
+
+
+def timed(fn: Callable, *args, **kwargs) -> Tuple[object, float]:
+    """Chạy hàm và trả về (kết quả, thời gian tính bằng ms)"""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def category_condition(category: str):
+    if not category or category == "All":
+        return True
+    return Embedding.category == category
+
+
+def load_query_vectors(connection, category: str, n: int, queries_file: str = None) -> List[list]:
+    """
+    Lấy tập truy vấn: nếu có file câu hỏi (mỗi dòng một câu) thì embed bằng API `/embed`,
+    ngược lại lấy ngẫu nhiên vector của các chunk trong category làm truy vấn.
+    """
+    if queries_file:
+        from services.chatbot.embedder import Embedder
+        from services.chatbot.document_retriever import API_URL
+        embedder = Embedder(url=f"{API_URL}/embed", batch_size=1, max_length=4096)
+        with open(queries_file, encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+        return [embedder.run(question) for question in questions[:n]]
+
+    connection.execute(text("SELECT setseed(0.42)"))
+    rows = connection.execute(
+        select(Embedding.embedding)
+        .where(category_condition(category))
+        .order_by(func.random())
+        .limit(n)
+    ).fetchall()
+    return [list(row.embedding) for row in rows]
+
+
+def exact_neighbors(connection, query_vector: list, category: str, k: int) -> List[int]:
+    """Kết quả chính xác (quét tuần tự, không dùng HNSW) làm ground truth"""
+    with connection.begin():
+        connection.execute(text("SET LOCAL enable_indexscan = off"))
+        connection.execute(text("SET LOCAL enable_bitmapscan = off"))
+        rows = connection.execute(
+            select(Embedding.chunk_id)
+            .where(category_condition(category))
+            .order_by(Embedding.embedding.l2_distance(query_vector))
+            .limit(k)
+        ).fetchall()
+    return [row.chunk_id for row in rows]
+
+
+def print_table(headers: List[str], rows: List[list]) -> None:
+    formatted = [[f"{value:.3f}" if isinstance(value, float) else str(value) for value in row] for row in rows]
+    widths = [max(len(str(cell)) for cell in column) for column in zip(headers, *formatted)]
+    print("  ".join(header.ljust(width) for header, width in zip(headers, widths)))
+    for row in formatted:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
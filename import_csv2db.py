@@ -1,3 +1,6 @@
+import csv
+import os
+import sys
 import psycopg2
 
 # Kết nối đến database
@@ -19,11 +22,24 @@ table_name = 'embeddings'  # thay bằng tên bảng thực tế
 
 # Import file CSV vào bảng
 with open(csv_path, 'r') as f:
-    # Nếu CSV có dòng header, dùng HEADER
-    cur.copy_expert(f"COPY {table_name} FROM STDIN WITH (FORMAT CSV, DELIMITER '|', HEADER)", f)
+    # Lấy danh sách cột từ dòng header để COPY đúng cột (bảng có thêm cột sinh/cột sparse_embedding không có trong CSV)
+    columns = next(csv.reader(f, delimiter='|'))
+    f.seek(0)
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    cur.copy_expert(f"COPY {table_name} ({column_list}) FROM STDIN WITH (FORMAT CSV, DELIMITER '|', HEADER)", f)
 
 conn.commit()
 cur.close()
 conn.close()
 
 print("Import thành công!")
+
+# Tính lexical weights (sparse_embedding) cho các chunk vừa import, chỉ khi dùng LEXICAL_BACKEND=sparse
+# hoặc chạy với --backfill-sparse (cần server /embed đang chạy)
+if "--backfill-sparse" in sys.argv or os.getenv("LEXICAL_BACKEND", "bm25") == "sparse":
+    from models.database import engine
+    from scripts.backfill_sparse_embeddings import backfill_sparse_embeddings
+
+    with engine.connect() as connection:
+        total = backfill_sparse_embeddings(connection)
+    print(f"Đã điền sparse_embedding cho {total} chunk")
@@ -4,9 +4,14 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from contextlib import contextmanager, asynccontextmanager
 import os
+import re
+import time
 from dotenv import load_dotenv
 from utils.monitor_log import logger
+from utils.metrics import DB_POOL_CHECKOUT_SECONDS, register_pool_metrics
 load_dotenv()
 
 # Cấu hình database
@@ -16,10 +21,165 @@ POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
 POSTGRES_PORT = os.getenv("POSTGRES_PORT", "5433")
 POSTGRES_DB = os.getenv("POSTGRES_DB", "chatbot")
 
+# Cấu hình connection pool (dùng cho cả engine đồng bộ và bất đồng bộ)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "True").lower() in ("1", "true", "yes")
+
+POOL_OPTIONS = {
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_timeout": DB_POOL_TIMEOUT,
+    "pool_recycle": DB_POOL_RECYCLE,
+    "pool_pre_ping": DB_POOL_PRE_PING,
+}
+
+# Các category đã biết, mỗi category có một partial HNSW index riêng
+KNOWN_CATEGORIES = [
+    category.strip()
+    for category in os.getenv("EMBEDDING_CATEGORIES", "mba,quytrinh_vanhanh").split(",")
+    if category.strip()
+]
+
 # URL kết nối đến postgres mặc định để tạo database
 DEFAULT_DB_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/postgres"
 # URL kết nối đến database chatbot
 DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+# URL kết nối bất đồng bộ (asyncpg) đến database chatbot
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+
+# Các cột được thêm sau khi bảng embeddings đã có dữ liệu, cùng script migration tương ứng
+MIGRATED_COLUMNS = {
+    "reference_header": "scripts/backfill_reference_header.py",
+    "sparse_embedding": "scripts/backfill_sparse_embeddings.py",
+}
+
+# Phiên bản corpus do trigger embeddings_corpus_version tăng sau mỗi lần ghi vào bảng embeddings
+CORPUS_VERSION_SQL = text("SELECT version::text FROM corpus_version WHERE id = 1")
+# Dự phòng khi chưa có bảng corpus_version (database chưa chạy init_db mới)
+CORPUS_STATS_SQL = text("SELECT concat(max(updated_at)::text, '/', count(*)) FROM embeddings")
+
+def read_corpus_version(connection) -> str:
+    """Đọc phiên bản corpus từ bộ đếm do trigger duy trì, dự phòng bằng max(updated_at) và số dòng"""
+    try:
+        with connection.begin_nested():
+            version = connection.execute(CORPUS_VERSION_SQL).scalar()
+    except Exception:
+        version = None
+    if version is None:
+        version = "stats:" + connection.execute(CORPUS_STATS_SQL).scalar()
+    return version
+
+def column_exists(connection, column: str) -> bool:
+    return bool(connection.execute(text(
+        "SELECT 1 FROM information_schema.columns "
+        "WHERE table_name = 'embeddings' AND column_name = :column"
+    ), {"column": column}).scalar())
+
+def check_migrated_columns(connection) -> None:
+    """
+    Chỉ kiểm tra các cột migration và content_hash của các chunk cũ, không ALTER/UPDATE khi khởi động: thêm cột
+    sinh (STORED) ghi lại toàn bộ bảng dưới ACCESS EXCLUSIVE, nên chỉ chạy từ script migration tương ứng.
+    """
+    for column, script in MIGRATED_COLUMNS.items():
+        if not column_exists(connection, column):
+            logger.warning(f"Bảng embeddings chưa có cột {column}, chạy python {script}")
+    # content_hash của các chunk cũ được điền theo lô bởi script, không UPDATE toàn bảng khi khởi động
+    missing_content_hash = connection.execute(text(
+        "SELECT 1 FROM embeddings WHERE content_hash IS NULL LIMIT 1"
+    )).scalar()
+    if missing_content_hash:
+        logger.warning("Còn chunk chưa có content_hash (không được cache), chạy python scripts/backfill_content_hash.py")
+
+def migrate_reference_header(connection):
+    """
+    Thêm cột sinh reference_header cho bảng embeddings đã tồn tại; Postgres tự tính cho các dòng cũ.
+    Chỉ gọi từ scripts/backfill_reference_header.py vì ALTER TABLE ghi lại toàn bộ bảng.
+    """
+    from models.embedding import REFERENCE_HEADER_SQL
+    if column_exists(connection, "reference_header"):
+        logger.info("Cột reference_header đã tồn tại")
+        return False
+    connection.execute(text(f"""
+        ALTER TABLE embeddings
+        ADD COLUMN reference_header text GENERATED ALWAYS AS ({REFERENCE_HEADER_SQL}) STORED;
+    """))
+    connection.commit()
+    logger.info("Đã thêm cột reference_header")
+    return True
+
+def migrate_sparse_embedding(connection):
+    """
+    Thêm cột sparse_embedding (lexical weights BGE-M3) cho bảng embeddings đã tồn tại.
+    Chỉ gọi từ scripts/backfill_sparse_embeddings.py.
+    """
+    from models.embedding import SPARSE_DIMENSION
+    if column_exists(connection, "sparse_embedding"):
+        logger.info("Cột sparse_embedding đã tồn tại")
+        return False
+    connection.execute(text(f"ALTER TABLE embeddings ADD COLUMN sparse_embedding sparsevec({SPARSE_DIMENSION});"))
+    connection.commit()
+    logger.info("Đã thêm cột sparse_embedding")
+    return True
+
+# Dạng lưu vector dùng cho index HNSW (lượt ANN): vector (float32) | halfvec (float16) | bit (binary quantize).
+# Với halfvec/bit, truy vấn lấy ứng viên qua index lượng tử hóa rồi chấm lại bằng vector đầy đủ.
+VECTOR_INDEX_STORAGE = os.getenv("VECTOR_INDEX_STORAGE", "vector")
+# Lượt lexical: bm25 (ParadeDB `@@@` + truy vấn dự phòng `AND`) | sparse (lexical weights BGE-M3 trong cột sparse_embedding).
+# Index HNSW sparsevec chỉ được tạo khi dùng sparse
+LEXICAL_BACKEND = os.getenv("LEXICAL_BACKEND", "bm25")
+
+# Biểu thức được index và operator class tương ứng với từng dạng lưu
+VECTOR_INDEX_EXPRESSIONS = {
+    "vector": ("embedding", "vector_l2_ops"),
+    "halfvec": ("(embedding::halfvec(1024))", "halfvec_l2_ops"),
+    "bit": ("(binary_quantize(embedding)::bit(1024))", "bit_hamming_ops"),
+    # Lexical weights (sparse) cho lượt lexical, không phải dạng lưu của cột embedding
+    "sparse": ("sparse_embedding", "sparsevec_ip_ops"),
+}
+
+def vector_index_name(storage: str = "vector", category: str = None) -> str:
+    parts = ["embeddings_embedding"]
+    if storage != "vector":
+        parts.append(storage)
+    if category:
+        parts.append(re.sub(r"[^a-z0-9_]", "_", category.lower()))
+    return "_".join(parts) + "_idx"
+
+def ensure_vector_indexes(connection, storage: str = None, categories=None, concurrently: bool = False) -> dict:
+    """
+    Tạo index HNSW toàn cục và partial HNSW index cho từng category đã biết theo dạng lưu `storage`.
+    Truy vấn semantic có điều kiện `category = '<category>'` sẽ dùng index riêng của category
+    thay vì index toàn cục rồi mới lọc. Trả về thời gian build (giây) của các index vừa tạo.
+    """
+    storage = storage or VECTOR_INDEX_STORAGE
+    expression, opclass = VECTOR_INDEX_EXPRESSIONS[storage]
+    build_seconds = {}
+    for category in [None] + list(categories or KNOWN_CATEGORIES):
+        index_name = vector_index_name(storage, category)
+        index_exists = connection.execute(text(
+            "SELECT 1 FROM pg_indexes WHERE indexname = :index_name"
+        ), {"index_name": index_name}).scalar()
+        label = f"Vector index ({storage}" + (f", category {category})" if category else ")")
+
+        if index_exists:
+            logger.info(f"{label} đã tồn tại")
+            continue
+        predicate = ""
+        if category:
+            category_literal = category.replace("'", "''")
+            predicate = f"WHERE category = '{category_literal}'"
+        start = time.perf_counter()
+        connection.execute(text(f"""
+            CREATE INDEX {"CONCURRENTLY" if concurrently else ""} {index_name} ON embeddings
+            USING hnsw ({expression} {opclass})
+            {predicate};
+        """))
+        build_seconds[index_name] = time.perf_counter() - start
+        logger.info(f"Đã tạo {label} trong {build_seconds[index_name]:.1f}s")
+    return build_seconds
 
 def init_db():
     """Khởi tạo database, extensions, tables và indexes nếu chưa tồn tại"""
@@ -44,7 +204,7 @@ def init_db():
                 logger.info(f"Database {POSTGRES_DB} đã tồn tại")
         
         # Sau khi đã có database, tạo engine mới kết nối đến database đó
-        engine = create_engine(DATABASE_URL)
+        engine = create_engine(DATABASE_URL, **POOL_OPTIONS)
         with engine.connect() as connection:
             # Cài đặt extensions
             connection.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
@@ -60,6 +220,88 @@ def init_db():
             except Exception as e:
                 logger.error(f"Lỗi khi tạo bảng: {str(e)}")
 
+            check_migrated_columns(connection)
+
+            # Trigger tăng phiên bản corpus mỗi khi bảng embeddings thay đổi (kể cả COPY/TRUNCATE)
+            connection.execute(text(
+                "INSERT INTO corpus_version (id, version) VALUES (1, 0) ON CONFLICT (id) DO NOTHING"
+            ))
+            connection.execute(text("""
+                CREATE OR REPLACE FUNCTION bump_corpus_version() RETURNS trigger AS $$
+                BEGIN
+                    UPDATE corpus_version SET version = version + 1, updated_at = now() WHERE id = 1;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """))
+            corpus_trigger_exists = connection.execute(text(
+                "SELECT 1 FROM pg_trigger WHERE tgname = 'embeddings_corpus_version'"
+            )).scalar()
+
+            if not corpus_trigger_exists:
+                connection.execute(text("""
+                    CREATE TRIGGER embeddings_corpus_version
+                    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON embeddings
+                    FOR EACH STATEMENT EXECUTE FUNCTION bump_corpus_version();
+                """))
+                logger.info("Đã tạo trigger corpus version")
+            else:
+                logger.info("Trigger corpus version đã tồn tại")
+
+            # Trigger tự tính content_hash (md5 của page_content) khi ghi chunk, dùng làm khóa cache
+            connection.execute(text("""
+                CREATE OR REPLACE FUNCTION set_content_hash() RETURNS trigger AS $$
+                BEGIN
+                    IF NEW.content_hash IS NULL
+                        OR (TG_OP = 'UPDATE'
+                            AND NEW.page_content IS DISTINCT FROM OLD.page_content
+                            AND NEW.content_hash IS NOT DISTINCT FROM OLD.content_hash) THEN
+                        NEW.content_hash := md5(coalesce(NEW.page_content, ''));
+                    END IF;
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql;
+            """))
+            content_hash_trigger_exists = connection.execute(text(
+                "SELECT 1 FROM pg_trigger WHERE tgname = 'embeddings_content_hash'"
+            )).scalar()
+
+            if not content_hash_trigger_exists:
+                connection.execute(text("""
+                    CREATE TRIGGER embeddings_content_hash
+                    BEFORE INSERT OR UPDATE ON embeddings
+                    FOR EACH ROW EXECUTE FUNCTION set_content_hash();
+                """))
+                logger.info("Đã tạo trigger content_hash")
+            else:
+                logger.info("Trigger content_hash đã tồn tại")
+
+            # Trigger cập nhật updated_at cho mọi lệnh ghi (kể cả SQL thô và COPY, không chỉ qua ORM),
+            # vector replica dựa vào cột này để đọc các dòng thay đổi
+            connection.execute(text("""
+                CREATE OR REPLACE FUNCTION set_updated_at() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'UPDATE' OR NEW.updated_at IS NULL THEN
+                        NEW.updated_at := clock_timestamp();
+                    END IF;
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql;
+            """))
+            updated_at_trigger_exists = connection.execute(text(
+                "SELECT 1 FROM pg_trigger WHERE tgname = 'embeddings_updated_at'"
+            )).scalar()
+
+            if not updated_at_trigger_exists:
+                connection.execute(text("""
+                    CREATE TRIGGER embeddings_updated_at
+                    BEFORE INSERT OR UPDATE ON embeddings
+                    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+                """))
+                logger.info("Đã tạo trigger updated_at")
+            else:
+                logger.info("Trigger updated_at đã tồn tại")
+
             # Kiểm tra và tạo indexes
             bm25_exists = connection.execute(text(
                 "SELECT 1 FROM pg_indexes WHERE indexname = 'search_idx_bm25_index'"
@@ -78,18 +320,9 @@ def init_db():
             else:
                 logger.info("BM25 index đã tồn tại")
 
-            vector_exists = connection.execute(text(
-                "SELECT 1 FROM pg_indexes WHERE indexname = 'embeddings_embedding_idx'"
-            )).scalar()
-            
-            if not vector_exists:
-                connection.execute(text("""
-                    CREATE INDEX ON embeddings
-                    USING hnsw (embedding vector_l2_ops);
-                """))
-                logger.info("Đã tạo Vector index")
-            else:
-                logger.info("Vector index đã tồn tại")
+            ensure_vector_indexes(connection)
+            if LEXICAL_BACKEND == "sparse" and column_exists(connection, "sparse_embedding"):
+                ensure_vector_indexes(connection, storage="sparse")
                 
             connection.commit()
             logger.info("Đã hoàn tất kiểm tra và tạo indexes!")
@@ -103,6 +336,7 @@ def init_db():
 # Khởi tạo engine sau khi tạo database
 engine = init_db()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+register_pool_metrics("sync", engine.pool)
 
 # Hàm tạo session
 def get_db():
@@ -110,4 +344,49 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+# Engine và session bất đồng bộ cho luồng truy xuất chạy song song
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **POOL_OPTIONS)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+register_pool_metrics("async", async_engine.sync_engine.pool)
+
+# Hàm tạo session bất đồng bộ
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+@contextmanager
+def session_scope():
+    """
+    Session ngắn hạn cho một lần truy vấn: lấy connection ngay để đo thời gian chờ pool,
+    commit khi thành công, rollback khi lỗi và luôn trả connection về pool.
+    """
+    session = SessionLocal()
+    try:
+        start = time.perf_counter()
+        session.connection()
+        DB_POOL_CHECKOUT_SECONDS.labels("sync").observe(time.perf_counter() - start)
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+@asynccontextmanager
+async def async_session_scope():
+    session = AsyncSessionLocal()
+    try:
+        start = time.perf_counter()
+        await session.connection()
+        DB_POOL_CHECKOUT_SECONDS.labels("async").observe(time.perf_counter() - start)
+        yield session
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
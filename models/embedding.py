@@ -1,14 +1,22 @@
-from pgvector.sqlalchemy import Vector
-from sqlalchemy import Column, String, DateTime, Text, Integer
+from pgvector.sqlalchemy import Vector, SPARSEVEC
+from sqlalchemy import Column, String, DateTime, Text, Integer, BigInteger, Computed, LargeBinary
 from sqlalchemy.sql import func
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
+# Số chiều vector sparse lexical weights (kích thước từ điển của BGE-M3)
+SPARSE_DIMENSION = 250002
+
+# Phần tiêu đề trước dòng phân cách `---` đầu tiên trong page_content, tính một lần khi ghi chunk
+REFERENCE_HEADER_SQL = "btrim(substring(page_content from '^(.*?)\\n-+\\n'), E' \\t\\r\\n')"
+
 class Embedding(Base):
     __tablename__ = "embeddings"
     chunk_id = Column(Integer, primary_key=True, autoincrement=True)
     embedding = Column(Vector(1024))
+    # Lexical weights của BGE-M3, dùng cho lượt lexical khi LEXICAL_BACKEND=sparse
+    sparse_embedding = Column(SPARSEVEC(SPARSE_DIMENSION), nullable=True)
     page_content = Column(Text)
     content_hash = Column(String(255), nullable=True)
     tables = Column(Text, nullable=True)
@@ -18,4 +26,22 @@ class Embedding(Base):
     category = Column(Text, nullable=True)
     created_at = Column(DateTime, default=func.now())
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
-    url = Column(Text, nullable = True)
\ No newline at end of file
+    url = Column(Text, nullable = True)
+    reference_header = Column(Text, Computed(REFERENCE_HEADER_SQL, persisted=True))
+
+
+class CorpusVersion(Base):
+    """Bộ đếm thay đổi của bảng embeddings, được tăng bởi trigger mỗi khi dữ liệu thay đổi"""
+    __tablename__ = "corpus_version"
+    id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+
+class ChunkColbertVector(Base):
+    """Vector ColBERT (mỗi token một vector 1024 chiều, float16) của nội dung chunk, khóa theo content_hash"""
+    __tablename__ = "chunk_colbert_vectors"
+    content_hash = Column(String(255), primary_key=True)
+    token_count = Column(Integer, nullable=False)
+    vectors = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=func.now())
@@ -10,6 +10,8 @@ class RelevantDocument:
                 url: str = None,
                 score=None,
                 cross_score=None,
+                content_hash: str = None,
+                colbert_score=None,
                 ) -> None:
         self.id = id
         self.page_content = page_content
@@ -21,6 +23,8 @@ class RelevantDocument:
         self.url = url
         self.score = score
         self.cross_score = cross_score
+        self.content_hash = content_hash
+        self.colbert_score = colbert_score
 
 
     def __str__(self):
@@ -41,4 +45,6 @@ class RelevantDocument:
             "url": self.url,
             "score": self.score,
             "cross_score": self.cross_score,
+            "content_hash": self.content_hash,
+            "colbert_score": self.colbert_score,
         }
\ No newline at end of file
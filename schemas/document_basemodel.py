@@ -11,6 +11,8 @@ class RelevantDocumentBaseModel(BaseModel):
     url: str | None = None
     score: float | None = None
     cross_score: float | None = None
+    content_hash: str | None = None
+    colbert_score: float | None = None
 
     def __str__(self):
         return f"Document(id={self.id}, page_content={self.page_content[:50]}...)"
@@ -0,0 +1,89 @@
+"""
+Tính vector ColBERT (float16) cho nội dung các chunk chưa có trong bảng chunk_colbert_vectors,
+dùng cho lượt ColBERT trước cross-encoder (COLBERT_TOP_N > 0).
+
+Vector được khóa theo content_hash nên các chunk trùng nội dung chỉ tính một lần và chunk sửa nội dung
+sẽ được tính lại. --prune xóa vector của các content_hash không còn trong bảng embeddings.
+
+Chạy: python scripts/backfill_colbert_vectors.py [--batch-size 8] [--max-length 8192] [--prune]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+from sqlalchemy import text
+from models.database import engine
+from models.embedding import Base
+from services.chatbot.embedder import Embedder, PRIORITY_BULK
+from services.chatbot.colbert_scorer import encode_colbert
+from services.chatbot.document_retriever import API_URL
+from utils.monitor_log import logger
+
+MISSING_SQL = text("""
+    SELECT DISTINCT ON (e.content_hash) e.content_hash, e.page_content
+    FROM embeddings e
+    WHERE e.content_hash IS NOT NULL
+        AND e.content_hash > :last_content_hash
+        AND NOT EXISTS (SELECT 1 FROM chunk_colbert_vectors c WHERE c.content_hash = e.content_hash)
+    ORDER BY e.content_hash
+    LIMIT :limit
+""")
+
+INSERT_SQL = text("""
+    INSERT INTO chunk_colbert_vectors (content_hash, token_count, vectors, created_at)
+    VALUES (:content_hash, :token_count, :vectors, now())
+    ON CONFLICT (content_hash) DO NOTHING
+""")
+
+PRUNE_SQL = text("""
+    DELETE FROM chunk_colbert_vectors c
+    WHERE NOT EXISTS (SELECT 1 FROM embeddings e WHERE e.content_hash = c.content_hash)
+""")
+
+
+def backfill_colbert_vectors(connection, batch_size: int = 8, max_length: int = 8192) -> int:
+    embedder = Embedder(url=f"{API_URL}/embed", batch_size=batch_size, max_length=max_length, priority=PRIORITY_BULK)
+    last_content_hash = ""
+    total = 0
+    while True:
+        rows = connection.execute(
+            MISSING_SQL, {"last_content_hash": last_content_hash, "limit": batch_size}
+        ).fetchall()
+        if not rows:
+            break
+        vectors = embedder.embed_colbert([row.page_content or "" for row in rows])
+        connection.execute(INSERT_SQL, [
+            {"content_hash": row.content_hash, "token_count": len(row_vectors), "vectors": encode_colbert(row_vectors)}
+            for row, row_vectors in zip(rows, vectors)
+        ])
+        connection.commit()
+        last_content_hash = rows[-1].content_hash
+        total += len(rows)
+        logger.info(f"Đã tính vector ColBERT cho {total} nội dung chunk")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill vector ColBERT cho các chunk")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-length", type=int, default=8192)
+    parser.add_argument("--prune", action="store_true",
+                        help="Xóa vector của các content_hash không còn trong bảng embeddings")
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    with engine.connect() as connection:
+        total = backfill_colbert_vectors(connection, args.batch_size, args.max_length)
+        if args.prune:
+            deleted = connection.execute(PRUNE_SQL).rowcount
+            connection.commit()
+            logger.info(f"Đã xóa {deleted} vector không còn dùng")
+        size = connection.execute(text(
+            "SELECT pg_size_pretty(pg_total_relation_size('chunk_colbert_vectors'))"
+        )).scalar()
+        logger.info(f"Hoàn tất, đã tính {total} nội dung chunk, kích thước bảng: {size}")
+
+
+if __name__ == "__main__":
+    main()
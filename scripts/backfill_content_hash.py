@@ -0,0 +1,56 @@
+"""
+Điền content_hash (md5 của page_content) cho các chunk cũ chưa có. Chunk mới được trigger embeddings_content_hash
+tự tính; init_db không điền cho các dòng cũ vì một lệnh UPDATE trên toàn bảng giữ khóa ghi của mọi dòng
+và sinh WAL cho cả bảng trong một transaction, nên script cập nhật theo từng lô chunk_id và commit sau mỗi lô.
+
+Chạy: python scripts/backfill_content_hash.py [--batch-size 5000]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+from sqlalchemy import text
+from models.database import engine
+from utils.monitor_log import logger
+
+UPDATE_BATCH_SQL = text("""
+    UPDATE embeddings SET content_hash = md5(coalesce(page_content, ''))
+    WHERE chunk_id IN (
+        SELECT chunk_id FROM embeddings
+        WHERE content_hash IS NULL AND chunk_id > :last_chunk_id
+        ORDER BY chunk_id LIMIT :limit
+    )
+    RETURNING chunk_id
+""")
+
+
+def backfill_content_hash(connection, batch_size: int = 5000) -> int:
+    """Điền content_hash cho các chunk còn thiếu theo từng lô, commit sau mỗi lô. Trả về số chunk đã điền."""
+    last_chunk_id = 0
+    total = 0
+    while True:
+        chunk_ids = connection.execute(
+            UPDATE_BATCH_SQL, {"last_chunk_id": last_chunk_id, "limit": batch_size}
+        ).scalars().all()
+        connection.commit()
+        if not chunk_ids:
+            break
+        last_chunk_id = max(chunk_ids)
+        total += len(chunk_ids)
+        logger.info(f"Đã điền content_hash cho {total} chunk (chunk_id <= {last_chunk_id})")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill cột content_hash của bảng embeddings")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    with engine.connect() as connection:
+        total = backfill_content_hash(connection, args.batch_size)
+        logger.info(f"Hoàn tất, đã điền {total} chunk")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Thêm cột sinh reference_header (nếu chưa có) cho các chunk đã có trong bảng embeddings. init_db không tự
+thêm cột này vì ALTER TABLE ghi lại toàn bộ bảng dưới ACCESS EXCLUSIVE, nên chạy script trong giờ thấp điểm.
+
+Chạy: python scripts/backfill_reference_header.py [--verify]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import re
+from sqlalchemy import text
+from models.database import engine, migrate_reference_header
+from utils.monitor_log import logger
+
+
+def extract_header(page_content: str) -> str:
+    # Cách tách tiêu đề cũ (regex trên page_content) dùng để đối chiếu
+    if not page_content:
+        return ""
+    match = re.search(r'^(.*?)(?:\n-+\n)', page_content, flags=re.DOTALL)
+    return match.group(1).strip() if match else ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill cột reference_header của bảng embeddings")
+    parser.add_argument("--verify", action="store_true",
+                        help="So sánh reference_header với kết quả regex cũ trên từng dòng")
+    args = parser.parse_args()
+
+    with engine.connect() as connection:
+        migrate_reference_header(connection)
+        total, with_header = connection.execute(text(
+            "SELECT count(*), count(NULLIF(reference_header, '')) FROM embeddings"
+        )).one()
+        logger.info(f"Tổng số chunk: {total}, số chunk có reference_header: {with_header}")
+
+        if args.verify:
+            mismatches = 0
+            rows = connection.execution_options(stream_results=True, yield_per=1000).execute(text(
+                "SELECT chunk_id, page_content, reference_header FROM embeddings"
+            ))
+            for row in rows:
+                if (row.reference_header or "") != extract_header(row.page_content):
+                    mismatches += 1
+                    logger.warning(f"reference_header khác regex cũ, chunk_id = {row.chunk_id}")
+            logger.info(f"Số chunk lệch so với regex cũ: {mismatches}")
+
+
+if __name__ == "__main__":
+    main()
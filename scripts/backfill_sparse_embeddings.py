@@ -0,0 +1,70 @@
+"""
+Điền cột sparse_embedding (lexical weights BGE-M3) cho các chunk chưa có, dùng cho LEXICAL_BACKEND=sparse.
+
+Mỗi chunk giữ SPARSE_MAX_TERMS token có trọng số lớn nhất (index HNSW sparsevec giới hạn 1000 phần tử khác 0).
+Được gọi lại sau mỗi lần import dữ liệu (import_csv2db.py, khi LEXICAL_BACKEND=sparse hoặc --backfill-sparse)
+để điền cho các chunk mới.
+
+Chạy: python scripts/backfill_sparse_embeddings.py [--batch-size 16] [--max-length 8192] [--recompute]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+from sqlalchemy import text, bindparam
+from pgvector.sqlalchemy import SPARSEVEC
+from models.database import engine, migrate_sparse_embedding, ensure_vector_indexes
+from models.embedding import SPARSE_DIMENSION
+from services.chatbot.embedder import Embedder, sparse_vector, SPARSE_MAX_TERMS, PRIORITY_BULK
+from services.chatbot.document_retriever import API_URL
+from utils.monitor_log import logger
+
+UPDATE_SQL = text(
+    "UPDATE embeddings SET sparse_embedding = :sparse_embedding WHERE chunk_id = :chunk_id"
+).bindparams(bindparam("sparse_embedding", type_=SPARSEVEC(SPARSE_DIMENSION)))
+
+
+def backfill_sparse_embeddings(connection, batch_size: int = 16, max_length: int = 8192, recompute: bool = False) -> int:
+    """Tính lexical weights cho các chunk còn thiếu theo từng lô, commit sau mỗi lô. Trả về số chunk đã điền."""
+    migrate_sparse_embedding(connection)
+    embedder = Embedder(url=f"{API_URL}/embed", batch_size=batch_size, max_length=max_length, priority=PRIORITY_BULK)
+    where_sql = "TRUE" if recompute else "sparse_embedding IS NULL"
+    last_chunk_id = 0
+    total = 0
+    while True:
+        rows = connection.execute(text(
+            f"SELECT chunk_id, page_content FROM embeddings "
+            f"WHERE {where_sql} AND chunk_id > :last_chunk_id ORDER BY chunk_id LIMIT :limit"
+        ), {"last_chunk_id": last_chunk_id, "limit": batch_size}).fetchall()
+        if not rows:
+            break
+        weights = embedder.embed_sparse([row.page_content or "" for row in rows])
+        connection.execute(UPDATE_SQL, [
+            {"chunk_id": row.chunk_id, "sparse_embedding": sparse_vector(row_weights, SPARSE_MAX_TERMS)}
+            for row, row_weights in zip(rows, weights)
+        ])
+        connection.commit()
+        last_chunk_id = rows[-1].chunk_id
+        total += len(rows)
+        logger.info(f"Đã điền sparse_embedding cho {total} chunk (chunk_id <= {last_chunk_id})")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill cột sparse_embedding của bảng embeddings")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--max-length", type=int, default=8192)
+    parser.add_argument("--recompute", action="store_true",
+                        help="Tính lại cho tất cả chunk, kể cả chunk đã có sparse_embedding")
+    args = parser.parse_args()
+
+    with engine.connect() as connection:
+        total = backfill_sparse_embeddings(connection, args.batch_size, args.max_length, args.recompute)
+        ensure_vector_indexes(connection, storage="sparse")
+        connection.commit()
+        logger.info(f"Hoàn tất, đã điền {total} chunk")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Chuyển index HNSW của bảng embeddings sang dạng lưu lượng tử hóa (halfvec hoặc bit).
+
+Index biểu thức `embedding::halfvec(1024)` / `binary_quantize(embedding)::bit(1024)` lưu bản
+lượng tử hóa của mọi dòng hiện có; cột embedding float32 được giữ lại để chấm lại ứng viên.
+Sau khi chạy, đặt VECTOR_INDEX_STORAGE=<storage> cho backend.
+
+Chạy: python scripts/migrate_vector_storage.py --storage halfvec [--drop-full] [--concurrently]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+from sqlalchemy import text
+from models.database import engine, ensure_vector_indexes, vector_index_name, KNOWN_CATEGORIES
+from utils.monitor_log import logger
+
+
+def index_size(connection, index_name: str) -> str:
+    return connection.execute(text(
+        "SELECT pg_size_pretty(pg_relation_size(to_regclass(:index_name)))"
+    ), {"index_name": index_name}).scalar()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate index vector sang halfvec/bit")
+    parser.add_argument("--storage", choices=["halfvec", "bit", "vector"], required=True)
+    parser.add_argument("--drop-full", action="store_true",
+                        help="Xóa các index HNSW float32 sau khi tạo xong index mới")
+    parser.add_argument("--concurrently", action="store_true",
+                        help="CREATE/DROP INDEX CONCURRENTLY để không khóa ghi bảng embeddings")
+    args = parser.parse_args()
+
+    isolation_level = "AUTOCOMMIT" if args.concurrently else None
+    connection_options = {"isolation_level": isolation_level} if isolation_level else {}
+    with engine.connect().execution_options(**connection_options) as connection:
+        build_seconds = ensure_vector_indexes(
+            connection, storage=args.storage, concurrently=args.concurrently
+        )
+        for category in [None] + KNOWN_CATEGORIES:
+            index_name = vector_index_name(args.storage, category)
+            logger.info(
+                f"{index_name}: size = {index_size(connection, index_name)}, "
+                f"build = {build_seconds.get(index_name, 0.0):.1f}s"
+            )
+
+        if args.drop_full and args.storage != "vector":
+            for category in [None] + KNOWN_CATEGORIES:
+                index_name = vector_index_name("vector", category)
+                connection.execute(text(
+                    f"DROP INDEX {'CONCURRENTLY' if args.concurrently else ''} IF EXISTS {index_name}"
+                ))
+                logger.info(f"Đã xóa index {index_name}")
+
+        if not args.concurrently:
+            connection.commit()
+
+
+if __name__ == "__main__":
+    main()
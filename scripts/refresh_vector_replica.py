@@ -0,0 +1,48 @@
+"""
+Dựng/cập nhật vector replica trong tiến trình (services/chatbot/vector_replica.py) từ bảng embeddings.
+
+Lần đầu (hoặc --full) đọc toàn bộ bảng và huấn luyện IVF; các lần sau chỉ đọc các dòng thay đổi
+theo updated_at (do trigger embeddings_updated_at duy trì) và các chunk_id mới, dựng lại toàn bộ khi
+số dòng không khớp với bảng. Backend dùng replica khi đặt VECTOR_REPLICA_ENABLED=True
+và replica có cùng phiên bản corpus với database, ngược lại semantic search chạy trên pgvector.
+
+Chạy: python scripts/refresh_vector_replica.py [--full] [--dir data/vector_replica] [--interval 60]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import time
+from models.database import engine
+from services.chatbot.vector_replica import refresh_replica, VECTOR_REPLICA_DIR
+from utils.monitor_log import logger
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dựng/cập nhật vector replica từ bảng embeddings")
+    parser.add_argument("--dir", default=VECTOR_REPLICA_DIR)
+    parser.add_argument("--full", action="store_true", help="Dựng lại toàn bộ và huấn luyện lại IVF")
+    parser.add_argument("--interval", type=float, default=0,
+                        help="Chạy lặp lại sau mỗi N giây (0: chạy một lần)")
+    args = parser.parse_args()
+
+    full = args.full
+    while True:
+        try:
+            with engine.connect() as connection:
+                stats = refresh_replica(connection, directory=args.dir, full=full)
+                connection.rollback()
+            print(stats)
+            full = False
+        except Exception as e:
+            logger.error(f"Cập nhật vector replica thất bại: {str(e)}")
+            if not args.interval:
+                raise
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,7 +12,6 @@ from utils.monitor_log import logger
 from utils.default_response import OVERLOAD_MESSAGE
 import traceback
 from utils.connect_langfuse import connect_langfuse
-from models.database import get_db
 from typing import List, AsyncGenerator
 from schemas.document import RelevantDocument
 
@@ -35,7 +34,7 @@ class AI_Chatbot_Service:
         self.detect_language = DetectLanguage(
             generator=self.gemini_generator
         )
-        self.document_retriever = DocumentRetriever(session=next(get_db()))
+        self.document_retriever = DocumentRetriever()
         self.single_query = SingleQuery(
             generator=self.gemini_generator
         )
@@ -73,29 +72,30 @@ class AI_Chatbot_Service:
             else:
                 child_prompts = [user_message]
 
-            # for query in child_prompts:
-            #     documents = self.document_retriever.run(
-            #         query_text=query,
-            #         threshold=0.2,
-            #         category=category
-            #         )
-            #     for doc in documents['final_rerank']:
-            #         if doc['id'] not in seen_ids:
-            #             relevant_documents.append(doc)
-            #             seen_ids.add(doc['id'])
+            for query in child_prompts:
+                documents = await self.document_retriever.arun(
+                    query_text=query,
+                    threshold=0.2,
+                    category=category
+                    )
+                for doc in documents['final_rerank']:
+                    if doc['id'] not in seen_ids:
+                        relevant_documents.append(doc)
+                        seen_ids.add(doc['id'])
 
-            # if not relevant_documents:
-            #     documents = self.document_retriever.run(
-            #         query_text=user_message,
-            #         threshold=0.2,
-            #         category=category
-            #         )
-            #     for doc in documents['final_rerank']:
-            #         if doc['id'] not in seen_ids:
-            #             relevant_documents.append(doc)
-            #             seen_ids.add(doc['id'])
+            if not relevant_documents and single_query:
+                documents = await self.document_retriever.arun(
+                    query_text=user_message,
+                    threshold=0.2,
+                    category=category
+                    )
+                for doc in documents['final_rerank']:
+                    if doc['id'] not in seen_ids:
+                        relevant_documents.append(doc)
+                        seen_ids.add(doc['id'])
 
-            # relevant_documents = sorted(relevant_documents, key=lambda doc: doc['cross_score'], reverse=False) if relevant_documents else []
+            # Tài liệu dự phòng khi API rerank lỗi không có cross_score, xếp trước các tài liệu đã chấm
+            relevant_documents = sorted(relevant_documents, key=lambda doc: doc['cross_score'] if doc['cross_score'] is not None else float('-inf'), reverse=False) if relevant_documents else []
 
             async for chunk in self.answer_generator.run(
                 messages=user_data.histories,
@@ -0,0 +1,106 @@
+"""
+Lượt xếp hạng ColBERT (late interaction) đứng trước cross-encoder: chấm điểm MaxSim giữa vector
+ColBERT của câu truy vấn và vector ColBERT tính sẵn của từng chunk (bảng chunk_colbert_vectors,
+khóa theo content_hash), chỉ COLBERT_TOP_N ứng viên tốt nhất được gửi sang `/rerank`.
+
+Vector của chunk được tính bởi scripts/backfill_colbert_vectors.py. Chunk chưa có vector vẫn được
+gửi sang cross-encoder để không mất kết quả.
+"""
+import os
+from typing import Callable, Dict, List
+import numpy as np
+from sqlalchemy import select, any_, bindparam, String
+from sqlalchemy.dialects.postgresql import ARRAY
+from langfuse.decorators import observe, langfuse_context
+from models.embedding import ChunkColbertVector
+from schemas.document import RelevantDocument
+from utils.cache import TwoTierCache
+from utils.monitor_log import logger
+
+# Số ứng viên giữ lại sau lượt ColBERT để gửi sang cross-encoder (0: tắt lượt ColBERT)
+COLBERT_TOP_N = int(os.getenv("COLBERT_TOP_N", 0))
+# Cache vector ColBERT của chunk trong tiến trình, mỗi phần tử cỡ token_count * 2KB
+COLBERT_CACHE_SIZE = int(os.getenv("COLBERT_CACHE_SIZE", 512))
+COLBERT_CACHE_TTL = int(os.getenv("COLBERT_CACHE_TTL", 3600))
+
+COLBERT_DIMENSION = 1024
+
+chunk_colbert_cache = TwoTierCache(
+    namespace="chunk_colbert",
+    maxsize=COLBERT_CACHE_SIZE,
+    ttl=COLBERT_CACHE_TTL,
+)
+
+
+def encode_colbert(vectors: np.ndarray) -> bytes:
+    return np.asarray(vectors, dtype=np.float16).tobytes()
+
+
+def decode_colbert(raw: bytes) -> np.ndarray:
+    return np.frombuffer(raw, dtype=np.float16).reshape(-1, COLBERT_DIMENSION)
+
+
+def maxsim(query_vectors: np.ndarray, document_vectors: np.ndarray) -> float:
+    """Điểm ColBERT như BGE-M3: trung bình theo token truy vấn của tích vô hướng lớn nhất với các token của chunk"""
+    if len(query_vectors) == 0 or len(document_vectors) == 0:
+        return 0.0
+    similarities = query_vectors.astype(np.float32) @ document_vectors.astype(np.float32).T
+    return float(similarities.max(axis=1).mean())
+
+
+class ColbertScorer:
+    def __init__(self, embedder, session_scope: Callable) -> None:
+        self.embedder = embedder
+        self.session_scope = session_scope
+
+    def load_vectors(self, content_hashes: List[str]) -> Dict[str, np.ndarray]:
+        """Vector ColBERT của các chunk theo content_hash, đọc từ cache rồi mới tới database"""
+        content_hashes = list(dict.fromkeys(content_hash for content_hash in content_hashes if content_hash))
+        vectors = {}
+        for content_hash, (value, _) in chunk_colbert_cache.lookup_many(content_hashes).items():
+            if value is not None:
+                vectors[content_hash] = value
+        missing = [content_hash for content_hash in content_hashes if content_hash not in vectors]
+        if missing:
+            with self.session_scope() as session:
+                rows = session.execute(
+                    select(ChunkColbertVector.content_hash, ChunkColbertVector.vectors)
+                    .where(ChunkColbertVector.content_hash == any_(
+                        bindparam("content_hashes", missing, type_=ARRAY(String))
+                    ))
+                ).fetchall()
+            loaded = {row.content_hash: decode_colbert(row.vectors) for row in rows}
+            chunk_colbert_cache.set_many(loaded)
+            vectors.update(loaded)
+        return vectors
+
+    @observe(name="Colbert_prune")
+    def prune(self, query: str, documents: List[RelevantDocument], top_n: int = None) -> List[RelevantDocument]:
+        """
+        Giữ top_n chunk có điểm ColBERT cao nhất (theo thứ tự điểm giảm dần), các chunk chưa có
+        vector ColBERT được giữ lại phía sau. Lỗi ở lượt này chỉ được log, trả về danh sách gốc.
+        """
+        top_n = COLBERT_TOP_N if top_n is None else top_n
+        if not top_n or len(documents) <= top_n:
+            return documents
+        try:
+            query_vectors = self.embedder.run_colbert(query)
+            document_vectors = self.load_vectors([doc.content_hash for doc in documents])
+        except Exception as e:
+            logger.warning(f"Lượt ColBERT lỗi, gửi toàn bộ ứng viên sang cross-encoder: {str(e)}")
+            return documents
+
+        scored, unscored = [], []
+        for doc in documents:
+            vectors = document_vectors.get(doc.content_hash)
+            if vectors is None:
+                unscored.append(doc)
+            else:
+                doc.colbert_score = maxsim(query_vectors, vectors)
+                scored.append(doc)
+        scored.sort(key=lambda doc: doc.colbert_score, reverse=True)
+        kept = scored[:max(top_n - len(unscored), 0)] + unscored
+        langfuse_context.update_current_observation(
+            metadata={"candidates": len(documents), "kept": len(kept), "without_vectors": len(unscored)}
+        )
+        return kept
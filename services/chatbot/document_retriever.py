@@ -1,51 +1,207 @@
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from models.embedding import Embedding
-from models.database import SessionLocal
-from langfuse.decorators import observe
+from models.embedding import Embedding, SPARSE_DIMENSION
+from models.database import session_scope, async_session_scope, VECTOR_INDEX_STORAGE, LEXICAL_BACKEND, CORPUS_VERSION_SQL, CORPUS_STATS_SQL
+from langfuse.decorators import observe, langfuse_context
 from utils.monitor_log import logger
+from utils.cache import TwoTierCache, shared_redis_client
+from utils.http_client import post_json, apost_json
 from typing import List, Set
 from schemas.document import RelevantDocument
 import numpy as np
 import json
-import requests
-from .embedder import Embedder
-from sqlalchemy import text, select, and_
+from .embedder import Embedder, query_embedding_cache, query_sparse_cache, query_colbert_cache, sparse_vector, PRIORITY_INTERACTIVE
+from .colbert_scorer import ColbertScorer, COLBERT_TOP_N
+from .vector_replica import get_vector_replica
+from .passage_windows import window_pairs, aggregate_scores, PASSAGE_WINDOW_SIGNATURE
+from sqlalchemy import text, select, and_, bindparam, cast, any_, func, Text, Integer
+from sqlalchemy.dialects.postgresql import ARRAY
+from pgvector.sqlalchemy import Vector, HALFVEC, BIT, SPARSEVEC
 import re
 import traceback
+import asyncio
+import copy
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
 
 
 API_URL = "http://localhost:8001"
+# Timeout đọc (giây) và số lần thử của mỗi lần gọi `/rerank`
+RERANK_TIMEOUT = float(os.getenv("RERANK_TIMEOUT", 30))
+RERANK_MAX_RETRIES = int(os.getenv("RERANK_MAX_RETRIES", 2))
+# Rerank luôn phục vụ câu truy vấn của người dùng nên được xếp lớp interactive trên server
+RERANK_HEADERS = {"X-Priority": PRIORITY_INTERACTIVE}
+# Dùng `/rerank/query` (câu truy vấn gửi một lần, server cache token tài liệu theo content_hash) khi mọi cặp cùng một câu truy vấn
+RERANK_QUERY_API = os.getenv("RERANK_QUERY_API", "True").lower() in ("1", "true", "yes")
 
 
 LIMIT_SEARCH = 25
+# Hằng số k của reciprocal rank fusion và số kết quả giữ lại sau khi fusion
+RRF_K = 60
+FUSED_TOP_K = LIMIT_SEARCH
+
+# Cache kết quả retrieve + rerank, khóa gồm phiên bản corpus nên tự vô hiệu khi bảng embeddings thay đổi
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", 1024))
+RETRIEVAL_CACHE_TTL = int(os.getenv("RETRIEVAL_CACHE_TTL", 3600))
+RETRIEVAL_CACHE_USE_REDIS = os.getenv("RETRIEVAL_CACHE_USE_REDIS", "True").lower() in ("1", "true", "yes")
+# Thời gian dùng lại phiên bản corpus đã đọc trước khi hỏi lại database (giây)
+CORPUS_VERSION_TTL = float(os.getenv("CORPUS_VERSION_TTL", 5))
+
+retrieval_result_cache = TwoTierCache(
+    namespace="retrieval",
+    maxsize=RETRIEVAL_CACHE_SIZE,
+    ttl=RETRIEVAL_CACHE_TTL,
+    redis_client=shared_redis_client() if RETRIEVAL_CACHE_USE_REDIS else None,
+)
+
+# Cache điểm cross-encoder theo (câu truy vấn, content_hash của chunk), điểm chỉ phụ thuộc nội dung nên không cần phiên bản corpus
+RERANK_MODEL_NAME = os.getenv("RERANK_MODEL_NAME", "BAAI/bge-reranker-v2-m3")
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", 20000))
+RERANK_CACHE_TTL = int(os.getenv("RERANK_CACHE_TTL", 3600))
+RERANK_CACHE_REDIS_TTL = int(os.getenv("RERANK_CACHE_REDIS_TTL", 86400))
+
+rerank_score_cache = TwoTierCache(
+    namespace="rerank",
+    maxsize=RERANK_CACHE_SIZE,
+    ttl=RERANK_CACHE_TTL,
+    redis_client=shared_redis_client(),
+    redis_ttl=RERANK_CACHE_REDIS_TTL,
+)
+
+
+# Cache các cột nặng của chunk trong tiến trình, khóa theo (chunk_id, content_hash, phiên bản corpus): content_hash
+# chỉ phụ thuộc page_content, phiên bản corpus đổi khi bất kỳ cột nào của bảng embeddings thay đổi
+CHUNK_CACHE_SIZE = int(os.getenv("CHUNK_CACHE_SIZE", 2048))
+CHUNK_CACHE_TTL = int(os.getenv("CHUNK_CACHE_TTL", 3600))
+
+chunk_cache = TwoTierCache(
+    namespace="chunk",
+    maxsize=CHUNK_CACHE_SIZE,
+    ttl=CHUNK_CACHE_TTL,
+)
+
+# Chế độ iterative scan của pgvector (>= 0.8) cho truy vấn vector có lọc: off | strict_order | relaxed_order
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN", "off")
+# hnsw.ef_search mặc định cho mỗi truy vấn (để trống: dùng giá trị của server)
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH")) if os.getenv("HNSW_EF_SEARCH") else None
+SET_CONFIG_SQL = text("SELECT set_config(:name, :value, true)")
+
+# Với index lượng tử hóa (halfvec/bit): số ứng viên lấy qua index = LIMIT_SEARCH * hệ số này,
+# sau đó chấm lại bằng khoảng cách L2 trên vector đầy đủ
+VECTOR_RESCORE_FACTOR = int(os.getenv("VECTOR_RESCORE_FACTOR", 4))
+
+# Khoảng cách dùng cho lượt ANN, phải khớp với biểu thức của index trong models/database.py
+ANN_DISTANCE_SQL = {
+    "vector": "{column} <-> {query}",
+    "halfvec": "{column}::halfvec(1024) <-> {query}::halfvec(1024)",
+    "bit": "binary_quantize({column})::bit(1024) <~> binary_quantize({query})::bit(1024)",
+}
+
+
+def semantic_filter_sql(query_sql: str, category_filter: str = "") -> str:
+    """
+    Điều kiện WHERE cho truy vấn semantic viết bằng SQL thuần. Với index halfvec/bit, giới hạn
+    các dòng về `:rescore_limit` ứng viên lấy qua index lượng tử hóa; truy vấn ngoài sắp xếp lại
+    bằng khoảng cách trên vector đầy đủ.
+    """
+    if VECTOR_INDEX_STORAGE == "vector":
+        return f"TRUE {category_filter}"
+    distance = ANN_DISTANCE_SQL[VECTOR_INDEX_STORAGE].format(column="candidates.embedding", query=query_sql)
+    return f"""chunk_id IN (
+                        SELECT candidates.chunk_id FROM embeddings candidates
+                        WHERE TRUE {category_filter}
+                        ORDER BY {distance}
+                        LIMIT :rescore_limit
+                    )"""
+
+
+def ann_distance(query_embedding: List[float], storage: str = None):
+    """Biểu thức khoảng cách của lượt ANN theo dạng lưu của index"""
+    storage = storage or VECTOR_INDEX_STORAGE
+    if storage == "halfvec":
+        return cast(Embedding.embedding, HALFVEC(1024)).l2_distance(
+            cast(bindparam(None, query_embedding, type_=Vector(1024)), HALFVEC(1024))
+        )
+    if storage == "bit":
+        return cast(func.binary_quantize(Embedding.embedding), BIT(1024)).hamming_distance(
+            cast(func.binary_quantize(bindparam(None, query_embedding, type_=Vector(1024))), BIT(1024))
+        )
+    return Embedding.embedding.l2_distance(query_embedding)
+
+
+def vector_search_statement(query_embedding: List[float],
+                            conditions: list,
+                            columns: tuple = None,
+                            limit: int = LIMIT_SEARCH,
+                            storage: str = None,
+                            rescore_factor: int = None):
+    """
+    Truy vấn semantic search. Với index halfvec/bit, lấy `limit * rescore_factor` ứng viên
+    qua index lượng tử hóa rồi sắp xếp lại bằng khoảng cách trên vector float32 đầy đủ.
+    """
+    storage = storage or VECTOR_INDEX_STORAGE
+    columns = columns or (Embedding.chunk_id,)
+    exact_distance = Embedding.embedding.l2_distance(query_embedding)
+    if storage == "vector":
+        return (
+            select(*columns)
+            .where(and_(*conditions))
+            .order_by(exact_distance)
+            .limit(limit)
+        )
+    candidates = (
+        select(Embedding.chunk_id)
+        .where(and_(*conditions))
+        .order_by(ann_distance(query_embedding, storage))
+        .limit(limit * (rescore_factor or VECTOR_RESCORE_FACTOR))
+    )
+    return (
+        select(*columns)
+        .where(Embedding.chunk_id.in_(candidates))
+        .order_by(exact_distance)
+        .limit(limit)
+    )
+
+
+_corpus_version_lock = threading.Lock()
+_corpus_version_state = {"value": None, "expires_at": 0.0}
 
 class DocumentRetriever:
-    def __init__(self, session) -> None:
-        # self.session = SessionLocal()
+    def __init__(self, session=None) -> None:
+        # Nếu không truyền session, mỗi lần truy vấn lấy một session ngắn hạn từ pool (session_scope)
         self.session = session
         self.embedder = Embedder(
             url=f"{API_URL}/embed",
             batch_size=1,
             max_length=4096,
             max_retries=10,
-            retry_delay=2.0
+            retry_delay=2.0,
+            cache=query_embedding_cache,
+            sparse_cache=query_sparse_cache,
+            colbert_cache=query_colbert_cache
         )
+        self.colbert_scorer = ColbertScorer(self.embedder, self._session_scope)
 
 
 
-    def _join_references(self, page_content: str, references: str) -> str:
+    @contextmanager
+    def _session_scope(self):
+        if self.session is not None:
+            yield self.session
+        else:
+            with session_scope() as session:
+                yield session
+
+
+    def _join_references(self, reference_header: str, references: str) -> str:
         """
-        Trích xuất phần nội dung trước dòng phân cách chứa dấu gạch (-) trong page_content 
-        và ghép với nội dung references hiện có.
+        Ghép phần tiêu đề của chunk (cột reference_header, là nội dung trước dòng phân cách
+        chứa dấu gạch (-) trong page_content, được tính sẵn khi ghi chunk) với nội dung references hiện có.
         """
-        extracted_header = ""
-        if page_content:
-            # Tìm phần nội dung trước dòng chứa ít nhất 3 dấu gạch liên tiếp ở dòng mới
-            match = re.search(r'^(.*?)(?:\n-+\n)', page_content, flags=re.DOTALL)
-            if match:
-                extracted_header = match.group(1).strip()
+        extracted_header = reference_header or ""
         if extracted_header and references and references.strip():
             return extracted_header + "\n" + references
         elif extracted_header:
@@ -58,17 +214,340 @@ class DocumentRetriever:
     def run(self,
             query_text: str,
             threshold: float,
-            category: str = None
+            category: str = None,
+            fused: bool = False,
+            ef_search: int = None
             ) -> List[RelevantDocument]:
-        hybrid_search_documents = self.hybrid_search(
+        """
+        ef_search: hnsw.ef_search áp dụng cho truy vấn vector của lần gọi này,
+        lớn hơn thì recall cao hơn nhưng chậm hơn (mặc định HNSW_EF_SEARCH).
+        """
+        search_settings = self._vector_search_settings(ef_search)
+        cache_key = self._result_cache_key(
+            query_text, threshold, category, fused, search_settings, self._corpus_version()
+        )
+        cached_result = self._cached_result(cache_key)
+        if cached_result is not None:
+            return cached_result
+
+        search = self.fused_search if fused else self.hybrid_search
+        hybrid_search_documents = search(
             query_text=query_text,
-            category=category
+            category=category,
+            search_settings=search_settings
             )
         rerank_hybrid_search = self.rerank_documents(
             query=query_text,
             documents=hybrid_search_documents,
             threshold=threshold
             )
+        results = self._collect_results(rerank_hybrid_search)
+        self.hydrate_documents(results["final_rerank"] + results["backup_rerank"])
+        self._store_result(cache_key, results)
+        return results
+
+
+    @observe(name="RetrieverAndReranker")
+    async def arun(self,
+                query_text: str,
+                threshold: float,
+                category: str = None,
+                fused: bool = False,
+                ef_search: int = None
+                ) -> List[RelevantDocument]:
+        search_settings = self._vector_search_settings(ef_search)
+        cache_key = self._result_cache_key(
+            query_text, threshold, category, fused, search_settings, await self._acorpus_version()
+        )
+        cached_result = await self._acached_result(cache_key)
+        if cached_result is not None:
+            return cached_result
+
+        search = self.afused_search if fused else self.ahybrid_search
+        hybrid_search_documents = await search(
+            query_text=query_text,
+            category=category,
+            search_settings=search_settings
+            )
+        rerank_hybrid_search = await self.arerank_documents(
+            query=query_text,
+            documents=hybrid_search_documents,
+            threshold=threshold
+            )
+        results = self._collect_results(rerank_hybrid_search)
+        await self.ahydrate_documents(results["final_rerank"] + results["backup_rerank"])
+        await self._astore_result(cache_key, results)
+        return results
+
+
+    @observe(name="RetrieverAndReranker_many")
+    def run_many(self,
+                queries: List[str],
+                threshold: float,
+                category: str = None,
+                ef_search: int = None
+                ) -> List[dict]:
+        """
+        Retrieve + rerank nhiều câu truy vấn (ví dụ câu đã viết lại và câu hỏi gốc) trong một lượt:
+        một lần gọi `/embed`, một truy vấn semantic `LATERAL` và một lần gọi `/rerank` đã loại trùng.
+        Trả về một kết quả cho mỗi câu, theo thứ tự `queries`, cùng dạng với kết quả của `run`.
+        """
+        search_settings = self._vector_search_settings(ef_search)
+        corpus_version = self._corpus_version()
+        cache_keys = {
+            query_text: self._result_cache_key(
+                query_text, threshold, category, False, search_settings, corpus_version
+            )
+            for query_text in queries
+        }
+        results = {}
+        for query_text, cache_key in cache_keys.items():
+            cached_result = self._cached_result(cache_key)
+            if cached_result is not None:
+                results[query_text] = cached_result
+
+        pending = [query_text for query_text in cache_keys if query_text not in results]
+        if pending:
+            candidates = self.hybrid_search_many(
+                queries=pending,
+                category=category,
+                search_settings=search_settings
+                )
+            reranked = self.rerank_documents_many(
+                queries=pending,
+                candidates=candidates,
+                threshold=threshold
+                )
+            fresh = {
+                query_text: self._collect_results(rerank_hybrid_search)
+                for query_text, rerank_hybrid_search in zip(pending, reranked)
+            }
+            # Nạp các cột nặng cho tài liệu của tất cả câu truy vấn bằng một truy vấn
+            self.hydrate_documents([
+                doc
+                for result in fresh.values()
+                for doc in result["final_rerank"] + result["backup_rerank"]
+            ])
+            for query_text, result in fresh.items():
+                self._store_result(cache_keys[query_text], result)
+            results.update(fresh)
+
+        return [copy.deepcopy(results[query_text]) for query_text in queries]
+
+
+    def _remember_corpus_version(self, version: str) -> str:
+        with _corpus_version_lock:
+            _corpus_version_state["value"] = version
+            _corpus_version_state["expires_at"] = time.monotonic() + CORPUS_VERSION_TTL
+        return version
+
+
+    def _recent_corpus_version(self) -> str:
+        with _corpus_version_lock:
+            if time.monotonic() < _corpus_version_state["expires_at"]:
+                return _corpus_version_state["value"]
+        return None
+
+
+    def _corpus_version(self) -> str:
+        """Phiên bản corpus lấy từ bộ đếm do trigger duy trì, dự phòng bằng max(updated_at) và số dòng"""
+        version = self._recent_corpus_version()
+        if version is not None:
+            return version
+        try:
+            with self._session_scope() as session:
+                try:
+                    version = session.execute(CORPUS_VERSION_SQL).scalar()
+                except Exception:
+                    session.rollback()
+                    version = None
+                if version is None:
+                    version = "stats:" + session.execute(CORPUS_STATS_SQL).scalar()
+                session.commit()
+        except Exception as e:
+            logger.warning(f"Không đọc được phiên bản corpus, bỏ qua cache kết quả: {str(e)}")
+            return None
+        return self._remember_corpus_version(version)
+
+
+    async def _acorpus_version(self) -> str:
+        version = self._recent_corpus_version()
+        if version is not None:
+            return version
+        try:
+            async with async_session_scope() as session:
+                try:
+                    version = (await session.execute(CORPUS_VERSION_SQL)).scalar()
+                except Exception:
+                    await session.rollback()
+                    version = None
+                if version is None:
+                    version = "stats:" + (await session.execute(CORPUS_STATS_SQL)).scalar()
+        except Exception as e:
+            logger.warning(f"Không đọc được phiên bản corpus, bỏ qua cache kết quả: {str(e)}")
+            return None
+        return self._remember_corpus_version(version)
+
+
+    def _result_cache_key(self,
+                        query_text: str,
+                        threshold: float,
+                        category: str,
+                        fused: bool,
+                        search_settings: dict,
+                        corpus_version: str
+                        ) -> str:
+        if corpus_version is None:
+            return None
+        raw_key = json.dumps(
+            [query_text, category, threshold, fused, search_settings, LEXICAL_BACKEND, COLBERT_TOP_N, corpus_version],
+            ensure_ascii=False, sort_keys=True
+        )
+        return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+
+    def _cached_result(self, cache_key: str) -> dict:
+        if cache_key is None:
+            return None
+        return self._use_cached_result(*retrieval_result_cache.lookup(cache_key))
+
+
+    async def _acached_result(self, cache_key: str) -> dict:
+        if cache_key is None:
+            return None
+        return self._use_cached_result(*(await retrieval_result_cache.alookup(cache_key)))
+
+
+    def _use_cached_result(self, result: dict, tier: str) -> dict:
+        langfuse_context.update_current_observation(
+            metadata={"retrieval_cache": tier or "miss"}
+        )
+        return copy.deepcopy(result) if result is not None else None
+
+
+    def _cacheable_result(self, cache_key: str, results: dict) -> bool:
+        if cache_key is None:
+            return False
+        # Không cache kết quả dự phòng khi API rerank lỗi (tài liệu chưa có cross_score)
+        documents = results["final_rerank"] + results["backup_rerank"]
+        return all(doc.get("cross_score") is not None for doc in documents)
+
+
+    def _store_result(self, cache_key: str, results: dict) -> None:
+        if self._cacheable_result(cache_key, results):
+            retrieval_result_cache.set(cache_key, copy.deepcopy(results))
+
+
+    async def _astore_result(self, cache_key: str, results: dict) -> None:
+        if self._cacheable_result(cache_key, results):
+            await retrieval_result_cache.aset(cache_key, copy.deepcopy(results))
+
+
+    def _chunk_cache_key(self, chunk_id, content_hash: str, corpus_version: str) -> str:
+        if content_hash is None or corpus_version is None:
+            return None
+        return f"{chunk_id}:{content_hash}:{corpus_version}"
+
+
+    def _hydrate_statement(self, chunk_ids: List[int]):
+        return (
+            select(Embedding.chunk_id,
+                Embedding.content_hash,
+                Embedding.tables,
+                Embedding.images,
+                Embedding.references,
+                Embedding.reference_header,
+                Embedding.category,
+                Embedding.url
+                )
+            .where(Embedding.chunk_id == any_(bindparam("chunk_ids", chunk_ids, type_=ARRAY(Integer))))
+        )
+
+
+    def _chunk_cache_keys(self, documents: List[dict], corpus_version: str) -> dict:
+        return {
+            doc['id']: self._chunk_cache_key(doc['id'], doc.get('content_hash'), corpus_version)
+            for doc in documents
+        }
+
+
+    def _pending_hydration(self, cache_keys: dict, cached: dict) -> tuple:
+        """Các cột nặng có sẵn trong chunk cache (kết quả lookup_many) và các chunk_id còn phải đọc từ database"""
+        heavy_columns = {}
+        for chunk_id, key in cache_keys.items():
+            if key is not None and cached[key][0] is not None:
+                heavy_columns[chunk_id] = cached[key][0]
+        missing_ids = sorted(chunk_id for chunk_id in cache_keys if chunk_id not in heavy_columns)
+        return heavy_columns, missing_ids
+
+
+    def _hydrated_columns(self, heavy_columns: dict, rows, corpus_version: str) -> dict:
+        """Thêm các cột nặng vừa đọc từ database vào heavy_columns, trả về các mục cần ghi vào chunk cache"""
+        cache_items = {}
+        for row in rows:
+            columns = {
+                "tables": row.tables,
+                "images": row.images,
+                "references": row.references,
+                "reference_header": row.reference_header,
+                "category": row.category,
+                "url": row.url,
+            }
+            heavy_columns[row.chunk_id] = columns
+            key = self._chunk_cache_key(row.chunk_id, row.content_hash, corpus_version)
+            if key is not None:
+                cache_items[key] = columns
+        return cache_items
+
+
+    def _apply_hydration(self, documents: List[dict], heavy_columns: dict) -> None:
+        for doc in documents:
+            columns = heavy_columns.get(doc['id'])
+            if columns is None:
+                continue
+            doc.update({key: value for key, value in columns.items() if key != "reference_header"})
+            doc['references'] = self._join_references(columns['reference_header'], columns['references'])
+
+
+    @observe(name="DocumentRetriever_hydrate")
+    def hydrate_documents(self, documents: List[dict]) -> None:
+        """
+        Nạp các cột nặng (tables, images, references, url, ...) cho các tài liệu còn lại sau rerank
+        bằng một truy vấn `chunk_id = ANY(...)`, dùng chunk cache theo (chunk_id, content_hash, phiên bản corpus).
+        """
+        corpus_version = self._corpus_version()
+        cache_keys = self._chunk_cache_keys(documents, corpus_version)
+        heavy_columns, missing_ids = self._pending_hydration(
+            cache_keys, chunk_cache.lookup_many([key for key in cache_keys.values() if key is not None])
+        )
+        rows = []
+        if missing_ids:
+            try:
+                with self._session_scope() as session:
+                    rows = session.execute(self._hydrate_statement(missing_ids)).fetchall()
+                    session.commit()
+            except Exception as e:
+                logger.error(f"Error in hydrate_documents: {str(e)}")
+                raise
+        chunk_cache.set_many(self._hydrated_columns(heavy_columns, rows, corpus_version))
+        self._apply_hydration(documents, heavy_columns)
+
+
+    @observe(name="DocumentRetriever_ahydrate")
+    async def ahydrate_documents(self, documents: List[dict]) -> None:
+        corpus_version = await self._acorpus_version()
+        cache_keys = self._chunk_cache_keys(documents, corpus_version)
+        heavy_columns, missing_ids = self._pending_hydration(
+            cache_keys, await chunk_cache.alookup_many([key for key in cache_keys.values() if key is not None])
+        )
+        rows = []
+        if missing_ids:
+            rows = await self._aexecute(self._hydrate_statement(missing_ids))
+        await chunk_cache.aset_many(self._hydrated_columns(heavy_columns, rows, corpus_version))
+        self._apply_hydration(documents, heavy_columns)
+
+
+    def _collect_results(self, rerank_hybrid_search: dict) -> dict:
         rerank_hybrid_search_documents = rerank_hybrid_search["top_reranked_documents"]
         backup_hybrid_search_documents = rerank_hybrid_search["reranked_documents"]
 
@@ -84,162 +563,864 @@ class DocumentRetriever:
         }
 
 
-    
+    def _base_conditions(self, category: str = None) -> list:
+        base_conditions = []
+        if category:
+            if category == "All":
+                base_conditions = []
+            else:
+                # Category được render thành literal để planner chọn được partial HNSW index của category
+                base_conditions.append(
+                    Embedding.category == bindparam("category", category, type_=Text, literal_execute=True)
+                )
+        return base_conditions
+
+
+    def _full_text_statement(self, search_query: str, base_conditions: list):
+        full_text_conditions = base_conditions.copy()
+        full_text_conditions.append(Embedding.page_content.op('@@@')(cast(search_query, Text)))
+        return (
+            select(Embedding.chunk_id,
+                    Embedding.page_content,
+                    Embedding.content_hash,
+                    text("paradedb.score(embeddings.chunk_id)")
+                    )
+            .where(and_(
+                *full_text_conditions
+            ))
+            .order_by(text("score DESC"))
+            .limit(LIMIT_SEARCH)
+        )
+
+
+    def _sparse_statement(self, query_sparse: dict, base_conditions: list):
+        """Lượt lexical theo inner product của lexical weights (index HNSW sparsevec_ip_ops)"""
+        return (
+            select(Embedding.chunk_id,
+                    Embedding.page_content,
+                    Embedding.content_hash
+                    )
+            .where(and_(
+                Embedding.sparse_embedding.isnot(None),
+                *base_conditions
+            ))
+            .order_by(Embedding.sparse_embedding.max_inner_product(sparse_vector(query_sparse)))
+            .limit(LIMIT_SEARCH)
+        )
+
+
+    def _semantic_statement(self, query_embedding: List[float], base_conditions: list):
+        return vector_search_statement(
+            query_embedding,
+            base_conditions,
+            columns=(Embedding.chunk_id,
+                Embedding.page_content,
+                Embedding.content_hash
+                )
+        )
+
+
+    def _append_documents(self,
+                        rows,
+                        documents: List[RelevantDocument],
+                        seen_ids: Set[str],
+                        query_text: str = None
+                        ) -> None:
+        for row in rows:
+            if row.chunk_id not in seen_ids:
+                # Chỉ giữ nội dung cần cho rerank, các cột nặng được nạp sau khi rerank (hydrate)
+                documents.append(
+                    RelevantDocument(
+                        id=row.chunk_id,
+                        page_content=row.page_content,
+                        content_hash=row.content_hash
+                    )
+                )
+                seen_ids.add(row.chunk_id)
+            elif query_text is not None:
+                logger.info(
+                    f"Trùng kết quả semantic search và BM25 search với query = `{query_text}`, id = {row.chunk_id}"
+                )
+
+
+    def _fresh_replica(self):
+        """Vector replica trong tiến trình nếu đã bắt kịp phiên bản corpus hiện tại, ngược lại None (dùng pgvector)"""
+        replica = get_vector_replica()
+        if replica is None:
+            return None
+        return self._check_replica(replica, self._corpus_version())
+
+
+    async def _afresh_replica(self):
+        replica = get_vector_replica()
+        if replica is None:
+            return None
+        return self._check_replica(replica, await self._acorpus_version())
+
+
+    def _check_replica(self, replica, corpus_version: str):
+        if corpus_version is None or replica.corpus_version != corpus_version:
+            logger.info(
+                f"Vector replica chưa cập nhật (replica = {replica.corpus_version}, corpus = {corpus_version}), dùng pgvector"
+            )
+            return None
+        return replica
+
+
+    def _chunks_statement(self, chunk_ids: List[int]):
+        """Nội dung cần cho rerank của các chunk tìm được qua vector replica, đọc theo khóa chính"""
+        return (
+            select(Embedding.chunk_id,
+                Embedding.page_content,
+                Embedding.content_hash
+                )
+            .where(Embedding.chunk_id == any_(bindparam("chunk_ids", chunk_ids, type_=ARRAY(Integer))))
+        )
+
+
+    def _ordered_rows(self, rows, chunk_ids: List[int]) -> list:
+        # Giữ thứ tự khoảng cách của replica, bỏ qua chunk đã bị xóa khỏi database
+        rows_by_id = {row.chunk_id: row for row in rows}
+        return [rows_by_id[chunk_id] for chunk_id in chunk_ids if chunk_id in rows_by_id]
+
+
+    def _embed_query(self, query_text: str) -> tuple:
+        """Embedding dense và (khi LEXICAL_BACKEND=sparse) lexical weights từ cùng một lần gọi `/embed`"""
+        if LEXICAL_BACKEND == "sparse":
+            return self.embedder.run_hybrid(query_text)
+        return self.embedder.run(query_text), None
+
+
+    async def _aembed_query(self, query_text: str) -> tuple:
+        if LEXICAL_BACKEND == "sparse":
+            return await self.embedder.arun_hybrid(query_text)
+        return await self.embedder.arun(query_text), None
+
+
+    def _sparse_search(self,
+                    session,
+                    query_sparse: dict,
+                    base_conditions: list,
+                    documents: List[RelevantDocument],
+                    seen_ids: Set[str],
+                    search_settings: dict = None
+                    ) -> None:
+        if not query_sparse:
+            return
+        self._apply_vector_search_settings(session, search_settings)
+        sparse_query = session.execute(
+            self._sparse_statement(query_sparse, base_conditions)
+        ).fetchall()
+
+        logger.info(f'sparse_query: {len(sparse_query)}')
+        self._append_documents(sparse_query, documents, seen_ids)
+
+
+    def _lexical_search(self,
+                        session,
+                        cleaned_query: str,
+                        base_conditions: list,
+                        documents: List[RelevantDocument],
+                        seen_ids: Set[str]
+                        ) -> None:
+        """Full text search, nếu không có kết quả thì thử lại với truy vấn `AND` của 10 từ đầu"""
+        if cleaned_query:
+            full_text_query = session.execute(
+                self._full_text_statement(cleaned_query, base_conditions)
+            ).fetchall()
+
+            logger.info(f'full_text_query: {len(full_text_query)}')
+            # Xử lý kết quả full text search
+            self._append_documents(full_text_query, documents, seen_ids)
+        if not documents:
+            processed_query = ' AND '.join(cleaned_query.split()[:10]).strip()
+            if processed_query:
+                bm25_query = session.execute(
+                    self._full_text_statement(processed_query, base_conditions)
+                ).fetchall()
+
+                logger.info(f'bm25_query: {len(bm25_query)}')
+                # Xử lý kết quả BM25 search
+                self._append_documents(bm25_query, documents, seen_ids)
+
+
     @observe(name="DocumentRetriever_hybrid_search")
     def hybrid_search(self,
                     query_text: str,
-                    category: str = None
+                    category: str = None,
+                    search_settings: dict = None
                     ) -> List[RelevantDocument]:
-        query_embedding = self.embedder.run(query_text)
+        query_embedding, query_sparse = self._embed_query(query_text)
+        replica = self._fresh_replica()
         documents: List[RelevantDocument] = []
         seen_ids: Set[str] = set()
         cleaned_query = re.sub(r'[^\w\s]', '', query_text)
         print("query_text: ", query_text)
         print("cleaned_query: ", cleaned_query)
         
-        try:
-            base_conditions = []
-            if category:
-                if category == "All":
-                    base_conditions = []
-                else:
-                    base_conditions.append(Embedding.category == category)
+        with self._session_scope() as session:
             try:
-                if cleaned_query:
-                    full_text_conditions = base_conditions.copy()
-                    full_text_conditions.append(Embedding.page_content.op('@@@')(cleaned_query))
-
-
-                    full_text_query = self.session.execute(
-                        select(Embedding.chunk_id,
-                                Embedding.page_content,
-                                Embedding.tables,
-                                Embedding.images,
-                                Embedding.references,
-                                Embedding.category,
-                                Embedding.url,
-                                text("paradedb.score(embeddings.chunk_id)")
-                                )
-                        .where(and_(
-                            *full_text_conditions
-                        ))
-                        .order_by(text("score DESC"))
-                        .limit(LIMIT_SEARCH)
-                    ).fetchall()
-                    
-
-                    logger.info(f'full_text_query: {len(full_text_query)}')
-                    # Xử lý kết quả full text search
-                    for row in full_text_query:
-                        if row.chunk_id not in seen_ids:
-                            new_references = self._join_references(row.page_content, row.references)
-                            documents.append(
-                                RelevantDocument(
-                                    id=row.chunk_id,
-                                    page_content=row.page_content,
-                                    tables=row.tables,
-                                    images=row.images,
-                                    references=new_references,
-                                    category=row.category,
-                                    url=row.url
-                                )
-                            )
-                            seen_ids.add(row.chunk_id)
-                if not documents:
-                    processed_query = ' AND '.join(cleaned_query.split()[:10]).strip()
-                    if processed_query:
-                        bm25_conditions = base_conditions.copy()
-                        bm25_conditions.append(Embedding.page_content.op('@@@')(processed_query))
-
-                        bm25_query = self.session.execute(
-                            select(Embedding.chunk_id,
-                                Embedding.page_content,
-                                Embedding.tables,
-                                Embedding.images,
-                                Embedding.category,
-                                Embedding.references,
-                                Embedding.url,
-                                text("paradedb.score(embeddings.chunk_id)"))
-                            .where(and_(
-                                *bm25_conditions
-                            ))
-                            .order_by(text("score DESC"))
-                            .limit(LIMIT_SEARCH)
-                        ).fetchall()
+                base_conditions = self._base_conditions(category)
+                try:
+                    if LEXICAL_BACKEND == "sparse":
+                        self._sparse_search(session, query_sparse, base_conditions, documents, seen_ids, search_settings)
+                    else:
+                        self._lexical_search(session, cleaned_query, base_conditions, documents, seen_ids)
 
-                        logger.info(f'bm25_query: {len(bm25_query)}')
-                        # Xử lý kết quả BM25 search
-                        for row in bm25_query:
-                            if row.chunk_id not in seen_ids:
-                                new_references = self._join_references(row.page_content, row.references)
-                                documents.append(
-                                    RelevantDocument(
-                                        id=row.chunk_id,
-                                        page_content=row.page_content,
-                                        tables=row.tables,
-                                        images=row.images,
-                                        references=new_references,
-                                        category=row.category,
-                                        url=row.url
-                                    )
-                                )
-                                seen_ids.add(row.chunk_id)
-
-
-                # Query semantic search
-                semantic_query = self.session.execute(
-                    select(Embedding.chunk_id,
-                        Embedding.page_content,
-                        Embedding.tables,
-                        Embedding.images,
-                        Embedding.references,
-                        Embedding.category,
-                        Embedding.url
-                        )
-                    .where(and_(
-                        *base_conditions
+                    # Query semantic search
+                    if replica is not None:
+                        chunk_ids, _ = replica.search(query_embedding, LIMIT_SEARCH, category)
+                        semantic_query = self._ordered_rows(
+                            session.execute(self._chunks_statement(chunk_ids)).fetchall(), chunk_ids
                         )
-                    )
-                    .order_by(Embedding.embedding.l2_distance(query_embedding))
-                    .limit(LIMIT_SEARCH)
-                ).fetchall()
+                    else:
+                        self._apply_vector_search_settings(session, search_settings)
+                        semantic_query = session.execute(
+                            self._semantic_statement(query_embedding, base_conditions)
+                        ).fetchall()
+
+                    logger.info(f'semantic_query: {len(semantic_query)}')
+
+                    # Xử lý kết quả semantic search
+                    self._append_documents(semantic_query, documents, seen_ids, query_text=query_text)
+
+                except Exception as e:
+                    traceback.print_exc()
+                    logger.warning(f"Full text search failed: {str(e)}")
+                    session.rollback()
+            
+
+                session.commit()
+
+            except Exception as e:
+                logger.error(f"Error in hybrid_search: {str(e)}")
+                session.rollback()
+                raise
+        return [doc.to_dict() for doc in documents]
+
 
-                logger.info(f'semantic_query: {len(semantic_query)}')
-
-                # Xử lý kết quả semantic search
-                for row in semantic_query:
-                    if row.chunk_id not in seen_ids:
-                        new_references = self._join_references(row.page_content, row.references)
-                        documents.append(
-                            RelevantDocument(
-                                id=row.chunk_id,
-                                page_content=row.page_content,
-                                tables=row.tables,
-                                images=row.images,
-                                references=new_references,
-                                category=row.category,
-                                url=row.url
+    def _semantic_many_statement(self,
+                                query_embeddings: List[List[float]],
+                                category: str = None):
+        """
+        Semantic search cho nhiều embedding trong một truy vấn: danh sách `VALUES` các embedding
+        được `CROSS JOIN LATERAL` với truy vấn HNSW, mỗi embedding lấy LIMIT_SEARCH chunk gần nhất.
+        """
+        params = {"limit": LIMIT_SEARCH}
+        category_filter = self._category_filter_sql(category, params)
+        semantic_filter = semantic_filter_sql("q.embedding", category_filter)
+        if VECTOR_INDEX_STORAGE != "vector":
+            params["rescore_limit"] = LIMIT_SEARCH * VECTOR_RESCORE_FACTOR
+
+        values = []
+        embedding_params = []
+        for idx, query_embedding in enumerate(query_embeddings):
+            params[f"query_embedding_{idx}"] = query_embedding
+            values.append(f"({idx}, CAST(:query_embedding_{idx} AS vector))")
+            embedding_params.append(bindparam(f"query_embedding_{idx}", type_=Vector(1024)))
+
+        statement = text(f"""
+            SELECT q.query_index, e.chunk_id, e.page_content, e.content_hash
+            FROM (VALUES {", ".join(values)}) AS q(query_index, embedding)
+            CROSS JOIN LATERAL (
+                SELECT c.chunk_id, c.page_content, c.content_hash, c.embedding <-> q.embedding AS distance
+                FROM embeddings c
+                WHERE {semantic_filter}
+                ORDER BY distance
+                LIMIT :limit
+            ) e
+            ORDER BY q.query_index, e.distance
+        """).bindparams(*embedding_params)
+        if "category" in params:
+            statement = statement.bindparams(bindparam("category", type_=Text, literal_execute=True))
+        return statement, params
+
+
+    @observe(name="DocumentRetriever_hybrid_search_many")
+    def hybrid_search_many(self,
+                        queries: List[str],
+                        category: str = None,
+                        search_settings: dict = None
+                        ) -> List[List[dict]]:
+        """
+        hybrid_search cho nhiều câu truy vấn trên cùng một session: embedding của tất cả câu
+        được lấy bằng một lần gọi `/embed` và semantic search chạy một truy vấn `LATERAL` duy nhất.
+        Full text search vẫn chạy từng câu. Thứ tự gộp và loại trùng của mỗi câu giữ nguyên như hybrid_search.
+        """
+        if LEXICAL_BACKEND == "sparse":
+            query_embeddings, query_sparses = self.embedder.run_many_hybrid(queries)
+        else:
+            query_embeddings, query_sparses = self.embedder.run_many(queries), None
+        replica = self._fresh_replica()
+        documents: List[List[RelevantDocument]] = [[] for _ in queries]
+        seen_ids: List[Set[str]] = [set() for _ in queries]
+
+        with self._session_scope() as session:
+            try:
+                base_conditions = self._base_conditions(category)
+                try:
+                    for idx, query_text in enumerate(queries):
+                        if query_sparses is not None:
+                            self._sparse_search(
+                                session, query_sparses[idx], base_conditions, documents[idx], seen_ids[idx], search_settings
                             )
-                        )
-                        seen_ids.add(row.chunk_id)
+                        else:
+                            cleaned_query = re.sub(r'[^\w\s]', '', query_text)
+                            self._lexical_search(session, cleaned_query, base_conditions, documents[idx], seen_ids[idx])
+
+                    # Query semantic search cho tất cả embedding
+                    if replica is not None:
+                        semantic_ids = [
+                            replica.search(query_embedding, LIMIT_SEARCH, category)[0]
+                            for query_embedding in query_embeddings
+                        ]
+                        all_ids = sorted({chunk_id for chunk_ids in semantic_ids for chunk_id in chunk_ids})
+                        semantic_query = session.execute(self._chunks_statement(all_ids)).fetchall()
+                        semantic_rows = [self._ordered_rows(semantic_query, chunk_ids) for chunk_ids in semantic_ids]
                     else:
-                        logger.info(
-                            f"Trùng kết quả semantic search và BM25 search với query = `{query_text}`, id = {row.chunk_id}"
-                        )
+                        statement, params = self._semantic_many_statement(query_embeddings, category)
+                        self._apply_vector_search_settings(session, search_settings)
+                        semantic_query = session.execute(statement, params).fetchall()
+                        semantic_rows = [
+                            [row for row in semantic_query if row.query_index == idx]
+                            for idx in range(len(queries))
+                        ]
+
+                    logger.info(f'semantic_query_many: {len(semantic_query)}')
+
+                    for idx, query_text in enumerate(queries):
+                        self._append_documents(semantic_rows[idx], documents[idx], seen_ids[idx], query_text=query_text)
+
+                except Exception as e:
+                    traceback.print_exc()
+                    logger.warning(f"Full text search failed: {str(e)}")
+                    session.rollback()
+
+                session.commit()
 
             except Exception as e:
-                traceback.print_exc()
-                logger.warning(f"Full text search failed: {str(e)}")
-                self.session.rollback()
-            
+                logger.error(f"Error in hybrid_search_many: {str(e)}")
+                session.rollback()
+                raise
+        return [[doc.to_dict() for doc in query_documents] for query_documents in documents]
+
+
+    def _vector_search_settings(self, ef_search: int = None) -> dict:
+        """Các tham số pgvector áp dụng cho truy vấn vector của một request"""
+        settings = {}
+        ef_search = ef_search if ef_search is not None else HNSW_EF_SEARCH
+        if ef_search is not None:
+            ef_search = int(ef_search)
+            if not 1 <= ef_search <= 1000:
+                raise ValueError(f"ef_search phải nằm trong khoảng [1, 1000], nhận {ef_search}")
+            settings["hnsw.ef_search"] = ef_search
+        if HNSW_ITERATIVE_SCAN != "off":
+            settings["hnsw.iterative_scan"] = HNSW_ITERATIVE_SCAN
+        return settings
 
-            self.session.commit()
 
+    def _apply_vector_search_settings(self, session, search_settings: dict = None) -> None:
+        # Tương đương SET LOCAL: chỉ có hiệu lực trong transaction hiện tại
+        for name, value in (search_settings or {}).items():
+            session.execute(SET_CONFIG_SQL, {"name": name, "value": str(value)})
+
+
+    async def _aapply_vector_search_settings(self, session, search_settings: dict = None) -> None:
+        for name, value in (search_settings or {}).items():
+            await session.execute(SET_CONFIG_SQL, {"name": name, "value": str(value)})
+
+
+    async def _aexecute(self, statement, params: dict = None, search_settings: dict = None) -> list:
+        # Mỗi truy vấn dùng một session (connection) riêng để có thể chạy song song
+        async with async_session_scope() as session:
+            await self._aapply_vector_search_settings(session, search_settings)
+            result = await session.execute(statement, params)
+            return result.fetchall()
+
+
+    async def _asemantic_search(self,
+                                query_text: str,
+                                base_conditions: list,
+                                search_settings: dict = None,
+                                category: str = None,
+                                query_embedding: List[float] = None
+                                ) -> list:
+        if query_embedding is None:
+            query_embedding = await self.embedder.arun(query_text)
+        replica = await self._afresh_replica()
+        if replica is not None:
+            chunk_ids, _ = await asyncio.to_thread(replica.search, query_embedding, LIMIT_SEARCH, category)
+            return self._ordered_rows(await self._aexecute(self._chunks_statement(chunk_ids)), chunk_ids)
+        return await self._aexecute(
+            self._semantic_statement(query_embedding, base_conditions),
+            search_settings=search_settings
+        )
+
+
+    @observe(name="DocumentRetriever_ahybrid_search")
+    async def ahybrid_search(self,
+                            query_text: str,
+                            category: str = None,
+                            search_settings: dict = None
+                            ) -> List[RelevantDocument]:
+        """
+        Phiên bản bất đồng bộ của hybrid_search: full text search, truy vấn dự phòng `AND`
+        và semantic search được khởi chạy cùng lúc, mỗi truy vấn trên một connection riêng.
+        Thứ tự gộp và loại trùng giữ nguyên như hybrid_search.
+        """
+        documents: List[RelevantDocument] = []
+        seen_ids: Set[str] = set()
+        cleaned_query = re.sub(r'[^\w\s]', '', query_text)
+        processed_query = ' AND '.join(cleaned_query.split()[:10]).strip()
+        base_conditions = self._base_conditions(category)
+
+        async def _skip():
+            return []
+
+        if LEXICAL_BACKEND == "sparse":
+            # Dense và sparse lấy từ một lần gọi `/embed`, lượt lexical là một truy vấn sparsevec
+            query_embedding, query_sparse = await self.embedder.arun_hybrid(query_text)
+            full_text_task = self._aexecute(
+                self._sparse_statement(query_sparse, base_conditions),
+                search_settings=search_settings
+            ) if query_sparse else _skip()
+            bm25_task = _skip()
+            semantic_task = self._asemantic_search(
+                query_text, base_conditions, search_settings, category, query_embedding=query_embedding
+            )
+        else:
+            full_text_task = self._aexecute(
+                self._full_text_statement(cleaned_query, base_conditions)
+            ) if cleaned_query else _skip()
+            # Truy vấn dự phòng chạy luôn, không chờ kết quả full text search rỗng mới bắt đầu
+            bm25_task = self._aexecute(
+                self._full_text_statement(processed_query, base_conditions)
+            ) if processed_query else _skip()
+            semantic_task = self._asemantic_search(query_text, base_conditions, search_settings, category)
+
+        async def _fallback(task):
+            # Truy vấn dự phòng chỉ được dùng khi full text search rỗng, lỗi của nó không làm hỏng kết quả.
+            # Lỗi của lượt lexical chính và semantic được ném ra như hybrid_search
+            try:
+                return await task
+            except Exception as e:
+                logger.warning(f"bm25_query failed: {str(e)}")
+                return []
+
+        full_text_query, bm25_query, semantic_query = await asyncio.gather(
+            full_text_task, _fallback(bm25_task), semantic_task
+        )
+
+        lexical_name = "sparse_query" if LEXICAL_BACKEND == "sparse" else "full_text_query"
+        logger.info(f'{lexical_name}: {len(full_text_query)}')
+        logger.info(f'bm25_query: {len(bm25_query)}')
+        logger.info(f'semantic_query: {len(semantic_query)}')
+
+        self._append_documents(full_text_query, documents, seen_ids)
+        if not documents:
+            self._append_documents(bm25_query, documents, seen_ids)
+        self._append_documents(semantic_query, documents, seen_ids, query_text=query_text)
+
+        return [doc.to_dict() for doc in documents]
+
+
+    def _category_filter_sql(self, category: str, params: dict) -> str:
+        if category and category != "All":
+            params["category"] = category
+            return "AND category = :category"
+        return ""
+
+
+    def _fused_statement(self,
+                        query_text: str,
+                        query_embedding: List[float],
+                        category: str = None,
+                        query_sparse: dict = None):
+        """
+        Tạo câu truy vấn hybrid search một lượt: xếp hạng BM25 (`@@@`), xếp hạng vector (HNSW),
+        lọc category và reciprocal rank fusion đều thực hiện trong database.
+        Truy vấn dự phòng `AND` chỉ được dùng khi full text search không có kết quả.
+        Chỉ FUSED_TOP_K chunk sau fusion được join lại để lấy nội dung cần cho rerank.
+        Khi LEXICAL_BACKEND=sparse, xếp hạng lexical là inner product của lexical weights (`query_sparse`).
+        """
+        cleaned_query = re.sub(r'[^\w\s]', '', query_text)
+        processed_query = ' AND '.join(cleaned_query.split()[:10]).strip()
+        params = {
+            "query_embedding": query_embedding,
+            "limit": LIMIT_SEARCH,
+            "rrf_k": RRF_K,
+            "top_k": FUSED_TOP_K,
+        }
+
+        category_filter = self._category_filter_sql(category, params)
+        semantic_filter = semantic_filter_sql("CAST(:query_embedding AS vector)", category_filter)
+        if VECTOR_INDEX_STORAGE != "vector":
+            params["rescore_limit"] = LIMIT_SEARCH * VECTOR_RESCORE_FACTOR
+
+        lexical_ctes = []
+        if LEXICAL_BACKEND == "sparse":
+            cleaned_query = processed_query = ""
+            if query_sparse:
+                params["query_sparse"] = sparse_vector(query_sparse)
+                lexical_ctes.append(f"""
+            sparse AS (
+                SELECT chunk_id, ROW_NUMBER() OVER (ORDER BY distance, chunk_id) AS rank
+                FROM (
+                    SELECT chunk_id, sparse_embedding <#> CAST(:query_sparse AS sparsevec) AS distance
+                    FROM embeddings
+                    WHERE sparse_embedding IS NOT NULL {category_filter}
+                    ORDER BY distance
+                    LIMIT :limit
+                ) ranked
+            ),""")
+        if cleaned_query:
+            params["full_text_query"] = cleaned_query
+            lexical_ctes.append(f"""
+            full_text AS (
+                SELECT chunk_id, ROW_NUMBER() OVER (ORDER BY score DESC, chunk_id) AS rank
+                FROM (
+                    SELECT chunk_id, paradedb.score(chunk_id) AS score
+                    FROM embeddings
+                    WHERE page_content @@@ CAST(:full_text_query AS text) {category_filter}
+                    ORDER BY score DESC
+                    LIMIT :limit
+                ) ranked
+            ),""")
+        if processed_query:
+            params["bm25_query"] = processed_query
+            no_full_text = "AND NOT EXISTS (SELECT 1 FROM full_text)" if cleaned_query else ""
+            lexical_ctes.append(f"""
+            bm25 AS (
+                SELECT chunk_id, ROW_NUMBER() OVER (ORDER BY score DESC, chunk_id) AS rank
+                FROM (
+                    SELECT chunk_id, paradedb.score(chunk_id) AS score
+                    FROM embeddings
+                    WHERE page_content @@@ CAST(:bm25_query AS text) {category_filter} {no_full_text}
+                    ORDER BY score DESC
+                    LIMIT :limit
+                ) ranked
+            ),""")
+        lexical_sources = [
+            f"SELECT chunk_id, rank FROM {name}"
+            for name, query in (("sparse", params.get("query_sparse")),
+                                ("full_text", cleaned_query),
+                                ("bm25", processed_query))
+            if query
+        ] or ["SELECT NULL::integer AS chunk_id, NULL::bigint AS rank WHERE FALSE"]
+
+        statement = text(f"""
+            WITH {"".join(lexical_ctes)}
+            lexical AS (
+                {" UNION ALL ".join(lexical_sources)}
+            ),
+            semantic AS (
+                SELECT chunk_id, ROW_NUMBER() OVER (ORDER BY distance, chunk_id) AS rank
+                FROM (
+                    SELECT chunk_id, embedding <-> CAST(:query_embedding AS vector) AS distance
+                    FROM embeddings
+                    WHERE {semantic_filter}
+                    ORDER BY distance
+                    LIMIT :limit
+                ) ranked
+            ),
+            fused AS (
+                SELECT COALESCE(l.chunk_id, s.chunk_id) AS chunk_id,
+                    COALESCE(1.0 / (:rrf_k + l.rank), 0.0) + COALESCE(1.0 / (:rrf_k + s.rank), 0.0) AS score
+                FROM lexical l
+                FULL OUTER JOIN semantic s ON l.chunk_id = s.chunk_id
+                ORDER BY score DESC, chunk_id
+                LIMIT :top_k
+            )
+            SELECT f.chunk_id, f.score, e.page_content, e.content_hash
+            FROM fused f
+            JOIN embeddings e ON e.chunk_id = f.chunk_id
+            ORDER BY f.score DESC, f.chunk_id
+        """).bindparams(bindparam("query_embedding", type_=Vector(1024)))
+        if "query_sparse" in params:
+            statement = statement.bindparams(bindparam("query_sparse", type_=SPARSEVEC(SPARSE_DIMENSION)))
+        if "category" in params:
+            statement = statement.bindparams(bindparam("category", type_=Text, literal_execute=True))
+        return statement, params
+
+
+    def _fused_documents(self, rows) -> List[dict]:
+        documents: List[RelevantDocument] = []
+        for row in rows:
+            documents.append(
+                RelevantDocument(
+                    id=row.chunk_id,
+                    page_content=row.page_content,
+                    content_hash=row.content_hash,
+                    score=float(row.score)
+                )
+            )
+        return [doc.to_dict() for doc in documents]
+
+
+    @observe(name="DocumentRetriever_fused_search")
+    def fused_search(self,
+                    query_text: str,
+                    category: str = None,
+                    search_settings: dict = None
+                    ) -> List[dict]:
+        query_embedding, query_sparse = self._embed_query(query_text)
+        statement, params = self._fused_statement(query_text, query_embedding, category, query_sparse)
+        try:
+            with self._session_scope() as session:
+                self._apply_vector_search_settings(session, search_settings)
+                rows = session.execute(statement, params).fetchall()
+                session.commit()
         except Exception as e:
-            logger.error(f"Error in hybrid_search: {str(e)}")
-            self.session.rollback()
+            logger.error(f"Error in fused_search: {str(e)}")
             raise
-        return [doc.to_dict() for doc in documents]
+        logger.info(f'fused_query: {len(rows)}')
+        return self._fused_documents(rows)
+
+
+    @observe(name="DocumentRetriever_afused_search")
+    async def afused_search(self,
+                            query_text: str,
+                            category: str = None,
+                            search_settings: dict = None
+                            ) -> List[dict]:
+        query_embedding, query_sparse = await self._aembed_query(query_text)
+        statement, params = self._fused_statement(query_text, query_embedding, category, query_sparse)
+        rows = await self._aexecute(statement, params, search_settings=search_settings)
+        logger.info(f'fused_query: {len(rows)}')
+        return self._fused_documents(rows)
+
+
+    def _documents_from_dicts(self, documents: List[dict]) -> List[RelevantDocument]:
+        return [RelevantDocument(
+            id=doc['id'],
+            page_content=doc['page_content'],
+            tables=doc.get('tables'),
+            images=doc.get('images'),
+            references=doc.get('references'),
+            category=doc.get('category'),
+            url=doc.get('url'),
+            score=doc.get('score'),
+            content_hash=doc.get('content_hash'),
+            colbert_score=doc.get('colbert_score')
+        ) for doc in documents]
+
+
+    def _rerank_scores(self, api_response: dict) -> List[float]:
+        if "results" in api_response:
+            # `/rerank/query` trả về theo điểm giảm dần, đưa về thứ tự tài liệu đã gửi
+            similarity_scores = [None] * len(api_response["results"])
+            for result in api_response["results"]:
+                similarity_scores[result["index"]] = result["score"]
+            return similarity_scores
+        if "scores" not in api_response:
+            logger.error(f"Invalid API response format: {api_response}")
+            return None
+        similarity_scores = api_response["scores"]
+        # Server trả về một số thay vì list khi chỉ có một cặp câu
+        if not isinstance(similarity_scores, list):
+            similarity_scores = [similarity_scores]
+        return similarity_scores
+
+
+    def _rerank_request(self, sentence_pairs: List[list], document_keys: List[str] = None) -> tuple:
+        """Endpoint và payload của một lần gọi rerank"""
+        # Server bỏ các cặp còn nằm trong hàng đợi sau RERANK_TIMEOUT, lúc đó client đã hết thời gian chờ
+        deadline_ms = RERANK_TIMEOUT * 1000
+        queries = {pair[0] for pair in sentence_pairs}
+        if RERANK_QUERY_API and len(queries) == 1:
+            document_keys = document_keys or [None] * len(sentence_pairs)
+            return f"{API_URL}/rerank/query", {
+                "query": sentence_pairs[0][0],
+                "documents": [
+                    {"text": pair[1], "content_hash": key} for pair, key in zip(sentence_pairs, document_keys)
+                ],
+                "deadline_ms": deadline_ms
+            }
+        return f"{API_URL}/rerank", {"sentence_pairs": sentence_pairs, "normalized": False, "deadline_ms": deadline_ms}
+
+
+    def _request_rerank_scores(self, sentence_pairs: List[list], document_keys: List[str] = None) -> List[float]:
+        """
+        Gọi API rerank, trả về None nếu API lỗi để caller dùng thứ tự retrieve. document_keys (content_hash
+        của từng tài liệu) cho phép server dùng lại token đã tokenize của tài liệu.
+        """
+        if not sentence_pairs:
+            return []
+        url, payload = self._rerank_request(sentence_pairs, document_keys)
+        try:
+            api_response = post_json(
+                url,
+                payload,
+                timeout=RERANK_TIMEOUT,
+                max_retries=RERANK_MAX_RETRIES,
+                name="API rerank",
+                headers=RERANK_HEADERS
+            )
+        except Exception as e:
+            logger.error(f"API request failed: {str(e)}")
+            return None
+        return self._rerank_scores(api_response)
+
+
+    async def _arequest_rerank_scores(self, sentence_pairs: List[list], document_keys: List[str] = None) -> List[float]:
+        if not sentence_pairs:
+            return []
+        url, payload = self._rerank_request(sentence_pairs, document_keys)
+        try:
+            api_response = await apost_json(
+                url,
+                payload,
+                timeout=RERANK_TIMEOUT,
+                max_retries=RERANK_MAX_RETRIES,
+                name="API rerank",
+                headers=RERANK_HEADERS
+            )
+        except Exception as e:
+            logger.error(f"API request failed: {str(e)}")
+            return None
+        return self._rerank_scores(api_response)
+
+
+    def _fallback_rerank(self, documents: List[RelevantDocument]) -> dict:
+        # Trả về documents gốc nếu API rerank lỗi
+        return {
+            "top_reranked_documents": [doc.to_dict() for doc in documents[:5]],
+            "reranked_documents": [doc.to_dict() for doc in documents[:3]]
+        }
+
+
+    def _rerank_cache_key(self, query: str, content_hash: str) -> str:
+        """Khóa cache điểm rerank: hash của (model, câu truy vấn) + content_hash, chunk không có content_hash không được cache"""
+        if not content_hash:
+            return None
+        query_hash = hashlib.sha256(f"{RERANK_MODEL_NAME}|{PASSAGE_WINDOW_SIGNATURE}|{query}".encode("utf-8")).hexdigest()
+        return f"{query_hash}:{content_hash}"
+
+
+    def _rerank_cache_keys(self, pairs: List[tuple]) -> List[str]:
+        return [self._rerank_cache_key(query, doc.content_hash) for query, doc in pairs]
+
+
+    def _lookup_rerank_scores(self, pairs: List[tuple], cache_keys: List[str], cached: dict) -> tuple:
+        """
+        Điểm trong cache (kết quả lookup_many) của các cặp (query, RelevantDocument). Trả về (điểm, vị trí các cặp
+        còn phải gửi sang `/rerank`) và ghi tỷ lệ trúng cache của request vào Langfuse.
+        """
+        scores = [cached[key][0] if key in cached else None for key in cache_keys]
+        missing = [idx for idx, score in enumerate(scores) if score is None]
+        hits = len(pairs) - len(missing)
+        hit_rate = hits / len(pairs) if pairs else 0.0
+        logger.info(f"rerank cache: {hits}/{len(pairs)} cặp trúng cache")
+        langfuse_context.update_current_observation(
+            metadata={
+                "rerank_cache_hits": hits,
+                "rerank_cache_misses": len(missing),
+                "rerank_cache_hit_rate": round(hit_rate, 3)
+            }
+        )
+        return scores, missing
+
+
+    def _missing_window_pairs(self, pairs: List[tuple], missing: List[int]) -> tuple:
+        """Các cặp [query, cửa sổ] của những chunk chưa có điểm trong cache, kèm vị trí chunk và khóa của từng cửa sổ"""
+        sentence_pairs, owners, window_keys = window_pairs([pairs[idx] for idx in missing])
+        langfuse_context.update_current_observation(
+            metadata={"rerank_chunks": len(missing), "rerank_windows": len(sentence_pairs)}
+        )
+        return sentence_pairs, owners, window_keys
+
+
+    def _merge_rerank_scores(self,
+                             scores: list,
+                             cache_keys: list,
+                             missing: List[int],
+                             fetched: List[float],
+                             owners: List[int]) -> List[float]:
+        """
+        Gộp điểm các cửa sổ về chunk (lấy max) và ghép vào đúng vị trí. Trả về các mục cần ghi vào cache điểm
+        rerank, None nếu API rerank lỗi.
+        """
+        if fetched is None:
+            return None
+        for idx, score in zip(missing, aggregate_scores(fetched, owners, len(missing))):
+            scores[idx] = score
+        return {cache_keys[idx]: scores[idx] for idx in missing if cache_keys[idx] is not None}
+
+
+    def _score_pairs(self, pairs: List[tuple]) -> List[float]:
+        """
+        Điểm cross-encoder của các cặp (query, RelevantDocument). Chỉ các cặp chưa có trong cache được
+        gửi sang `/rerank`, mỗi chunk được thay bằng các cửa sổ tốt nhất của nó (xem passage_windows).
+        """
+        cache_keys = self._rerank_cache_keys(pairs)
+        scores, missing = self._lookup_rerank_scores(
+            pairs, cache_keys, rerank_score_cache.lookup_many([key for key in cache_keys if key is not None])
+        )
+        sentence_pairs, owners, window_keys = self._missing_window_pairs(pairs, missing)
+        fetched = self._request_rerank_scores(sentence_pairs, window_keys)
+        cache_items = self._merge_rerank_scores(scores, cache_keys, missing, fetched, owners)
+        if cache_items is None:
+            return None
+        rerank_score_cache.set_many(cache_items)
+        return scores
+
+
+    async def _ascore_pairs(self, pairs: List[tuple]) -> List[float]:
+        cache_keys = self._rerank_cache_keys(pairs)
+        scores, missing = self._lookup_rerank_scores(
+            pairs, cache_keys, await rerank_score_cache.alookup_many([key for key in cache_keys if key is not None])
+        )
+        sentence_pairs, owners, window_keys = self._missing_window_pairs(pairs, missing)
+        fetched = await self._arequest_rerank_scores(sentence_pairs, window_keys)
+        cache_items = self._merge_rerank_scores(scores, cache_keys, missing, fetched, owners)
+        if cache_items is None:
+            return None
+        await rerank_score_cache.aset_many(cache_items)
+        return scores
+
+
+    def _rank_documents(self,
+                        documents: List[RelevantDocument],
+                        similarity_scores: List[float],
+                        threshold: float
+                        ) -> dict:
+        # Sigmoid và scoring
+        def sigmoid(x):
+            return 1 / (1 + np.exp(-x))
+
+        # Gán điểm số từ API cho từng tài liệu
+        for idx, document in enumerate(documents):
+            document.cross_score = sigmoid(similarity_scores[idx])  # Lấy điểm từ API
+
+        filter_documents = [doc for doc in documents if doc.cross_score >= threshold]
+
+        no_filter_documents = sorted(
+            documents,
+            key=lambda item: item.cross_score,
+            reverse=True  # Sắp xếp theo thứ tự giảm dần
+        )[:4]
+
+
+        # Sắp xếp tài liệu theo điểm số từ API (cross_score)
+        reranked_documents = sorted(
+            filter_documents,  # Sử dụng danh sách đã được lọc
+            key=lambda item: item.cross_score,
+            reverse=True  # Sắp xếp theo thứ tự giảm dần
+        )
+
+        # Chỉ lấy 5 tài liệu hàng đầu
+        top_reranked_documents = reranked_documents[:5]
+
+        print(f"Number of reranked documents: {len(reranked_documents)}")
+
+        print("Top 5 hits with API rerank scores:")
+        for item in top_reranked_documents:
+            print("\t{:.3f}\t{}".format(item.cross_score, item.id))
+
+        return {
+            "top_reranked_documents": [doc.to_dict() for doc in top_reranked_documents],
+            "reranked_documents": [doc.to_dict() for doc in no_filter_documents]
+        }
 
 
     @observe(name="Rerank_Document")
@@ -250,99 +1431,82 @@ class DocumentRetriever:
         threshold: float = 0.2
         ) -> List[RelevantDocument]:
         try:
-            documents = [RelevantDocument(
-                id=doc['id'],
-                page_content=doc['page_content'],
-                tables=doc['tables'],
-                images=doc['images'],
-                references=doc['references'],
-                category=doc['category'],
-                url=doc['url']
-            ) for doc in documents]
-
-            # Tạo các cặp câu truy vấn và nội dung tài liệu
-            sentence_pairs = [[query, item.page_content] for item in documents]
-            
-            payload = json.dumps({
-                "sentence_pairs": sentence_pairs,
-                "normalized": False
-            })
-
-            url = f"{API_URL}/rerank"
-            headers = {
-                'Content-Type': 'application/json'
-            }
+            documents = self._documents_from_dicts(documents)
+            # Lượt ColBERT: chỉ gửi COLBERT_TOP_N ứng viên tốt nhất sang cross-encoder
+            documents = self.colbert_scorer.prune(query, documents)
 
-            try:
-                # Gửi yêu cầu POST với payload đến API rerank
-                response = requests.request("POST", url, headers=headers, data=payload)
-
-                # In phản hồi từ server (nếu cần debug)
-                # print(response.text)
-
-                # Parse phản hồi JSON từ server
-                api_response = json.loads(response.text)
-                
-                if "scores" in api_response:
-                    similarity_scores = api_response["scores"]
-                else:
-                    logger.error(f"Invalid API response format: {api_response}")
-                    # Trả về documents gốc thay vì raise error
-                    return {
-                        "top_reranked_documents": [doc.to_dict() for doc in documents[:5]],
-                        "reranked_documents": [doc.to_dict() for doc in documents[:3]]
-                    }
-
-            except requests.exceptions.RequestException as e:
-                logger.error(f"API request failed: {str(e)}")
-                # Trả về documents gốc nếu API fail
-                return {
-                    "top_reranked_documents": [doc.to_dict() for doc in documents[:5]],
-                    "reranked_documents": [doc.to_dict() for doc in documents[:3]]
-                }
-
-            # Sigmoid và scoring
-            def sigmoid(x):
-                return 1 / (1 + np.exp(-x))
-
-            # Gán điểm số từ API cho từng tài liệu
-            for idx, document in enumerate(documents):
-                document.cross_score = sigmoid(similarity_scores[idx])  # Lấy điểm từ API
-
-            filter_documents = [doc for doc in documents if doc.cross_score >= threshold]
-
-            no_filter_documents = sorted(
-                documents,  # Sử dụng danh sách đã được lọc
-                key=lambda item: item.cross_score,
-                reverse=True  # Sắp xếp theo thứ tự giảm dần
-            )[:4]
-
-
-            # Sắp xếp tài liệu theo điểm số từ API (cross_score)
-            reranked_documents = sorted(
-                filter_documents,  # Sử dụng danh sách đã được lọc
-                key=lambda item: item.cross_score,
-                reverse=True  # Sắp xếp theo thứ tự giảm dần
-            )
+            # Tạo các cặp câu truy vấn và tài liệu, chỉ các cặp chưa có điểm trong cache được gửi sang API
+            similarity_scores = self._score_pairs([(query, item) for item in documents])
+            if similarity_scores is None:
+                return self._fallback_rerank(documents)
+            return self._rank_documents(documents, similarity_scores, threshold)
+
+        except Exception as e:
+            logger.error(f"Error in rerank_documents: {str(e)}")
+            # Trả về documents gốc trong trường hợp lỗi
+            return self._fallback_rerank(documents)
 
-            # Chỉ lấy 5 tài liệu hàng đầu
-            top_reranked_documents = reranked_documents[:5]
 
-            print(f"Number of reranked documents: {len(reranked_documents)}")
+    @observe(name="Rerank_Document")
+    async def arerank_documents(
+        self,
+        query: str,
+        documents: List[dict],
+        threshold: float = 0.2
+        ) -> List[RelevantDocument]:
+        """Phiên bản bất đồng bộ của rerank_documents, gọi `/rerank` qua client dùng chung mà không chặn event loop"""
+        try:
+            documents = self._documents_from_dicts(documents)
+            # Lượt ColBERT đọc database đồng bộ nên chạy trong thread riêng
+            documents = await asyncio.to_thread(self.colbert_scorer.prune, query, documents)
 
-            print("Top 5 hits with API rerank scores:")
-            for item in top_reranked_documents:
-                print("\t{:.3f}\t{}".format(item.cross_score, item.id))
+            similarity_scores = await self._ascore_pairs([(query, item) for item in documents])
+            if similarity_scores is None:
+                return self._fallback_rerank(documents)
+            return self._rank_documents(documents, similarity_scores, threshold)
 
-            return {
-                "top_reranked_documents": [doc.to_dict() for doc in top_reranked_documents],
-                "reranked_documents": [doc.to_dict() for doc in no_filter_documents]
-            }
+        except Exception as e:
+            logger.error(f"Error in arerank_documents: {str(e)}")
+            return self._fallback_rerank(documents)
+
+
+    @observe(name="Rerank_Document_many")
+    def rerank_documents_many(
+        self,
+        queries: List[str],
+        candidates: List[List[dict]],
+        threshold: float = 0.2
+        ) -> List[dict]:
+        """
+        Rerank ứng viên của nhiều câu truy vấn bằng một lần gọi `/rerank`. Các cặp (query, chunk)
+        trùng nhau chỉ được chấm một lần; kết quả trả về theo thứ tự `queries`.
+        """
+        candidates = [
+            self.colbert_scorer.prune(query, self._documents_from_dicts(documents))
+            for query, documents in zip(queries, candidates)
+        ]
+        try:
+            pair_index = {}
+            pairs = []
+            for query, documents in zip(queries, candidates):
+                for doc in documents:
+                    if (query, doc.id) not in pair_index:
+                        pair_index[(query, doc.id)] = len(pairs)
+                        pairs.append((query, doc))
+            logger.info(f"rerank_documents_many: {len(pairs)} cặp cho {len(queries)} câu truy vấn")
+
+            similarity_scores = self._score_pairs(pairs)
+            if similarity_scores is None:
+                return [self._fallback_rerank(documents) for documents in candidates]
+            return [
+                self._rank_documents(
+                    documents,
+                    [similarity_scores[pair_index[(query, doc.id)]] for doc in documents],
+                    threshold
+                )
+                for query, documents in zip(queries, candidates)
+            ]
 
         except Exception as e:
-            logger.error(f"Error in rerank_documents: {str(e)}")
-            # Trả về documents gốc trong trường hợp lỗi
-            return {
-                "top_reranked_documents": [doc.to_dict() for doc in documents[:5]],
-                "reranked_documents": [doc.to_dict() for doc in documents[:3]]
-            }
\ No newline at end of file
+            logger.error(f"Error in rerank_documents_many: {str(e)}")
+            return [self._fallback_rerank(documents) for documents in candidates]
@@ -31,12 +31,91 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 
-from langfuse.decorators import observe
-import requests
-import json
-from typing import List
-import time
+from langfuse.decorators import observe, langfuse_context
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import unicodedata
+import numpy as np
+from pgvector import SparseVector
 from utils.monitor_log import logger
+from utils.cache import TwoTierCache, shared_redis_client
+from utils.http_client import post_json, apost_json
+from models.embedding import SPARSE_DIMENSION
+from utils.wire_format import EMBEDDING_MEDIA_TYPE, accept_header, decode_embeddings
+
+# Cache embedding của câu truy vấn
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 4096))
+EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", 3600))
+EMBEDDING_CACHE_REDIS_TTL = int(os.getenv("EMBEDDING_CACHE_REDIS_TTL", 86400))
+# Giới hạn batch_size của server embedding (LIMIT_MAX_BATCH_SIZE)
+MAX_REQUEST_BATCH_SIZE = 64
+# Timeout đọc (giây) của mỗi lần gọi `/embed`
+EMBED_TIMEOUT = float(os.getenv("EMBED_TIMEOUT", 30))
+
+# Định dạng response của `/embed`: binary (float32/float16 thô, xem wire_format) | json
+EMBED_WIRE_FORMAT = os.getenv("EMBED_WIRE_FORMAT", "binary")
+
+# Lớp ưu tiên gửi trong header X-Priority: câu truy vấn là interactive, ingest/backfill là bulk
+# (server phục vụ interactive trước và cắt request bulk thành các lát nhỏ)
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BULK = "bulk"
+
+# Số token có trọng số lớn nhất được giữ lại cho mỗi chunk (index HNSW sparsevec giới hạn 1000 phần tử khác 0)
+SPARSE_MAX_TERMS = int(os.getenv("SPARSE_MAX_TERMS", 256))
+
+
+def normalize_query(text: str) -> str:
+    """Chuẩn hóa câu truy vấn làm khóa cache: Unicode NFC, gộp khoảng trắng, không phân biệt hoa thường"""
+    return " ".join(unicodedata.normalize("NFC", text).split()).casefold()
+
+
+query_embedding_cache = TwoTierCache(
+    namespace="embedding",
+    maxsize=EMBEDDING_CACHE_SIZE,
+    ttl=EMBEDDING_CACHE_TTL,
+    redis_client=shared_redis_client(),
+    redis_ttl=EMBEDDING_CACHE_REDIS_TTL,
+    # Lưu vector dạng float32 thô trên Redis thay vì JSON
+    dumps=lambda value: np.asarray(value, dtype=np.float32).tobytes(),
+    loads=lambda raw: np.frombuffer(raw, dtype=np.float32).tolist(),
+)
+
+# Cache lexical weights (sparse) của câu truy vấn, lưu JSON {token_id: weight}
+query_sparse_cache = TwoTierCache(
+    namespace="sparse_embedding",
+    maxsize=EMBEDDING_CACHE_SIZE,
+    ttl=EMBEDDING_CACHE_TTL,
+    redis_client=shared_redis_client(),
+    redis_ttl=EMBEDDING_CACHE_REDIS_TTL,
+)
+
+# Cache vector ColBERT của câu truy vấn, lưu float16 thô (mỗi token 1024 chiều)
+query_colbert_cache = TwoTierCache(
+    namespace="colbert_embedding",
+    maxsize=EMBEDDING_CACHE_SIZE,
+    ttl=EMBEDDING_CACHE_TTL,
+    redis_client=shared_redis_client(),
+    redis_ttl=EMBEDDING_CACHE_REDIS_TTL,
+    dumps=lambda value: np.asarray(value, dtype=np.float16).tobytes(),
+    loads=lambda raw: np.frombuffer(raw, dtype=np.float16).reshape(-1, 1024),
+)
+
+
+def parse_embed_response(response) -> dict:
+    """Kết quả `embeddings` của `/embed`; server cũ bỏ qua header Accept và vẫn trả JSON"""
+    if response.headers.get("content-type", "").startswith(EMBEDDING_MEDIA_TYPE):
+        return decode_embeddings(response.content)
+    return response.json()['embeddings']
+
+
+def sparse_vector(weights: Dict[str, float], max_terms: int = None):
+    """Đổi lexical weights `{token_id: weight}` của `/embed` thành pgvector SparseVector"""
+    items = sorted(((int(token_id), float(weight)) for token_id, weight in weights.items()),
+                key=lambda item: item[1], reverse=True)
+    if max_terms:
+        items = items[:max_terms]
+    return SparseVector(dict(items), SPARSE_DIMENSION)
+
 
 class Embedder:
     def __init__(
@@ -45,43 +124,247 @@ class Embedder:
         batch_size: int = 1,
         max_length: int = 4096,
         max_retries: int = 20,
-        retry_delay: float = 2.0
+        retry_delay: float = 2.0,
+        model_name: str = "BAAI/bge-m3",
+        cache: Optional[TwoTierCache] = None,
+        sparse_cache: Optional[TwoTierCache] = None,
+        colbert_cache: Optional[TwoTierCache] = None,
+        priority: str = PRIORITY_INTERACTIVE
     ) -> None:
         self.url = url
         self.batch_size = batch_size
         self.max_length = max_length
         self.max_retries = max_retries
         self.retry_delay = retry_delay
+        self.model_name = model_name
+        self.cache = cache
+        self.sparse_cache = sparse_cache
+        self.colbert_cache = colbert_cache
+        self.priority = priority
+
+    def _cache_key(self, text: str) -> str:
+        raw_key = f"{self.model_name}|{self.max_length}|{normalize_query(text)}"
+        return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
 
     @observe(name="Embedder")
     def run(self, text: str) -> List[float]:
-        payload = json.dumps({
-            "sentences": [text],
+        return self._embed([text])[0][0]
+
+    @observe(name="Embedder")
+    async def arun(self, text: str) -> List[float]:
+        return (await self._aembed([text]))[0][0]
+
+    @observe(name="Embedder_batch")
+    def run_many(self, texts: List[str]) -> List[List[float]]:
+        """Embed nhiều câu, các câu chưa có trong cache được gửi chung trong một lần gọi `/embed`"""
+        return self._embed(texts)[0]
+
+    @observe(name="Embedder_batch")
+    async def arun_many(self, texts: List[str]) -> List[List[float]]:
+        return (await self._aembed(texts))[0]
+
+    @observe(name="Embedder_hybrid")
+    def run_hybrid(self, text: str) -> Tuple[List[float], Dict[str, float]]:
+        """Vector dense và lexical weights (sparse) của câu truy vấn từ cùng một lần gọi model"""
+        dense, sparse = self._embed([text], sparse=True)
+        return dense[0], sparse[0]
+
+    @observe(name="Embedder_hybrid")
+    async def arun_hybrid(self, text: str) -> Tuple[List[float], Dict[str, float]]:
+        dense, sparse = await self._aembed([text], sparse=True)
+        return dense[0], sparse[0]
+
+    @observe(name="Embedder_hybrid_batch")
+    def run_many_hybrid(self, texts: List[str]) -> Tuple[List[List[float]], List[Dict[str, float]]]:
+        return self._embed(texts, sparse=True)
+
+    def _lookup(self, cache: Optional[TwoTierCache], cache_keys: List[str], values: list, name: str) -> None:
+        if cache is None:
+            return
+        self._fill_cached(cache, cache_keys, cache.lookup_many(cache_keys), values, name)
+
+    async def _alookup(self, cache: Optional[TwoTierCache], cache_keys: List[str], values: list, name: str) -> None:
+        if cache is None:
+            return
+        self._fill_cached(cache, cache_keys, await cache.alookup_many(cache_keys), values, name)
+
+    def _fill_cached(self, cache: TwoTierCache, cache_keys: List[str], cached: dict, values: list, name: str) -> None:
+        tiers = []
+        for idx, cache_key in enumerate(cache_keys):
+            values[idx], tier = cached[cache_key]
+            tiers.append(tier or "miss")
+        langfuse_context.update_current_observation(
+            metadata={
+                f"{name}_cache": tiers[0] if len(tiers) == 1 else tiers,
+                f"{name}_cache_stats": cache.snapshot()
+            }
+        )
+
+    def _new_state(self, texts: List[str], sparse: bool = False) -> dict:
+        return {
+            "embeddings": [None] * len(texts),
+            "sparse_weights": [None] * len(texts) if sparse else None,
+            "cache_keys": [self._cache_key(text) for text in texts],
+        }
+
+    def _pending(self, texts: List[str], sparse: bool = False) -> dict:
+        """Đọc cache, trả về trạng thái gồm kết quả đã có và các câu (không trùng) còn phải gọi API"""
+        state = self._new_state(texts, sparse)
+        self._lookup(self.cache, state["cache_keys"], state["embeddings"], "embedding")
+        if sparse:
+            self._lookup(self.sparse_cache, state["cache_keys"], state["sparse_weights"], "sparse_embedding")
+        return self._find_missing(texts, state, sparse)
+
+    async def _apending(self, texts: List[str], sparse: bool = False) -> dict:
+        state = self._new_state(texts, sparse)
+        await self._alookup(self.cache, state["cache_keys"], state["embeddings"], "embedding")
+        if sparse:
+            await self._alookup(self.sparse_cache, state["cache_keys"], state["sparse_weights"], "sparse_embedding")
+        return self._find_missing(texts, state, sparse)
+
+    def _find_missing(self, texts: List[str], state: dict, sparse: bool) -> dict:
+        state["missing"] = [
+            idx for idx in range(len(texts))
+            if state["embeddings"][idx] is None or (sparse and state["sparse_weights"][idx] is None)
+        ]
+        # Loại các câu trùng nhau trước khi gọi API
+        state["unique_texts"] = list(dict.fromkeys(texts[idx] for idx in state["missing"]))
+        return state
+
+    def _complete(self, texts: List[str], state: dict, result: dict) -> Tuple[List[List[float]], Optional[List[Dict[str, float]]]]:
+        for cache, items in self._merge_fetched(texts, state, result):
+            cache.set_many(items)
+        return state["embeddings"], state["sparse_weights"]
+
+    async def _acomplete(self, texts: List[str], state: dict, result: dict) -> Tuple[List[List[float]], Optional[List[Dict[str, float]]]]:
+        for cache, items in self._merge_fetched(texts, state, result):
+            await cache.aset_many(items)
+        return state["embeddings"], state["sparse_weights"]
+
+    def _merge_fetched(self, texts: List[str], state: dict, result: dict) -> List[Tuple[TwoTierCache, dict]]:
+        """Ghép kết quả API vào các vị trí còn thiếu, trả về các cặp (cache, giá trị) cần ghi lại"""
+        embeddings, sparse_weights, cache_keys, missing = (
+            state["embeddings"], state["sparse_weights"], state["cache_keys"], state["missing"]
+        )
+        if missing:
+            dense_vecs = result['dense_vecs']
+            # Response nhị phân trả về mảng numpy chỉ đọc trên buffer, đổi sang list như JSON và cache Redis
+            if isinstance(dense_vecs, np.ndarray):
+                dense_vecs = dense_vecs.tolist()
+            fetched = dict(zip(state["unique_texts"], dense_vecs))
+            fetched_sparse = dict(zip(state["unique_texts"], result['sparse_vecs'])) if sparse_weights is not None else {}
+            for idx in missing:
+                embeddings[idx] = fetched[texts[idx]]
+                if sparse_weights is not None:
+                    sparse_weights[idx] = fetched_sparse[texts[idx]]
+        writes = []
+        if missing and self.cache is not None:
+            writes.append((self.cache, {cache_keys[idx]: embeddings[idx] for idx in missing}))
+        if missing and sparse_weights is not None and self.sparse_cache is not None:
+            writes.append((self.sparse_cache, {cache_keys[idx]: sparse_weights[idx] for idx in missing}))
+        return writes
+
+    def _embed(self, texts: List[str], sparse: bool = False) -> Tuple[List[List[float]], Optional[List[Dict[str, float]]]]:
+        state = self._pending(texts, sparse)
+        result = self._request(state["unique_texts"], dense=True, sparse=sparse) if state["missing"] else None
+        return self._complete(texts, state, result)
+
+    async def _aembed(self, texts: List[str], sparse: bool = False) -> Tuple[List[List[float]], Optional[List[Dict[str, float]]]]:
+        state = await self._apending(texts, sparse)
+        result = await self._arequest(state["unique_texts"], dense=True, sparse=sparse) if state["missing"] else None
+        return await self._acomplete(texts, state, result)
+
+    @observe(name="Embedder_colbert")
+    def run_colbert(self, text: str) -> np.ndarray:
+        """Vector ColBERT (token x 1024, float16) của câu truy vấn"""
+        cache_key = self._cache_key(text)
+        if self.colbert_cache is not None:
+            vectors, tier = self.colbert_cache.lookup(cache_key)
+            langfuse_context.update_current_observation(metadata={"colbert_embedding_cache": tier or "miss"})
+            if vectors is not None:
+                return vectors
+        vectors = np.asarray(self._request([text], dense=False, colbert=True)['colbert_vecs'][0], dtype=np.float16)
+        if self.colbert_cache is not None:
+            self.colbert_cache.set(cache_key, vectors)
+        return vectors
+
+    def embed_colbert(self, texts: List[str]) -> List[np.ndarray]:
+        """Vector ColBERT float16 của các chunk khi ingest (không dùng cache, lớp bulk)"""
+        return [
+            np.asarray(vectors, dtype=np.float16)
+            for vectors in self._request(texts, dense=False, colbert=True, priority=PRIORITY_BULK)['colbert_vecs']
+        ]
+
+    def embed_sparse(self, texts: List[str]) -> List[Dict[str, float]]:
+        """Lexical weights của các chunk khi ingest (không dùng cache, lớp bulk)"""
+        return self._request(texts, dense=False, sparse=True, priority=PRIORITY_BULK)['sparse_vecs']
+
+    def _request_embeddings(self, texts: List[str]) -> List[List[float]]:
+        dense_vecs = self._request(texts)['dense_vecs']
+        return dense_vecs.tolist() if isinstance(dense_vecs, np.ndarray) else dense_vecs
+
+    def _payload(self, texts: List[str], dense: bool = True, sparse: bool = False, colbert: bool = False) -> dict:
+        return {
+            "sentences": texts,
             "params": {
-                "batch_size": self.batch_size,
+                "batch_size": min(max(self.batch_size, len(texts)), MAX_REQUEST_BATCH_SIZE),
                 "max_length": self.max_length
             },
             "embedding_types": {
-                "dense": True,
-                "sparse": False,
-                "colbert": False
+                "dense": dense,
+                "sparse": sparse,
+                "colbert": colbert
             }
-        })
-        headers = {'Content-Type': 'application/json'}
-        
-        for attempt in range(self.max_retries):
-            try:
-                response = requests.post(self.url, headers=headers, data=payload)
-                response.raise_for_status()
-                result = response.json()
-                return result['embeddings']['dense_vecs'][0]
-            except Exception as e:
-                logger.warning(f"Lỗi khi gọi API embedding (lần thử {attempt + 1}/{self.max_retries}): {str(e)}")
-                if attempt < self.max_retries - 1:
-                    time.sleep(self.retry_delay)
-                else:
-                    logger.error("Đã hết số lần thử lại. Không thể lấy embedding.")
-                    raise
+        }
+
+    def _headers(self, dense: bool, priority: Optional[str] = None) -> dict:
+        headers = {"X-Priority": priority or self.priority}
+        if EMBED_WIRE_FORMAT == "binary":
+            # Vector ColBERT chỉ được dùng ở float16 nên không cần nhận float32
+            headers["Accept"] = accept_header("float32" if dense else "float16")
+        return headers
+
+    def _request(self,
+                 texts: List[str],
+                 dense: bool = True,
+                 sparse: bool = False,
+                 colbert: bool = False,
+                 priority: Optional[str] = None) -> dict:
+        try:
+            return post_json(
+                self.url,
+                self._payload(texts, dense, sparse, colbert),
+                timeout=EMBED_TIMEOUT,
+                max_retries=self.max_retries,
+                base_delay=self.retry_delay,
+                name="API embedding",
+                headers=self._headers(dense, priority),
+                parse=parse_embed_response
+            )
+        except Exception:
+            logger.error("Đã hết số lần thử lại. Không thể lấy embedding.")
+            raise
+
+    async def _arequest(self,
+                        texts: List[str],
+                        dense: bool = True,
+                        sparse: bool = False,
+                        colbert: bool = False,
+                        priority: Optional[str] = None) -> dict:
+        try:
+            return await apost_json(
+                self.url,
+                self._payload(texts, dense, sparse, colbert),
+                timeout=EMBED_TIMEOUT,
+                max_retries=self.max_retries,
+                base_delay=self.retry_delay,
+                name="API embedding",
+                headers=self._headers(dense, priority),
+                parse=parse_embed_response
+            )
+        except Exception:
+            logger.error("Đã hết số lần thử lại. Không thể lấy embedding.")
+            raise
 
 
 
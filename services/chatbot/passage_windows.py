@@ -0,0 +1,127 @@
+"""
+Chia chunk dài thành các cửa sổ (passage window) có độ dài giới hạn trước khi gửi sang cross-encoder.
+Mỗi chunk chỉ gửi PASSAGE_TOP_WINDOWS cửa sổ có điểm trùng từ với câu truy vấn cao nhất, điểm của chunk
+là điểm lớn nhất của các cửa sổ đó, nên chi phí mỗi cặp (query, chunk) không phụ thuộc độ dài chunk.
+
+Cửa sổ được giới hạn theo số từ (tách theo khoảng trắng), quy đổi từ số token bằng PASSAGE_TOKENS_PER_WORD
+vì phía chatbot không tải tokenizer của reranker. Danh sách cửa sổ được cache theo content_hash và cấu hình
+cửa sổ (PASSAGE_WINDOW_CONFIG).
+"""
+import os
+import re
+from typing import List, Tuple
+from utils.cache import TwoTierCache
+
+# Số token tối đa của một cửa sổ (0: tắt, gửi nguyên chunk)
+PASSAGE_WINDOW_TOKENS = int(os.getenv("PASSAGE_WINDOW_TOKENS", 384))
+# Số token chồng lấn giữa hai cửa sổ liên tiếp
+PASSAGE_WINDOW_OVERLAP = int(os.getenv("PASSAGE_WINDOW_OVERLAP", 64))
+# Số cửa sổ mỗi chunk được gửi sang cross-encoder
+PASSAGE_TOP_WINDOWS = int(os.getenv("PASSAGE_TOP_WINDOWS", 1))
+# Tỷ lệ token/từ ước lượng của tokenizer XLM-R cho văn bản tiếng Việt
+PASSAGE_TOKENS_PER_WORD = float(os.getenv("PASSAGE_TOKENS_PER_WORD", 1.4))
+PASSAGE_WINDOW_CACHE_SIZE = int(os.getenv("PASSAGE_WINDOW_CACHE_SIZE", 4096))
+PASSAGE_WINDOW_CACHE_TTL = int(os.getenv("PASSAGE_WINDOW_CACHE_TTL", 3600))
+
+# Các tham số quyết định cách chia cửa sổ (số từ của mỗi cửa sổ phụ thuộc PASSAGE_TOKENS_PER_WORD),
+# được đưa vào khóa cache cửa sổ và khóa cache token phía server
+PASSAGE_WINDOW_CONFIG = f"{PASSAGE_WINDOW_TOKENS}/{PASSAGE_WINDOW_OVERLAP}/{PASSAGE_TOKENS_PER_WORD}"
+# Cấu hình cửa sổ ảnh hưởng tới điểm rerank, được đưa vào khóa cache điểm
+PASSAGE_WINDOW_SIGNATURE = f"{PASSAGE_WINDOW_CONFIG}/{PASSAGE_TOP_WINDOWS}"
+
+WORD_PATTERN = re.compile(r"\S+")
+TERM_PATTERN = re.compile(r"\w+")
+
+passage_window_cache = TwoTierCache(
+    namespace="passage_windows",
+    maxsize=PASSAGE_WINDOW_CACHE_SIZE,
+    ttl=PASSAGE_WINDOW_CACHE_TTL,
+)
+
+
+def split_windows(text: str,
+                  window_tokens: int = None,
+                  overlap_tokens: int = None) -> List[str]:
+    """Chia văn bản thành các cửa sổ chồng lấn, giữ nguyên định dạng gốc bên trong mỗi cửa sổ"""
+    window_tokens = PASSAGE_WINDOW_TOKENS if window_tokens is None else window_tokens
+    overlap_tokens = PASSAGE_WINDOW_OVERLAP if overlap_tokens is None else overlap_tokens
+    if window_tokens <= 0:
+        return [text]
+    window_words = max(int(window_tokens / PASSAGE_TOKENS_PER_WORD), 1)
+    stride = max(window_words - int(overlap_tokens / PASSAGE_TOKENS_PER_WORD), 1)
+
+    spans = [match.span() for match in WORD_PATTERN.finditer(text)]
+    if len(spans) <= window_words:
+        return [text]
+    windows = []
+    for start in range(0, len(spans), stride):
+        end = min(start + window_words, len(spans))
+        windows.append(text[spans[start][0]:spans[end - 1][1]])
+        if end == len(spans):
+            break
+    return windows
+
+
+def chunk_windows(page_content: str, content_hash: str = None) -> List[str]:
+    """Các cửa sổ của một chunk, đọc từ cache theo content_hash nếu có"""
+    if not content_hash:
+        return split_windows(page_content)
+    cache_key = f"{content_hash}:{PASSAGE_WINDOW_CONFIG}"
+    windows, _ = passage_window_cache.lookup(cache_key)
+    if windows is None:
+        windows = split_windows(page_content)
+        passage_window_cache.set_many({cache_key: windows})
+    return windows
+
+
+def _terms(text: str) -> Tuple[set, set]:
+    words = TERM_PATTERN.findall(text.lower())
+    return set(words), set(zip(words, words[1:]))
+
+
+def select_windows(query: str, windows: List[str], top_n: int = None) -> List[int]:
+    """
+    Vị trí của top_n cửa sổ có điểm trùng từ với câu truy vấn cao nhất (từ đơn + cặp từ liền kề, vì từ
+    tiếng Việt thường gồm nhiều âm tiết). Cửa sổ bằng điểm ưu tiên cửa sổ đứng trước.
+    """
+    top_n = PASSAGE_TOP_WINDOWS if top_n is None else top_n
+    if len(windows) <= top_n:
+        return list(range(len(windows)))
+    query_words, query_bigrams = _terms(query)
+    scores = []
+    for position, window in enumerate(windows):
+        words, bigrams = _terms(window)
+        scores.append((len(query_words & words) + 2 * len(query_bigrams & bigrams), -position))
+    best = sorted(range(len(windows)), key=lambda idx: scores[idx], reverse=True)[:top_n]
+    return sorted(best)
+
+
+def window_key(content_hash: str, position: int) -> str:
+    """Khóa của cửa sổ cho cache token phía server reranker, None nếu chunk không có content_hash"""
+    if not content_hash:
+        return None
+    return f"{content_hash}:{PASSAGE_WINDOW_CONFIG}:{position}"
+
+
+def window_pairs(pairs: List[tuple]) -> Tuple[List[list], List[int], List[str]]:
+    """
+    Đổi các cặp (query, RelevantDocument) thành các cặp [query, cửa sổ] để gửi sang `/rerank`,
+    kèm vị trí cặp gốc và khóa (window_key) của từng cửa sổ.
+    """
+    sentence_pairs, owners, keys = [], [], []
+    for idx, (query, doc) in enumerate(pairs):
+        windows = chunk_windows(doc.page_content, doc.content_hash)
+        for position in select_windows(query, windows):
+            sentence_pairs.append([query, windows[position]])
+            owners.append(idx)
+            keys.append(window_key(doc.content_hash, position))
+    return sentence_pairs, owners, keys
+
+
+def aggregate_scores(scores: List[float], owners: List[int], size: int) -> List[float]:
+    """Điểm của mỗi cặp gốc là điểm lớn nhất trong các cửa sổ của nó"""
+    aggregated = [None] * size
+    for owner, score in zip(owners, scores):
+        if aggregated[owner] is None or score > aggregated[owner]:
+            aggregated[owner] = score
+    return aggregated
@@ -0,0 +1,393 @@
+"""
+Bản sao chỉ đọc của cột embedding trong tiến trình, dùng cho lượt semantic search mà không cần
+round trip tới Postgres.
+
+Mỗi thế hệ (generation) của bản sao là một thư mục gồm các file `.npy` được mở bằng mmap:
+ma trận vector float16, chunk_id, mã category, bình phương chuẩn của vector và index IVF
+(tâm cụm + danh sách dòng theo cụm). File `CURRENT` trỏ tới thế hệ đang dùng; các worker cùng
+mmap một bộ file nên dữ liệu chỉ nằm một lần trong page cache của hệ điều hành.
+
+Bản sao được tạo/cập nhật bởi `scripts/refresh_vector_replica.py`: lần đầu (hoặc --full) đọc toàn bộ
+bảng và huấn luyện IVF, các lần sau chỉ đọc các dòng có updated_at mới hơn hoặc chunk_id mới,
+bỏ các dòng đã bị xóa rồi ghi ra thế hệ mới. updated_at được trigger `embeddings_updated_at` cập nhật
+cho mọi lệnh ghi (kể cả SQL thô/COPY); nếu số dòng sau khi cập nhật không khớp với bảng thì dựng lại toàn bộ.
+`meta.json` lưu phiên bản corpus lúc đọc dữ liệu;
+DocumentRetriever chỉ dùng bản sao khi phiên bản này khớp với phiên bản hiện tại của database.
+"""
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+from typing import List, Optional, Tuple
+import numpy as np
+from sqlalchemy import text
+from models.database import read_corpus_version
+from utils.monitor_log import logger
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+VECTOR_REPLICA_ENABLED = os.getenv("VECTOR_REPLICA_ENABLED", "False").lower() in ("1", "true", "yes")
+VECTOR_REPLICA_DIR = os.getenv("VECTOR_REPLICA_DIR", os.path.join(PROJECT_ROOT, "data", "vector_replica"))
+# Số cụm IVF được quét cho mỗi truy vấn
+VECTOR_REPLICA_NPROBE = int(os.getenv("VECTOR_REPLICA_NPROBE", 8))
+# Dưới số dòng này không dựng IVF, mỗi truy vấn quét toàn bộ ma trận
+VECTOR_REPLICA_MIN_IVF_ROWS = int(os.getenv("VECTOR_REPLICA_MIN_IVF_ROWS", 20000))
+# Khi số dòng thay đổi vượt tỷ lệ này so với lần huấn luyện IVF gần nhất thì huấn luyện lại tâm cụm
+VECTOR_REPLICA_RETRAIN_RATIO = float(os.getenv("VECTOR_REPLICA_RETRAIN_RATIO", 0.2))
+# Các dòng có updated_at trong khoảng này (giây) trước mốc của lần cập nhật trước được đọc lại, để không bỏ sót
+# dòng do transaction bắt đầu trước nhưng commit sau lần đọc đó
+VECTOR_REPLICA_UPDATE_OVERLAP = float(os.getenv("VECTOR_REPLICA_UPDATE_OVERLAP", 300))
+# Khoảng thời gian (giây) giữa hai lần kiểm tra file CURRENT để nạp thế hệ mới
+VECTOR_REPLICA_CHECK_INTERVAL = float(os.getenv("VECTOR_REPLICA_CHECK_INTERVAL", 5))
+
+DIMENSION = 1024
+# Số dòng được đổi sang float32 mỗi lượt khi tính khoảng cách
+SCORE_BLOCK_ROWS = 16384
+# Số dòng đọc từ database mỗi lượt khi dựng bản sao
+FETCH_BATCH_ROWS = 5000
+KEEP_GENERATIONS = 2
+
+ARRAY_FILES = ("vectors", "chunk_ids", "category_codes", "norms", "ivf_centroids", "ivf_assign", "ivf_order", "ivf_offsets")
+
+
+class VectorReplica:
+    """Một thế hệ của bản sao, các mảng được mở bằng mmap ở chế độ chỉ đọc"""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in ARRAY_FILES
+            if os.path.exists(os.path.join(path, f"{name}.npy"))
+        }
+        self.vectors = arrays["vectors"]
+        self.chunk_ids = arrays["chunk_ids"]
+        self.category_codes = arrays["category_codes"]
+        self.norms = arrays["norms"]
+        self.ivf_centroids = arrays.get("ivf_centroids")
+        self.ivf_assign = arrays.get("ivf_assign")
+        self.ivf_order = arrays.get("ivf_order")
+        self.ivf_offsets = arrays.get("ivf_offsets")
+        self.category_index = {category: code for code, category in enumerate(self.meta["categories"])}
+
+    @property
+    def corpus_version(self) -> str:
+        return self.meta["corpus_version"]
+
+    @property
+    def has_ivf(self) -> bool:
+        return self.ivf_centroids is not None
+
+    def __len__(self) -> int:
+        return len(self.chunk_ids)
+
+    def _candidate_rows(self,
+                        query: np.ndarray,
+                        k: int,
+                        category: str = None,
+                        nprobe: int = None
+                        ) -> Optional[np.ndarray]:
+        """Các dòng cần chấm điểm; None nghĩa là toàn bộ ma trận"""
+        rows = None
+        if self.has_ivf:
+            nprobe = min(nprobe or VECTOR_REPLICA_NPROBE, len(self.ivf_centroids))
+            centroid_distances = ((self.ivf_centroids - query) ** 2).sum(axis=1)
+            probes = np.argpartition(centroid_distances, nprobe - 1)[:nprobe]
+            rows = np.concatenate([
+                self.ivf_order[self.ivf_offsets[probe]:self.ivf_offsets[probe + 1]] for probe in probes
+            ])
+        if category and category != "All":
+            code = self.category_index.get(category)
+            if code is None:
+                return np.empty(0, dtype=np.int64)
+            if rows is not None:
+                rows = rows[self.category_codes[rows] == code]
+            # Category nhỏ có thể không đủ k dòng trong các cụm được quét: chấm toàn bộ dòng của category
+            if rows is None or len(rows) < k:
+                rows = np.flatnonzero(self.category_codes == code)
+        return rows
+
+    def _squared_distances(self, query: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+        # ||v - q||^2 = ||v||^2 - 2 v.q + ||q||^2, đổi float16 sang float32 theo từng khối để giới hạn bộ nhớ tạm
+        total = len(self) if rows is None else len(rows)
+        distances = np.empty(total, dtype=np.float32)
+        for start in range(0, total, SCORE_BLOCK_ROWS):
+            end = min(start + SCORE_BLOCK_ROWS, total)
+            if rows is None:
+                block, norms = self.vectors[start:end], self.norms[start:end]
+            else:
+                block, norms = self.vectors[rows[start:end]], self.norms[rows[start:end]]
+            distances[start:end] = norms - 2.0 * (block.astype(np.float32) @ query)
+        return distances + float(query @ query)
+
+    def search(self,
+            query_embedding: List[float],
+            k: int,
+            category: str = None,
+            nprobe: int = None
+            ) -> Tuple[List[int], List[float]]:
+        """Trả về (chunk_ids, khoảng cách L2) của k vector gần nhất, sắp xếp tăng dần theo khoảng cách"""
+        query = np.asarray(query_embedding, dtype=np.float32)
+        rows = self._candidate_rows(query, k, category, nprobe)
+        distances = self._squared_distances(query, rows)
+        if len(distances) == 0:
+            return [], []
+        k = min(k, len(distances))
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top], kind="stable")]
+        top_rows = top if rows is None else rows[top]
+        return (
+            [int(chunk_id) for chunk_id in self.chunk_ids[top_rows]],
+            [float(np.sqrt(max(distance, 0.0))) for distance in distances[top]],
+        )
+
+
+_replica_lock = threading.Lock()
+_replica_state = {"replica": None, "generation": None, "checked_at": 0.0}
+
+
+def current_generation(directory: str = None) -> Optional[str]:
+    try:
+        with open(os.path.join(directory or VECTOR_REPLICA_DIR, "CURRENT"), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def load_replica(directory: str = None) -> Optional[VectorReplica]:
+    directory = directory or VECTOR_REPLICA_DIR
+    generation = current_generation(directory)
+    if generation is None:
+        return None
+    return VectorReplica(os.path.join(directory, generation))
+
+
+def get_vector_replica() -> Optional[VectorReplica]:
+    """
+    Bản sao dùng chung trong tiến trình (None nếu tắt hoặc chưa được dựng).
+    File CURRENT được kiểm tra lại sau mỗi VECTOR_REPLICA_CHECK_INTERVAL giây để nạp thế hệ mới.
+    """
+    if not VECTOR_REPLICA_ENABLED:
+        return None
+    now = time.monotonic()
+    with _replica_lock:
+        if now - _replica_state["checked_at"] < VECTOR_REPLICA_CHECK_INTERVAL:
+            return _replica_state["replica"]
+        _replica_state["checked_at"] = now
+        generation = current_generation()
+        if generation != _replica_state["generation"]:
+            try:
+                _replica_state["replica"] = (
+                    VectorReplica(os.path.join(VECTOR_REPLICA_DIR, generation)) if generation else None
+                )
+                _replica_state["generation"] = generation
+                if generation:
+                    logger.info(f"Đã nạp vector replica {generation} ({len(_replica_state['replica'])} dòng)")
+            except Exception as e:
+                logger.warning(f"Không nạp được vector replica {generation}: {str(e)}")
+                _replica_state["replica"] = None
+        return _replica_state["replica"]
+
+
+def _train_ivf(vectors: np.ndarray) -> Optional[np.ndarray]:
+    """Huấn luyện tâm cụm IVF bằng MiniBatchKMeans, nlist ~ 4 * sqrt(N)"""
+    if len(vectors) < VECTOR_REPLICA_MIN_IVF_ROWS:
+        return None
+    from sklearn.cluster import MiniBatchKMeans
+    nlist = int(4 * np.sqrt(len(vectors)))
+    sample_size = min(len(vectors), nlist * 256)
+    sample = vectors[np.random.default_rng(42).choice(len(vectors), sample_size, replace=False)]
+    kmeans = MiniBatchKMeans(n_clusters=nlist, batch_size=4096, n_init=1, random_state=42)
+    kmeans.fit(sample.astype(np.float32))
+    return kmeans.cluster_centers_.astype(np.float32)
+
+
+def _assign_ivf(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    assign = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), SCORE_BLOCK_ROWS):
+        block = vectors[start:start + SCORE_BLOCK_ROWS].astype(np.float32)
+        assign[start:start + len(block)] = np.argmin(centroid_norms - 2.0 * (block @ centroids.T), axis=1)
+    return assign
+
+
+def _write_generation(directory: str, arrays: dict, meta: dict) -> str:
+    """Ghi một thế hệ mới rồi đổi file CURRENT (os.replace là thao tác nguyên tử)"""
+    generation = f"gen-{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+    path = os.path.join(directory, generation)
+    os.makedirs(path)
+    for name, array in arrays.items():
+        if array is not None:
+            np.save(os.path.join(path, f"{name}.npy"), array)
+    with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    current_tmp = os.path.join(directory, "CURRENT.tmp")
+    with open(current_tmp, "w", encoding="utf-8") as f:
+        f.write(generation)
+    os.replace(current_tmp, os.path.join(directory, "CURRENT"))
+
+    # Các worker đang mmap thế hệ cũ vẫn đọc được file sau khi bị xóa, giữ lại thêm một thế hệ để an toàn
+    generations = sorted(name for name in os.listdir(directory) if name.startswith("gen-"))
+    for old in generations[:-KEEP_GENERATIONS]:
+        shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+    return generation
+
+
+def _fetch_rows(connection, where_sql: str = "TRUE", params: dict = None):
+    """Đọc (chunk_id, embedding, category, updated_at) theo từng lượt FETCH_BATCH_ROWS dòng"""
+    result = connection.execution_options(stream_results=True, yield_per=FETCH_BATCH_ROWS).execute(text(
+        f"SELECT chunk_id, embedding::text AS embedding, category, updated_at FROM embeddings WHERE {where_sql}"
+    ), params or {})
+    for rows in result.partitions():
+        yield rows
+
+
+def _collect(connection, where_sql: str = "TRUE", params: dict = None) -> dict:
+    chunk_ids, vectors, categories, max_updated_at = [], [], [], None
+    for rows in _fetch_rows(connection, where_sql, params):
+        for row in rows:
+            chunk_ids.append(row.chunk_id)
+            vectors.append(np.array(json.loads(row.embedding), dtype=np.float16))
+            categories.append(row.category)
+            if row.updated_at is not None and (max_updated_at is None or row.updated_at > max_updated_at):
+                max_updated_at = row.updated_at
+    return {
+        "chunk_ids": np.array(chunk_ids, dtype=np.int64),
+        "vectors": np.vstack(vectors) if vectors else np.empty((0, DIMENSION), dtype=np.float16),
+        "categories": categories,
+        "max_updated_at": max_updated_at,
+    }
+
+
+def _squared_norms(vectors: np.ndarray) -> np.ndarray:
+    # Tính trên giá trị float16 đã lưu để khớp với ma trận dùng khi chấm điểm
+    norms = np.empty(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), SCORE_BLOCK_ROWS):
+        block = vectors[start:start + SCORE_BLOCK_ROWS].astype(np.float32)
+        norms[start:start + len(block)] = (block ** 2).sum(axis=1)
+    return norms
+
+
+def _build_arrays(chunk_ids: np.ndarray,
+                vectors: np.ndarray,
+                categories: List[str],
+                centroids: Optional[np.ndarray]
+                ) -> Tuple[dict, List[str]]:
+    category_names = sorted({category for category in categories if category is not None})
+    category_index = {category: code for code, category in enumerate(category_names)}
+    arrays = {
+        "vectors": vectors,
+        "chunk_ids": chunk_ids,
+        "category_codes": np.array(
+            [category_index.get(category, -1) for category in categories], dtype=np.int16
+        ),
+        "norms": _squared_norms(vectors),
+    }
+    if centroids is not None:
+        assign = _assign_ivf(vectors, centroids)
+        order = np.argsort(assign, kind="stable").astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=len(centroids)))]).astype(np.int64)
+        arrays.update({
+            "ivf_centroids": centroids,
+            "ivf_assign": assign,
+            "ivf_order": order,
+            "ivf_offsets": offsets,
+        })
+    return arrays, category_names
+
+
+def refresh_replica(connection, directory: str = None, full: bool = False) -> dict:
+    """
+    Cập nhật bản sao từ bảng embeddings. Phiên bản corpus được đọc trước khi đọc dữ liệu nên nếu có ghi
+    xen giữa, bản sao sẽ bị coi là cũ và được cập nhật ở lần chạy sau.
+    """
+    directory = directory or VECTOR_REPLICA_DIR
+    os.makedirs(directory, exist_ok=True)
+    start = time.perf_counter()
+    corpus_version = read_corpus_version(connection)
+    current = None if full else load_replica(directory)
+
+    if current is not None and current.corpus_version == corpus_version:
+        return {"status": "fresh", "generation": current_generation(directory), "rows": len(current)}
+
+    if current is not None:
+        live_ids = np.array(
+            connection.execute(text("SELECT chunk_id FROM embeddings")).scalars().all(), dtype=np.int64
+        )
+        new_ids = np.setdiff1d(live_ids, current.chunk_ids)
+        since = current.meta.get("max_updated_at")
+        data = _collect(
+            connection,
+            "(CAST(:since AS timestamp) IS NOT NULL "
+            "AND updated_at > CAST(:since AS timestamp) - make_interval(secs => :overlap)) "
+            "OR chunk_id = ANY(:new_ids)",
+            {"since": since, "overlap": VECTOR_REPLICA_UPDATE_OVERLAP, "new_ids": new_ids.tolist()},
+        )
+        keep = np.isin(current.chunk_ids, live_ids) & ~np.isin(current.chunk_ids, data["chunk_ids"])
+        current_categories = [
+            current.meta["categories"][code] if code >= 0 else None
+            for code in current.category_codes[keep]
+        ]
+        chunk_ids = np.concatenate([current.chunk_ids[keep], data["chunk_ids"]])
+        vectors = np.vstack([current.vectors[keep], data["vectors"]])
+        categories = current_categories + data["categories"]
+        max_updated_at = max(
+            [value for value in (data["max_updated_at"], since and datetime.fromisoformat(since)) if value],
+            default=None
+        )
+        changed_rows = len(data["chunk_ids"])
+        removed_rows = int((~keep).sum()) - changed_rows + len(new_ids)
+        trained_rows = current.meta.get("trained_rows", 0)
+
+        if len(chunk_ids) != len(live_ids) or len(np.unique(chunk_ids)) != len(chunk_ids):
+            # Lượt đọc tăng dần không giải thích được trạng thái của bảng, không gắn phiên bản corpus
+            # hiện tại cho bản sao có thể đã cũ
+            logger.warning(
+                f"Vector replica lệch với bảng embeddings ({len(chunk_ids)} dòng, bảng có {len(live_ids)}), dựng lại toàn bộ"
+            )
+            current = None
+        else:
+            # Giữ tâm cụm cũ cho các thay đổi nhỏ, huấn luyện lại khi dữ liệu đã thay đổi nhiều
+            centroids = np.array(current.ivf_centroids) if current.has_ivf else None
+            drift = (changed_rows + removed_rows) / max(trained_rows, 1)
+            if (centroids is None and len(vectors) >= VECTOR_REPLICA_MIN_IVF_ROWS) or \
+                    (centroids is not None and drift > VECTOR_REPLICA_RETRAIN_RATIO):
+                centroids = _train_ivf(vectors)
+                trained_rows = len(vectors) if centroids is not None else 0
+
+    if current is None:
+        data = _collect(connection)
+        chunk_ids, vectors, categories = data["chunk_ids"], data["vectors"], data["categories"]
+        max_updated_at = data["max_updated_at"]
+        centroids = _train_ivf(vectors)
+        trained_rows = len(vectors) if centroids is not None else 0
+        changed_rows = len(vectors)
+        removed_rows = 0
+
+    arrays, category_names = _build_arrays(chunk_ids, vectors, categories, centroids)
+    meta = {
+        "corpus_version": corpus_version,
+        "max_updated_at": max_updated_at.isoformat() if max_updated_at else None,
+        "rows": int(len(chunk_ids)),
+        "dimension": DIMENSION,
+        "categories": category_names,
+        "nlist": int(len(centroids)) if centroids is not None else 0,
+        "trained_rows": int(trained_rows),
+        "built_at": datetime.now().isoformat(),
+    }
+    generation = _write_generation(directory, arrays, meta)
+    stats = {
+        "status": "full" if current is None else "incremental",
+        "generation": generation,
+        "rows": meta["rows"],
+        "changed_rows": int(changed_rows),
+        "removed_rows": int(max(removed_rows, 0)),
+        "nlist": meta["nlist"],
+        "seconds": round(time.perf_counter() - start, 2),
+    }
+    logger.info(f"Vector replica: {stats}")
+    return stats
@@ -1,12 +1,21 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Response
 from pydantic import BaseModel
-from FlagEmbedding import BGEM3FlagModel, FlagReranker
 from fastapi.middleware.cors import CORSMiddleware
+from prometheus_client import make_asgi_app
 from typing import List, Optional, Any
 import os
+import sys
 from collections import defaultdict
 import numpy as np
 import asyncio
+from micro_batcher import MicroBatcher, DeadlineExceeded, QueueFull, PRIORITIES, INTERACTIVE, BULK
+from inference_executor import run_inference
+from model_loader import load_models, resolve_use_gpu
+from memory_budget import plan_batches, token_budget, track_batch
+from rerank_inputs import PairTokenizer
+# Thư mục gốc của project, để dùng chung utils.wire_format với client
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from utils.wire_format import EMBEDDING_MEDIA_TYPE, encode_embeddings, requested_dtype
 
 
 app = FastAPI()
@@ -20,32 +29,140 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-USE_GPU = "True"
-DEFAULT_BATCH_SIZE = os.getenv("DEFAULT_BATCH_SIZE", 64)
-LIMIT_MAX_BATCH_SIZE = os.getenv("LIMIT_MAX_BATCH_SIZE", 64)#epends on server hardware
+app.mount("/metrics", make_asgi_app())
 
-DEFAULT_MAX_LENGTH = os.getenv("DEFAULT_MAX_LENGTH", 8192)
-LIMIT_MAX_LENGTH = os.getenv("LIMIT_MAX_LENGTH", 8192)
+DEFAULT_BATCH_SIZE = int(os.getenv("DEFAULT_BATCH_SIZE", 64))
+LIMIT_MAX_BATCH_SIZE = int(os.getenv("LIMIT_MAX_BATCH_SIZE", 64))#epends on server hardware
 
+DEFAULT_MAX_LENGTH = int(os.getenv("DEFAULT_MAX_LENGTH", 8192))
+LIMIT_MAX_LENGTH = int(os.getenv("LIMIT_MAX_LENGTH", 8192))
 
+# Micro-batching cho /embed: gom các request đồng thời trong EMBED_BATCH_WINDOW_MS, tới tối đa
+# EMBED_BATCH_MAX_TOKENS token hoặc EMBED_BATCH_MAX_SIZE câu, rồi chạy một lượt encode
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", 5))
+EMBED_BATCH_MAX_TOKENS = int(os.getenv("EMBED_BATCH_MAX_TOKENS", 16384))
+EMBED_BATCH_MAX_SIZE = int(os.getenv("EMBED_BATCH_MAX_SIZE", LIMIT_MAX_BATCH_SIZE))
+# Số câu tối đa được chờ trong hàng đợi /embed, vượt quá trả về 503 ngay (0: không giới hạn)
+EMBED_MAX_QUEUE_ITEMS = int(os.getenv("EMBED_MAX_QUEUE_ITEMS", 1024))
 
-if USE_GPU:
-    embedder = BGEM3FlagModel('BAAI/bge-m3', use_fp16=True)
-    hardware_lock = asyncio.Lock()
-else:
-    embedder = BGEM3FlagModel('BAAI/bge-m3', use_fp16=False, device="cpu")
-    hardware_lock = None
+# Micro-batching cho /rerank: các cặp của nhiều request được gom rồi chia theo độ dài (token) vào các bucket,
+# mỗi bucket chạy một lượt compute_score với max_length bằng cận trên của bucket để giảm padding
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", 512))
+RERANK_LENGTH_BUCKETS = [
+    int(bound) for bound in os.getenv("RERANK_LENGTH_BUCKETS", "64,128,256,512,1024,2048,4096,8192").split(",")
+    if int(bound) < RERANK_MAX_LENGTH
+] + [RERANK_MAX_LENGTH]
+RERANK_BATCH_WINDOW_MS = float(os.getenv("RERANK_BATCH_WINDOW_MS", 5))
+RERANK_BATCH_MAX_TOKENS = int(os.getenv("RERANK_BATCH_MAX_TOKENS", 65536))
+RERANK_BATCH_MAX_SIZE = int(os.getenv("RERANK_BATCH_MAX_SIZE", 256))
+# Deadline mặc định của một request rerank khi client không gửi deadline_ms (0: không giới hạn)
+RERANK_DEFAULT_DEADLINE_MS = float(os.getenv("RERANK_DEFAULT_DEADLINE_MS", 0))
+# Số cặp tối đa được chờ trong hàng đợi /rerank, vượt quá trả về 503 ngay (0: không giới hạn)
+RERANK_MAX_QUEUE_ITEMS = int(os.getenv("RERANK_MAX_QUEUE_ITEMS", 2048))
+# Số tài liệu tối đa trong cache token của reranker (khóa theo content_hash)
+RERANK_TOKEN_CACHE_SIZE = int(os.getenv("RERANK_TOKEN_CACHE_SIZE", 10000))
+# Giá trị header Retry-After (giây) của response 503
+QUEUE_FULL_RETRY_AFTER = os.getenv("QUEUE_FULL_RETRY_AFTER", "1")
+
+# Lớp ưu tiên của request (header X-Priority hoặc trường priority: interactive | bulk). Client trong repo luôn
+# ghi rõ lớp; request không ghi rõ được xếp interactive nếu tổng số token sau khi tokenize không vượt quá
+# INTERACTIVE_MAX_TOKENS, còn lại là bulk (ingest, re-index)
+INTERACTIVE_MAX_TOKENS = int(os.getenv("INTERACTIVE_MAX_TOKENS", 16384))
+# Request bulk được cắt thành các lát tối đa BULK_SLICE_TOKENS token, request interactive chỉ chờ một lát
+BULK_SLICE_TOKENS = int(os.getenv("BULK_SLICE_TOKENS", 4096))
+# Số request đang xử lý tối đa của mỗi lớp trên mỗi endpoint, request vượt quá chờ tới lượt (0: không giới hạn)
+INTERACTIVE_MAX_CONCURRENCY = int(os.getenv("INTERACTIVE_MAX_CONCURRENCY", 0))
+BULK_MAX_CONCURRENCY = int(os.getenv("BULK_MAX_CONCURRENCY", 2))
+CLASS_LIMITS = {INTERACTIVE: INTERACTIVE_MAX_CONCURRENCY, BULK: BULK_MAX_CONCURRENCY}
+
+
+
+# Backend (PyTorch hoặc ONNX Runtime int8) và thiết bị được chọn theo USE_GPU/INFERENCE_BACKEND, xem model_loader
+USE_GPU = resolve_use_gpu()
+embedder, reranker = load_models(use_gpu=USE_GPU)
+
+
+def requested_priority(header: Optional[str], field: Optional[str]) -> Optional[str]:
+    """Lớp ưu tiên client ghi rõ: header X-Priority, rồi trường priority, None nếu không có"""
+    priority = (header or field or "").strip().lower()
+    if not priority:
+        return None
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Invalid priority, must be one of {list(PRIORITIES)}.")
+    return priority
+
+
+def request_priority(priority: Optional[str], tokens: int) -> str:
+    """Lớp ưu tiên client ghi rõ, mặc định theo tổng số token của request"""
+    if priority is not None:
+        return priority
+    return INTERACTIVE if tokens <= INTERACTIVE_MAX_TOKENS else BULK
+
+
+def sentence_ids(sentences: List[str], max_length: int) -> List[List[int]]:
+    """
+    Token id (kèm token đặc biệt, cắt theo max_length) của từng câu. Chỉ tokenize một lần: độ dài dùng để chia
+    batch theo ngân sách token, token id được đưa thẳng vào lượt forward.
+    """
+    if not sentences:
+        return []
+    return embedder.tokenizer(sentences, truncation=True, max_length=max_length)["input_ids"]
+
+
+async def encode_batch(key: tuple, items: List[List[int]]) -> List[dict]:
+    """
+    Encode các câu đã tokenize (token id) đã gom: sắp theo độ dài rồi chia thành các lượt forward dưới ngân sách
+    token tính từ bộ nhớ còn trống, trả về kết quả theo từng câu.
+    """
+    _max_length, return_dense_vecs, return_sparse_vecs, return_colbert_vecs = key
+
+    def encode():
+        results = [None] * len(items)
+        budget = token_budget(USE_GPU)
+        for indices in plan_batches([len(input_ids) for input_ids in items], budget):
+            with track_batch("embed", [len(items[idx]) for idx in indices], budget, USE_GPU):
+                total_embeddings = embedder.encode_ids([items[idx] for idx in indices],
+                                                       return_dense=return_dense_vecs,
+                                                       return_sparse=return_sparse_vecs,
+                                                       return_colbert_vecs=return_colbert_vecs)
+            for row, idx in enumerate(indices):
+                results[idx] = {
+                    "dense_vecs": total_embeddings["dense_vecs"][row] if return_dense_vecs else None,
+                    "lexical_weights": total_embeddings["lexical_weights"][row] if return_sparse_vecs else None,
+                    "colbert_vecs": total_embeddings["colbert_vecs"][row] if return_colbert_vecs else None,
+                }
+        return results
+
+    return await run_inference(encode)
+
+
+embed_batcher = MicroBatcher(
+    name="embed",
+    run_batch=encode_batch,
+    window=EMBED_BATCH_WINDOW_MS / 1000,
+    max_tokens=EMBED_BATCH_MAX_TOKENS,
+    max_items=EMBED_BATCH_MAX_SIZE,
+    max_queue_items=EMBED_MAX_QUEUE_ITEMS,
+    bulk_slice_tokens=BULK_SLICE_TOKENS,
+    class_limits=CLASS_LIMITS,
+)
 
 
 class EmbeddingRequest(BaseModel):
     sentences: List[str]
     params: Optional[dict] = None
     embedding_types: Optional[dict] = None
+    priority: Optional[str] = None
 
 class EmbeddingResponse(BaseModel):
     embeddings: dict
 
-async def process_embeddings(sentences: List[str], params: Optional[dict], embedding_types: Optional[dict]):
+async def process_embeddings(sentences: List[str],
+                             params: Optional[dict],
+                             embedding_types: Optional[dict],
+                             dtype: Optional[str] = None,
+                             priority: Optional[str] = None):
+    """Kết quả encode dạng dict JSON, hoặc bytes theo wire_format khi client yêu cầu định dạng nhị phân (dtype)"""
     if params is None:
         params = {
             "batch_size": DEFAULT_BATCH_SIZE,
@@ -80,27 +197,26 @@ async def process_embeddings(sentences: List[str], params: Optional[dict], embed
     if not (return_dense_vecs or return_sparse_vecs or return_colbert_vecs):
         return []
 
-    if USE_GPU:
-        async with hardware_lock:
-            total_embeddings = embedder.encode(sentences,
-                                            batch_size=batch_size,
-                                            max_length=max_length,
-                                            return_dense=return_dense_vecs,
-                                            return_sparse=return_sparse_vecs,
-                                            return_colbert_vecs=return_colbert_vecs)
+    # Các request đồng thời cùng tham số được gom thành một lượt encode, batch_size chỉ còn dùng để kiểm tra đầu vào
+    key = (max_length, return_dense_vecs, return_sparse_vecs, return_colbert_vecs)
+    if not sentences:
+        results = []
     else:
-        total_embeddings = embedder.encode(sentences,
-                                        batch_size=batch_size,
-                                        max_length=max_length,
-                                        return_dense=return_dense_vecs,
-                                        return_sparse=return_sparse_vecs,
-                                        return_colbert_vecs=return_colbert_vecs)
+        input_ids = await asyncio.to_thread(sentence_ids, sentences, max_length)
+        lengths = [len(ids) for ids in input_ids]
+        tokens = sum(lengths)
+        results = await embed_batcher.submit(key, input_ids, tokens, priority=request_priority(priority, tokens),
+                                             item_tokens=lengths)
 
     embeddings: dict = {}
-    dense_vecs: List[List[float]] = total_embeddings["dense_vecs"] if return_dense_vecs else None
-    lexical_weights: List[defaultdict[int, Any]] = total_embeddings["lexical_weights"] if return_sparse_vecs else None
-    colbert_vecs: List[np.ndarray] = total_embeddings["colbert_vecs"] if return_colbert_vecs else None
-    
+    dense_vecs: List[List[float]] = [result["dense_vecs"] for result in results] if return_dense_vecs else None
+    lexical_weights: List[defaultdict[int, Any]] = [result["lexical_weights"] for result in results] if return_sparse_vecs else None
+    colbert_vecs: List[np.ndarray] = [result["colbert_vecs"] for result in results] if return_colbert_vecs else None
+
+    if dtype is not None:
+        # Ghi thẳng buffer numpy, không đổi sang list float của Python
+        return encode_embeddings(len(sentences), dense_vecs, lexical_weights, colbert_vecs, dtype=dtype)
+
     if return_dense_vecs:
         embeddings["dense_vecs"] = np.array(dense_vecs, dtype=np.float32).tolist()
     if return_sparse_vecs:
@@ -111,42 +227,192 @@ async def process_embeddings(sentences: List[str], params: Optional[dict], embed
     return embeddings
 
 @app.post("/embed", response_model=EmbeddingResponse)
-async def embed_sentences(request: EmbeddingRequest):
+async def embed_sentences(request: EmbeddingRequest,
+                          accept: Optional[str] = Header(None),
+                          x_priority: Optional[str] = Header(None)):
     try:
         sentences = request.sentences
         params = request.params
         embedding_types = request.embedding_types
-        
-        embeddings = await process_embeddings(sentences, params, embedding_types)
-        
+        # JSON là mặc định, định dạng nhị phân chỉ dùng khi client gửi Accept: application/x-embeddings
+        dtype = requested_dtype(accept)
+        priority = requested_priority(x_priority, request.priority)
+
+        embeddings = await process_embeddings(sentences, params, embedding_types, dtype, priority)
+        if isinstance(embeddings, bytes):
+            return Response(content=embeddings, media_type=EMBEDDING_MEDIA_TYPE)
+
         return EmbeddingResponse(embeddings=embeddings)
+    except HTTPException:
+        raise
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": QUEUE_FULL_RETRY_AFTER})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 
 
-# Khởi tạo model cho reranker
-reranker = FlagReranker('BAAI/bge-reranker-v2-m3', use_fp16=True)
+pair_tokenizer = PairTokenizer(reranker.tokenizer, RERANK_MAX_LENGTH, RERANK_TOKEN_CACHE_SIZE)
+
+
+def sentence_pair_ids(sentence_pairs: list) -> List[List[int]]:
+    """Token id của các cặp [query, passage], mỗi câu truy vấn khác nhau chỉ tokenize một lần"""
+    queries = list(dict.fromkeys(pair[0] for pair in sentence_pairs))
+    query_ids = dict(zip(queries, pair_tokenizer.text_ids(queries)))
+    passage_ids = pair_tokenizer.text_ids([pair[1] for pair in sentence_pairs])
+    return [pair_tokenizer.pair_ids(query_ids[pair[0]], ids) for pair, ids in zip(sentence_pairs, passage_ids)]
+
+
+def query_pair_ids(query: str, texts: List[Optional[str]], content_hashes: List[Optional[str]]) -> tuple:
+    """Token id của các cặp (query, tài liệu) cùng vị trí các tài liệu thiếu text và chưa có trong cache"""
+    (query_ids,) = pair_tokenizer.text_ids([query])
+    document_ids = pair_tokenizer.document_ids(texts, content_hashes)
+    missing = [idx for idx, ids in enumerate(document_ids) if ids is None]
+    if missing:
+        return None, missing
+    return [pair_tokenizer.pair_ids(query_ids, ids) for ids in document_ids], []
+
+
+def length_bucket(length: int) -> int:
+    return next(bound for bound in RERANK_LENGTH_BUCKETS if length <= bound)
+
+
+async def score_batch(_key, items: List[List[int]]) -> List[float]:
+    """
+    Chấm các cặp đã tokenize (token id) gom từ nhiều request: chia theo bucket độ dài, mỗi bucket một lượt
+    forward (chỉ pad tới cặp dài nhất trong bucket), trả về điểm thô (chưa sigmoid) theo đúng thứ tự items.
+    """
+    buckets = defaultdict(list)
+    for idx, input_ids in enumerate(items):
+        buckets[length_bucket(len(input_ids))].append(idx)
+
+    def compute():
+        scores = [None] * len(items)
+        budget = token_budget(USE_GPU)
+        for _, bucket in sorted(buckets.items()):
+            # Bucket lớn được chia tiếp theo ngân sách token để không tràn bộ nhớ
+            for batch in plan_batches([len(items[idx]) for idx in bucket], budget):
+                indices = [bucket[position] for position in batch]
+                with track_batch("rerank", [len(items[idx]) for idx in indices], budget, USE_GPU):
+                    batch_scores = reranker.compute_score_ids([items[idx] for idx in indices], batch_size=len(indices))
+                for idx, score in zip(indices, batch_scores):
+                    scores[idx] = float(score)
+        return scores
+
+    return await run_inference(compute)
+
+
+rerank_batcher = MicroBatcher(
+    name="rerank",
+    run_batch=score_batch,
+    window=RERANK_BATCH_WINDOW_MS / 1000,
+    max_tokens=RERANK_BATCH_MAX_TOKENS,
+    max_items=RERANK_BATCH_MAX_SIZE,
+    max_queue_items=RERANK_MAX_QUEUE_ITEMS,
+    bulk_slice_tokens=BULK_SLICE_TOKENS,
+    class_limits=CLASS_LIMITS,
+)
+
+
+def sigmoid(scores: List[float]) -> List[float]:
+    return [float(1 / (1 + np.exp(-score))) for score in scores]
+
+
+async def score_pairs(items: List[List[int]], deadline_ms: Optional[float], priority: Optional[str] = None) -> List[float]:
+    deadline_ms = deadline_ms if deadline_ms is not None else RERANK_DEFAULT_DEADLINE_MS
+    lengths = [len(input_ids) for input_ids in items]
+    tokens = sum(lengths)
+    return await rerank_batcher.submit(None, items, tokens, timeout=deadline_ms / 1000,
+                                       priority=request_priority(priority, tokens), item_tokens=lengths)
+
 
 # Định nghĩa mô hình dữ liệu cho yêu cầu rerank
 class RerankRequest(BaseModel):
     sentence_pairs: list
     normalize: bool = False
+    # Thời gian tối đa (ms) request được chờ trong hàng đợi, quá hạn trả về 504
+    deadline_ms: Optional[float] = None
+    priority: Optional[str] = None
 @app.post("/rerank")
-async def rerank(request: RerankRequest):
+async def rerank(request: RerankRequest, x_priority: Optional[str] = Header(None)):
     try:
         sentence_pairs = request.sentence_pairs
         normalize = request.normalize
+        if not sentence_pairs:
+            return {"scores": []}
+        priority = requested_priority(x_priority, request.priority)
 
-        # Tính toán điểm số cho các cặp câu
-        scores = reranker.compute_score(sentence_pairs, normalize=normalize)
-        # Chuyển đổi mảng NumPy thành list Python
+        # Tokenize trên thread pool mặc định để không chặn event loop và không chiếm executor inference
+        items = await asyncio.to_thread(sentence_pair_ids, sentence_pairs)
+        # Các cặp của request được gom với các request đồng thời khác, điểm trả về theo thứ tự sentence_pairs
+        scores = await score_pairs(items, request.deadline_ms, priority)
+        if normalize:
+            scores = sigmoid(scores)
         return {"scores": scores}
+    except HTTPException:
+        raise
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": QUEUE_FULL_RETRY_AFTER})
     except Exception as e:
         print(f"Error in rerank: {str(e)}")
         return {"error": str(e)}
 
+class RerankDocument(BaseModel):
+    # Có thể bỏ text nếu server đã cache token của content_hash; chưa có thì server trả 409 kèm vị trí thiếu
+    text: Optional[str] = None
+    content_hash: Optional[str] = None
+
+
+class RerankQueryRequest(BaseModel):
+    query: str
+    documents: List[RerankDocument]
+    # Chỉ trả về top_k tài liệu điểm cao nhất (None: trả về tất cả, sắp theo điểm giảm dần)
+    top_k: Optional[int] = None
+    normalize: bool = False
+    deadline_ms: Optional[float] = None
+    priority: Optional[str] = None
+
+
+@app.post("/rerank/query")
+async def rerank_query(request: RerankQueryRequest, x_priority: Optional[str] = Header(None)):
+    """
+    Rerank một câu truy vấn với danh sách tài liệu: câu truy vấn chỉ tokenize một lần, token của tài liệu
+    được cache theo content_hash. Trả về {"results": [{"index", "score"}]} theo điểm giảm dần.
+    """
+    try:
+        if not request.documents:
+            return {"results": []}
+        priority = requested_priority(x_priority, request.priority)
+        items, missing = await asyncio.to_thread(
+            query_pair_ids,
+            request.query,
+            [document.text for document in request.documents],
+            [document.content_hash for document in request.documents],
+        )
+        if missing:
+            raise HTTPException(status_code=409, detail={"missing": missing})
+
+        scores = await score_pairs(items, request.deadline_ms, priority)
+        if request.normalize:
+            scores = sigmoid(scores)
+        ranked = sorted(range(len(scores)), key=lambda idx: scores[idx], reverse=True)
+        if request.top_k is not None:
+            ranked = ranked[:request.top_k]
+        return {"results": [{"index": idx, "score": scores[idx]} for idx in ranked]}
+    except HTTPException:
+        raise
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": QUEUE_FULL_RETRY_AFTER})
+    except Exception as e:
+        print(f"Error in rerank_query: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.get("/benchmark")
 async def benchmark_rerank():
     import time
@@ -156,7 +422,7 @@ async def benchmark_rerank():
     dummy_pairs = [["what is AI?", long_doc]] * 64
 
     start = time.time()
-    scores = reranker.compute_score(dummy_pairs, normalize=False)
+    scores = await run_inference(reranker.compute_score, dummy_pairs, normalize=False)
     end = time.time()
     return {
         "time_taken": round(end - start, 4),
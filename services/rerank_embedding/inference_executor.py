@@ -0,0 +1,35 @@
+"""
+Executor riêng cho các lượt forward của model: các lời gọi đồng bộ (encode, compute_score) chạy trên
+INFERENCE_WORKERS thread, event loop chỉ còn lo I/O, hàng đợi micro-batch và /health.
+"""
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Số lượt forward chạy đồng thời; mặc định 1 vì embedder và reranker dùng chung một GPU
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 1))
+# Số thread tính toán của mỗi lượt forward trên CPU (0: tự tính theo số CPU được cấp cho tiến trình)
+INFERENCE_THREADS = int(os.getenv("INFERENCE_THREADS", 0))
+
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+
+
+def available_cpus() -> int:
+    """Số CPU tiến trình được phép chạy (tôn trọng CPU affinity/cpuset của container)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def inference_threads() -> int:
+    if INFERENCE_THREADS > 0:
+        return INFERENCE_THREADS
+    return max(available_cpus() // INFERENCE_WORKERS, 1)
+
+
+async def run_inference(fn, *args, **kwargs):
+    """Chạy fn(*args, **kwargs) trên executor inference và chờ kết quả mà không chặn event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(inference_executor, functools.partial(fn, *args, **kwargs))
@@ -0,0 +1,79 @@
+"""
+Chia các câu/cặp câu đã gom thành các lượt forward theo ngân sách token (số phần tử x độ dài sau padding)
+thay vì số phần tử cố định. Ngân sách được tính lại trước mỗi batch từ bộ nhớ còn trống (GPU: cuda.mem_get_info,
+CPU: psutil), để một request lớn gồm nhiều chunk dài không làm tràn bộ nhớ và câu ngắn không phải pad theo câu dài.
+
+Mỗi lượt forward được ghi lại bộ nhớ (GPU: bộ nhớ đỉnh, CPU: mức tăng RSS đỉnh) và tỷ lệ padding (xem serving_metrics).
+"""
+import os
+import resource
+from contextlib import contextmanager
+from typing import List
+import psutil
+from serving_metrics import BATCH_PADDING_RATIO, BATCH_PEAK_MEMORY_BYTES, BATCH_PEAK_RSS_GROWTH_BYTES, BATCH_TOKEN_BUDGET
+
+# Tỷ lệ bộ nhớ còn trống được dùng cho activation của một lượt forward
+INFERENCE_MEMORY_FRACTION = float(os.getenv("INFERENCE_MEMORY_FRACTION", 0.5))
+# Ước lượng bộ nhớ activation cho mỗi token sau padding (byte), chỉnh theo inference_batch_peak_memory_bytes (GPU)
+# hoặc inference_batch_peak_rss_growth_bytes (CPU)
+INFERENCE_BYTES_PER_TOKEN = int(os.getenv("INFERENCE_BYTES_PER_TOKEN", 131072))
+# Trần số token sau padding của một lượt forward, kể cả khi còn nhiều bộ nhớ
+INFERENCE_MAX_BATCH_TOKENS = int(os.getenv("INFERENCE_MAX_BATCH_TOKENS", 65536))
+
+
+def peak_rss() -> int:
+    # ru_maxrss tính bằng KB trên Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def available_memory(use_gpu: bool) -> int:
+    if use_gpu:
+        import torch
+        free, _ = torch.cuda.mem_get_info()
+        return free
+    return psutil.virtual_memory().available
+
+
+def token_budget(use_gpu: bool) -> int:
+    budget = int(available_memory(use_gpu) * INFERENCE_MEMORY_FRACTION / INFERENCE_BYTES_PER_TOKEN)
+    return max(min(budget, INFERENCE_MAX_BATCH_TOKENS), 1)
+
+
+def plan_batches(lengths: List[int], budget: int) -> List[List[int]]:
+    """
+    Sắp các phần tử theo độ dài giảm dần rồi gom liên tiếp sao cho số phần tử x độ dài lớn nhất không vượt
+    budget. Phần tử dài hơn budget vẫn được chạy một mình.
+    """
+    order = sorted(range(len(lengths)), key=lambda idx: lengths[idx], reverse=True)
+    batches, batch = [], []
+    for idx in order:
+        # Phần tử đầu của batch dài nhất nên quyết định độ dài sau padding
+        if batch and (len(batch) + 1) * lengths[batch[0]] > budget:
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+@contextmanager
+def track_batch(endpoint: str, lengths: List[int], budget: int, use_gpu: bool):
+    """
+    Ghi bộ nhớ và tỷ lệ padding của một lượt forward. GPU: bộ nhớ đỉnh (max_memory_allocated) trong lượt.
+    CPU: mức tăng RSS đỉnh của tiến trình (ru_maxrss) trong lượt, bằng 0 khi lượt không vượt đỉnh đã có,
+    nên INFERENCE_BYTES_PER_TOKEN được chỉnh theo các lượt có mức tăng lớn nhất.
+    """
+    if use_gpu:
+        import torch
+        torch.cuda.reset_peak_memory_stats()
+    else:
+        rss_before = peak_rss()
+    yield
+    if use_gpu:
+        BATCH_PEAK_MEMORY_BYTES.labels(endpoint).observe(torch.cuda.max_memory_allocated())
+    else:
+        BATCH_PEAK_RSS_GROWTH_BYTES.labels(endpoint).observe(peak_rss() - rss_before)
+    padded = len(lengths) * max(lengths)
+    BATCH_PADDING_RATIO.labels(endpoint).observe(1 - sum(lengths) / padded if padded else 0.0)
+    BATCH_TOKEN_BUDGET.labels(endpoint).set(budget)
@@ -0,0 +1,290 @@
+"""
+Micro-batching cho server embed/rerank: các request đồng thời có cùng khóa (cùng tham số forward) được gom
+trong một cửa sổ thời gian ngắn, tới giới hạn token/số phần tử, rồi chạy chung một lượt forward; kết quả được
+chia lại cho từng request theo đúng thứ tự.
+
+Một worker duy nhất cho mỗi batcher nên các lượt forward của cùng một model không chạy chồng lên nhau;
+trong lúc một batch đang chạy, các request mới dồn vào hàng đợi và được gom ở lượt sau. Request có deadline
+đã quá hạn lúc batch bắt đầu bị bỏ khỏi batch và nhận DeadlineExceeded; khi hàng đợi đã có quá max_queue_items
+phần tử, request mới bị từ chối ngay bằng QueueFull.
+
+Mỗi request thuộc một lớp ưu tiên (PRIORITIES, đứng trước được phục vụ trước): batch chỉ gồm job cùng lớp
+và worker luôn lấy lớp cao nhất còn job đang chờ. Request lớp bulk được cắt thành các lát tối đa
+bulk_slice_tokens token, nên request interactive đến sau chỉ phải chờ lát bulk đang chạy. Số request đang xử
+lý của mỗi lớp được giới hạn bởi class_limits, request vượt giới hạn chờ (tính cả vào deadline) tới lượt.
+"""
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional
+from serving_metrics import (
+    BATCH_QUEUE_WAIT_SECONDS,
+    BATCH_SIZE,
+    BATCH_REQUESTS,
+    BATCH_TOKENS,
+    BATCH_RUN_SECONDS,
+    BATCH_EXPIRED,
+    BATCH_REJECTED,
+    BATCH_QUEUE_ITEMS,
+    BATCH_INFLIGHT_REQUESTS,
+)
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+# Thứ tự ưu tiên giảm dần
+PRIORITIES = (INTERACTIVE, BULK)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+@dataclass
+class BatchJob:
+    key: Hashable
+    items: list
+    tokens: int
+    future: asyncio.Future
+    priority: str = INTERACTIVE
+    enqueued_at: float = field(default_factory=time.perf_counter)
+    # Thời điểm (theo time.perf_counter) sau đó kết quả không còn được dùng, None: không giới hạn
+    deadline: Optional[float] = None
+
+    def expired(self, now: float) -> bool:
+        return self.deadline is not None and now > self.deadline
+
+
+class MicroBatcher:
+    def __init__(self,
+                 name: str,
+                 run_batch: Callable[[Hashable, list], Awaitable[list]],
+                 window: float,
+                 max_tokens: int,
+                 max_items: int,
+                 max_queue_items: int = 0,
+                 bulk_slice_tokens: int = 0,
+                 class_limits: Optional[Dict[str, int]] = None) -> None:
+        """
+        run_batch(key, items) chạy một lượt forward cho các phần tử có cùng khóa và trả về list kết quả
+        cùng độ dài với items. window tính bằng giây, kể từ lúc request đầu tiên của batch vào hàng đợi.
+        max_queue_items giới hạn số phần tử đang chờ (0: không giới hạn). bulk_slice_tokens là số token tối
+        đa của một lát request bulk (0: không cắt), class_limits là số request tối đa đang xử lý của từng lớp
+        ưu tiên (lớp không có trong dict hoặc 0: không giới hạn).
+        """
+        self.name = name
+        self.run_batch = run_batch
+        self.window = window
+        self.max_tokens = max_tokens
+        self.max_items = max_items
+        self.max_queue_items = max_queue_items
+        self.bulk_slice_tokens = bulk_slice_tokens
+        self.class_limits = class_limits or {}
+        # Số phần tử đã nhận nhưng chưa được đưa vào batch nào, tổng và theo lớp ưu tiên
+        self.queued_items = 0
+        self.queued_by_priority = {priority: 0 for priority in PRIORITIES}
+        self.inflight = {priority: 0 for priority in PRIORITIES}
+        self.queue = None
+        self.worker = None
+        self.slots = None
+        # Các job đã lấy khỏi hàng đợi nhưng chưa vào batch nào (khác khóa, khác lớp hoặc vượt giới hạn của
+        # batch đang gom), theo lớp ưu tiên, được xử lý trước hàng đợi ở lượt sau
+        self.deferred = {priority: deque() for priority in PRIORITIES}
+
+    def _ensure_worker(self) -> None:
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+            self.slots = {
+                priority: asyncio.Semaphore(limit) for priority, limit in self.class_limits.items() if limit
+            }
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self._run())
+
+    def _slices(self, items: list, tokens: int, item_tokens: Optional[List[int]]) -> List[tuple]:
+        """Cắt request bulk thành các lát (items, tokens) liên tiếp, mỗi lát tối đa bulk_slice_tokens token"""
+        if not self.bulk_slice_tokens or tokens <= self.bulk_slice_tokens or len(items) < 2:
+            return [(items, tokens)]
+        if item_tokens is None:
+            item_tokens = [tokens / len(items)] * len(items)
+        slices, start, slice_tokens = [], 0, 0
+        for idx, count in enumerate(item_tokens):
+            if idx > start and slice_tokens + count > self.bulk_slice_tokens:
+                slices.append((items[start:idx], int(slice_tokens)))
+                start, slice_tokens = idx, 0
+            slice_tokens += count
+        slices.append((items[start:], int(slice_tokens)))
+        return slices
+
+    async def submit(self,
+                     key: Hashable,
+                     items: list,
+                     tokens: int,
+                     timeout: float = None,
+                     priority: str = INTERACTIVE,
+                     item_tokens: Optional[List[int]] = None) -> list:
+        """
+        Đưa các phần tử của một request vào hàng đợi, chờ tới khi batch chứa chúng chạy xong. Với timeout
+        (giây), request chưa được đưa vào batch nào sau thời gian này bị bỏ và nhận DeadlineExceeded.
+        item_tokens (số token của từng phần tử) dùng để cắt request bulk, không có thì chia đều tokens.
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"priority không hợp lệ: {priority}, chọn một trong {PRIORITIES}")
+        # Hàng đợi rỗng thì luôn nhận, để request lớn hơn giới hạn vẫn được chạy một mình
+        if self.max_queue_items and self.queued_items and self.queued_items + len(items) > self.max_queue_items:
+            BATCH_REJECTED.labels(self.name, priority).inc()
+            raise QueueFull(f"{self.name}: hàng đợi đã có {self.queued_items} phần tử")
+        self._ensure_worker()
+        enqueued_at = time.perf_counter()
+        deadline = enqueued_at + timeout if timeout else None
+
+        # Phần tử được tính vào hàng đợi ngay khi nhận, kể cả lúc còn chờ lượt của lớp, để max_queue_items
+        # giới hạn cả các request đang chờ class_limits
+        self._track_queued(priority, len(items))
+        slot = self.slots.get(priority)
+        if slot is not None:
+            try:
+                await asyncio.wait_for(slot.acquire(), deadline - time.perf_counter() if deadline else None)
+            except asyncio.TimeoutError:
+                self._track_queued(priority, -len(items))
+                BATCH_EXPIRED.labels(self.name, priority).inc()
+                raise DeadlineExceeded(f"{self.name}: request quá hạn sau {timeout:.3f}s khi chờ lượt của lớp {priority}")
+            except BaseException:
+                self._track_queued(priority, -len(items))
+                raise
+        self._track_inflight(priority, 1)
+        try:
+            slices = self._slices(items, tokens, item_tokens) if priority == BULK else [(items, tokens)]
+            loop = asyncio.get_running_loop()
+            jobs = [
+                BatchJob(key=key, items=slice_items, tokens=slice_tokens, future=loop.create_future(),
+                         priority=priority, enqueued_at=enqueued_at, deadline=deadline)
+                for slice_items, slice_tokens in slices
+            ]
+            for job in jobs:
+                self.queue.put_nowait(job)
+            try:
+                results = await asyncio.gather(*(job.future for job in jobs))
+            except BaseException:
+                # Lát còn chờ của request đã lỗi/bị hủy không cần chạy nữa, worker bỏ qua future đã hủy
+                for job in jobs:
+                    job.future.cancel()
+                raise
+            return [result for slice_results in results for result in slice_results]
+        finally:
+            self._track_inflight(priority, -1)
+            if slot is not None:
+                slot.release()
+
+    async def _next_job(self, timeout: float):
+        try:
+            return self.queue.get_nowait()
+        except asyncio.QueueEmpty:
+            if timeout <= 0:
+                return None
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def _track_queued(self, priority: str, delta: int) -> None:
+        self.queued_items += delta
+        self.queued_by_priority[priority] += delta
+        BATCH_QUEUE_ITEMS.labels(self.name, priority).set(self.queued_by_priority[priority])
+
+    def _track_inflight(self, priority: str, delta: int) -> None:
+        self.inflight[priority] += delta
+        BATCH_INFLIGHT_REQUESTS.labels(self.name, priority).set(self.inflight[priority])
+
+    def _outranks(self, job: BatchJob, other: BatchJob) -> bool:
+        return PRIORITIES.index(job.priority) < PRIORITIES.index(other.priority)
+
+    def _drain(self) -> None:
+        while not self.queue.empty():
+            job = self.queue.get_nowait()
+            self.deferred[job.priority].append(job)
+
+    async def _first_job(self) -> BatchJob:
+        """Job đầu tiên của batch tiếp theo: job chờ lâu nhất của lớp ưu tiên cao nhất"""
+        self._drain()
+        for priority in PRIORITIES:
+            if self.deferred[priority]:
+                return self.deferred[priority].popleft()
+        return await self.queue.get()
+
+    def _max_tokens(self, batch: List[BatchJob]) -> int:
+        # Batch bulk cũng chỉ lớn bằng một lát để request interactive không phải chờ lâu hơn
+        if batch[0].priority == BULK and self.bulk_slice_tokens:
+            return min(self.max_tokens, self.bulk_slice_tokens)
+        return self.max_tokens
+
+    def _fits(self, batch: List[BatchJob], job: BatchJob) -> bool:
+        return (sum(item.tokens for item in batch) + job.tokens <= self._max_tokens(batch)
+                and sum(len(item.items) for item in batch) + len(job.items) <= self.max_items)
+
+    def _has_room(self, batch: List[BatchJob]) -> bool:
+        return (sum(job.tokens for job in batch) < self._max_tokens(batch)
+                and sum(len(job.items) for job in batch) < self.max_items)
+
+    async def _collect(self) -> List[BatchJob]:
+        first = await self._first_job()
+        deferred = self.deferred[first.priority]
+        batch = [first]
+        for job in list(deferred):
+            if job.key == first.key and self._fits(batch, job):
+                deferred.remove(job)
+                batch.append(job)
+
+        deadline = first.enqueued_at + self.window
+        while self._has_room(batch):
+            job = await self._next_job(deadline - time.perf_counter())
+            if job is None:
+                break
+            if job.priority == first.priority and job.key == first.key and self._fits(batch, job):
+                batch.append(job)
+            else:
+                self.deferred[job.priority].append(job)
+                # Request ưu tiên cao hơn vừa tới thì chạy batch hiện tại ngay để nó được lấy ở lượt sau
+                if self._outranks(job, first) or (job.priority == first.priority and job.key == first.key):
+                    break
+        self._track_queued(first.priority, -sum(len(job.items) for job in batch))
+        now = time.perf_counter()
+        for job in batch:
+            if job.expired(now) and not job.future.done():
+                BATCH_EXPIRED.labels(self.name, job.priority).inc()
+                job.future.set_exception(DeadlineExceeded(f"{self.name}: request quá hạn sau {now - job.enqueued_at:.3f}s trong hàng đợi"))
+        return [job for job in batch if not job.future.done()]
+
+    async def _execute(self, batch: List[BatchJob]) -> None:
+        started = time.perf_counter()
+        items = [item for job in batch for item in job.items]
+        for job in batch:
+            BATCH_QUEUE_WAIT_SECONDS.labels(self.name, job.priority).observe(started - job.enqueued_at)
+        BATCH_SIZE.labels(self.name).observe(len(items))
+        BATCH_REQUESTS.labels(self.name).observe(len(batch))
+        BATCH_TOKENS.labels(self.name).observe(sum(job.tokens for job in batch))
+
+        try:
+            results = await self.run_batch(batch[0].key, items)
+        except Exception as e:
+            for job in batch:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            return
+        finally:
+            BATCH_RUN_SECONDS.labels(self.name).observe(time.perf_counter() - started)
+
+        offset = 0
+        for job in batch:
+            if not job.future.done():
+                job.future.set_result(results[offset:offset + len(job.items)])
+            offset += len(job.items)
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect()
+            if batch:
+                await self._execute(batch)
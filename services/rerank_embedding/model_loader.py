@@ -0,0 +1,164 @@
+"""
+Chọn thiết bị và backend suy luận cho server embed/rerank.
+
+USE_GPU: auto (dùng GPU nếu torch thấy CUDA) | True | False
+INFERENCE_BACKEND: auto (torch trên GPU, onnx trên CPU nếu đã cài onnxruntime) | torch | onnx
+"""
+import importlib.util
+import os
+from typing import List, Tuple
+from inference_executor import inference_threads
+
+USE_GPU = os.getenv("USE_GPU", "auto")
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "auto")
+
+EMBED_MODEL_NAME = os.getenv("EMBED_MODEL_NAME", "BAAI/bge-m3")
+RERANK_MODEL_NAME = os.getenv("RERANK_MODEL_NAME", "BAAI/bge-reranker-v2-m3")
+
+
+def resolve_use_gpu(value: str = None) -> bool:
+    value = (USE_GPU if value is None else str(value)).lower()
+    if value == "auto":
+        import torch
+        return torch.cuda.is_available()
+    return value in ("1", "true", "yes")
+
+
+def resolve_backend(backend: str = None, use_gpu: bool = False) -> str:
+    backend = (INFERENCE_BACKEND if backend is None else backend).lower()
+    if backend != "auto":
+        return backend
+    if use_gpu:
+        return "torch"
+    if importlib.util.find_spec("onnxruntime") is None:
+        print("onnxruntime chưa được cài, dùng PyTorch fp32 trên CPU")
+        return "torch"
+    return "onnx"
+
+
+class TorchM3Embedder:
+    """BGEM3FlagModel kèm lượt encode trên token id đã tokenize sẵn (cùng giao diện với OnnxM3Embedder)"""
+
+    def __init__(self, embedder, use_gpu: bool) -> None:
+        self.embedder = embedder
+        self.tokenizer = embedder.tokenizer
+        self.model = embedder.model
+        self.device = "cuda" if use_gpu else "cpu"
+        if use_gpu:
+            self.model.half()
+        self.model.to(self.device).eval()
+        self.unused_tokens = {
+            self.tokenizer.cls_token_id,
+            self.tokenizer.eos_token_id,
+            self.tokenizer.pad_token_id,
+            self.tokenizer.unk_token_id,
+        }
+
+    def encode(self, *args, **kwargs):
+        return self.embedder.encode(*args, **kwargs)
+
+    def _lexical_weights(self, input_ids: List[int], weights: List[float]) -> dict:
+        # Giống FlagEmbedding: trọng số lớn nhất của mỗi token id, bỏ token đặc biệt, khóa là chuỗi
+        result = {}
+        for token_id, weight in zip(input_ids, weights):
+            if token_id in self.unused_tokens or weight <= 0:
+                continue
+            key = str(token_id)
+            if weight > result.get(key, 0):
+                result[key] = weight
+        return result
+
+    def encode_ids(self,
+                   input_ids: List[List[int]],
+                   return_dense: bool = True,
+                   return_sparse: bool = False,
+                   return_colbert_vecs: bool = False) -> dict:
+        """Giống encode cho các câu đã tokenize sẵn (token id kèm token đặc biệt), chạy một lượt forward"""
+        import torch
+
+        if not input_ids:
+            return {
+                "dense_vecs": None,
+                "lexical_weights": [] if return_sparse else None,
+                "colbert_vecs": [] if return_colbert_vecs else None,
+            }
+        with torch.inference_mode():
+            encoded = self.tokenizer.pad({"input_ids": input_ids}, padding=True, return_tensors="pt").to(self.device)
+            outputs = self.model(
+                encoded,
+                return_dense=return_dense,
+                return_sparse=return_sparse,
+                return_colbert_vecs=return_colbert_vecs,
+            )
+        token_counts = encoded["attention_mask"].sum(dim=1).tolist()
+        result = {"dense_vecs": None, "lexical_weights": None, "colbert_vecs": None}
+        if return_dense:
+            result["dense_vecs"] = outputs["dense_vecs"].float().cpu().numpy()
+        if return_sparse:
+            weights = outputs["sparse_vecs"].squeeze(-1).float().cpu().tolist()
+            result["lexical_weights"] = [
+                self._lexical_weights(ids, row_weights[:len(ids)]) for ids, row_weights in zip(input_ids, weights)
+            ]
+        if return_colbert_vecs:
+            colbert = outputs["colbert_vecs"].cpu().numpy()
+            # Không dùng vector của token CLS nên mỗi câu có token_count - 1 vector
+            result["colbert_vecs"] = [colbert[row][:count - 1] for row, count in enumerate(token_counts)]
+        return result
+
+
+class TorchReranker:
+    """FlagReranker kèm lượt chấm trên token id đã tokenize sẵn (cùng giao diện với OnnxReranker)"""
+
+    def __init__(self, reranker, use_gpu: bool) -> None:
+        self.reranker = reranker
+        self.tokenizer = reranker.tokenizer
+        self.model = reranker.model
+        self.device = "cuda" if use_gpu else "cpu"
+        if use_gpu:
+            self.model.half()
+        self.model.to(self.device).eval()
+
+    def compute_score(self, *args, **kwargs):
+        return self.reranker.compute_score(*args, **kwargs)
+
+    def compute_score_ids(self, input_ids: List[List[int]], batch_size: int = 256) -> List[float]:
+        import torch
+
+        scores = []
+        with torch.inference_mode():
+            for start in range(0, len(input_ids), batch_size):
+                encoded = self.tokenizer.pad(
+                    {"input_ids": input_ids[start:start + batch_size]}, padding=True, return_tensors="pt"
+                )
+                logits = self.model(**{name: tensor.to(self.device) for name, tensor in encoded.items()}).logits
+                scores.extend(logits.view(-1).float().cpu().tolist())
+        return scores
+
+
+def load_models(backend: str = None, use_gpu: bool = None) -> Tuple[object, object]:
+    """Nạp (embedder, reranker) theo backend và thiết bị đã chọn"""
+    use_gpu = resolve_use_gpu() if use_gpu is None else use_gpu
+    backend = resolve_backend(backend, use_gpu)
+    print(f"Inference backend: {backend}, GPU: {use_gpu}, CPU threads: {inference_threads()}")
+
+    if backend == "onnx":
+        from onnx_backend import OnnxM3Embedder, OnnxReranker
+        return (
+            OnnxM3Embedder(EMBED_MODEL_NAME, use_gpu=use_gpu),
+            OnnxReranker(RERANK_MODEL_NAME, use_gpu=use_gpu),
+        )
+    if backend != "torch":
+        raise ValueError(f"INFERENCE_BACKEND không hợp lệ: {backend}")
+
+    from FlagEmbedding import BGEM3FlagModel, FlagReranker
+    if use_gpu:
+        return (
+            TorchM3Embedder(BGEM3FlagModel(EMBED_MODEL_NAME, use_fp16=True), use_gpu),
+            TorchReranker(FlagReranker(RERANK_MODEL_NAME, use_fp16=True), use_gpu),
+        )
+    import torch
+    torch.set_num_threads(inference_threads())
+    return (
+        TorchM3Embedder(BGEM3FlagModel(EMBED_MODEL_NAME, use_fp16=False, devices="cpu"), use_gpu),
+        TorchReranker(FlagReranker(RERANK_MODEL_NAME, use_fp16=False, devices="cpu"), use_gpu),
+    )
@@ -0,0 +1,294 @@
+"""
+Backend ONNX Runtime cho BGE-M3 và bge-reranker-v2-m3. Giao diện giống BGEM3FlagModel.encode và
+FlagReranker.compute_score nên server dùng thay thế trực tiếp.
+
+Lần đầu chạy, model được export sang ONNX (fp32). Khi chạy trên CPU, trọng số được lượng tử hóa động
+int8. Kết quả lưu trong ONNX_MODEL_DIR, các lần sau chỉ cần nạp lại. Cần onnx và onnxruntime
+(onnxruntime-gpu nếu chạy trên GPU).
+"""
+import os
+from typing import List
+import numpy as np
+from transformers import AutoTokenizer
+from inference_executor import inference_threads
+
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "/root/.cache/huggingface/onnx")
+# Lượng tử hóa động int8 trọng số khi chạy trên CPU (False: dùng model fp32)
+ONNX_QUANTIZE = os.getenv("ONNX_QUANTIZE", "True").lower() in ("1", "true", "yes")
+ONNX_OPSET = int(os.getenv("ONNX_OPSET", 17))
+
+INPUT_NAMES = ["input_ids", "attention_mask"]
+EMBED_OUTPUT_NAMES = ["dense_vecs", "sparse_weights", "colbert_vecs"]
+
+
+def model_path(model_name: str, quantized: bool) -> str:
+    return os.path.join(
+        ONNX_MODEL_DIR,
+        model_name.replace("/", "--"),
+        "model.int8.onnx" if quantized else "model.onnx",
+    )
+
+
+def _export(module, dummy_inputs: dict, path: str, output_names: List[str], dynamic_axes: dict) -> None:
+    import torch
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with torch.no_grad():
+        # Model > 2GB (BGE-M3 fp32) được torch tự lưu trọng số ra file external data cạnh file .onnx
+        torch.onnx.export(
+            module,
+            tuple(dummy_inputs[name] for name in INPUT_NAMES),
+            path,
+            input_names=INPUT_NAMES,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=ONNX_OPSET,
+        )
+
+
+def _quantize(fp32_path: str, int8_path: str) -> None:
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+
+
+def export_embedder(model_name: str) -> str:
+    """Export BGE-M3 (dense + sparse + colbert) sang ONNX, trả về đường dẫn model fp32"""
+    import torch
+    from huggingface_hub import snapshot_download
+    from transformers import AutoModel
+
+    path = model_path(model_name, quantized=False)
+    if os.path.exists(path):
+        return path
+    local_dir = snapshot_download(model_name)
+    tokenizer = AutoTokenizer.from_pretrained(local_dir)
+    model = AutoModel.from_pretrained(local_dir).eval()
+    hidden_size = model.config.hidden_size
+    # Hai lớp chiếu của BGE-M3 được lưu riêng cạnh trọng số transformer
+    colbert_linear = torch.nn.Linear(hidden_size, hidden_size)
+    colbert_linear.load_state_dict(torch.load(os.path.join(local_dir, "colbert_linear.pt"), map_location="cpu"))
+    sparse_linear = torch.nn.Linear(hidden_size, 1)
+    sparse_linear.load_state_dict(torch.load(os.path.join(local_dir, "sparse_linear.pt"), map_location="cpu"))
+
+    class M3Module(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+            self.colbert_linear = colbert_linear
+            self.sparse_linear = sparse_linear
+
+        def forward(self, input_ids, attention_mask):
+            hidden = self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+            dense = torch.nn.functional.normalize(hidden[:, 0], dim=-1)
+            sparse = torch.relu(self.sparse_linear(hidden)).squeeze(-1)
+            colbert = self.colbert_linear(hidden[:, 1:]) * attention_mask[:, 1:, None].to(hidden.dtype)
+            colbert = torch.nn.functional.normalize(colbert, dim=-1)
+            return dense, sparse, colbert
+
+    _export(
+        M3Module().eval(),
+        tokenizer(["xin chào"], return_tensors="pt"),
+        path,
+        EMBED_OUTPUT_NAMES,
+        {
+            "input_ids": {0: "batch", 1: "sequence"},
+            "attention_mask": {0: "batch", 1: "sequence"},
+            "dense_vecs": {0: "batch"},
+            "sparse_weights": {0: "batch", 1: "sequence"},
+            "colbert_vecs": {0: "batch", 1: "colbert_sequence"},
+        },
+    )
+    return path
+
+
+def export_reranker(model_name: str) -> str:
+    """Export cross-encoder sang ONNX (đầu ra: logit của từng cặp), trả về đường dẫn model fp32"""
+    import torch
+    from transformers import AutoModelForSequenceClassification
+
+    path = model_path(model_name, quantized=False)
+    if os.path.exists(path):
+        return path
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForSequenceClassification.from_pretrained(model_name).eval()
+
+    class RerankModule(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask).logits.view(-1)
+
+    _export(
+        RerankModule().eval(),
+        tokenizer(["xin chào"], ["Trường Đại học"], return_tensors="pt"),
+        path,
+        ["scores"],
+        {
+            "input_ids": {0: "batch", 1: "sequence"},
+            "attention_mask": {0: "batch", 1: "sequence"},
+            "scores": {0: "batch"},
+        },
+    )
+    return path
+
+
+def prepare_model(model_name: str, export, use_gpu: bool) -> str:
+    """Đường dẫn model ONNX sẵn sàng để nạp: export nếu chưa có, lượng tử hóa int8 khi chạy CPU"""
+    fp32_path = export(model_name)
+    if use_gpu or not ONNX_QUANTIZE:
+        return fp32_path
+    int8_path = model_path(model_name, quantized=True)
+    if not os.path.exists(int8_path):
+        _quantize(fp32_path, int8_path)
+    return int8_path
+
+
+def create_session(path: str, use_gpu: bool):
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = inference_threads()
+    options.inter_op_num_threads = 1
+    providers = ["CPUExecutionProvider"]
+    if use_gpu and "CUDAExecutionProvider" in ort.get_available_providers():
+        providers.insert(0, "CUDAExecutionProvider")
+    return ort.InferenceSession(path, options, providers=providers)
+
+
+def _length_order(sequences: list) -> List[int]:
+    # Sắp theo độ dài (ký tự hoặc token) giảm dần như FlagEmbedding để các câu cùng batch có độ dài gần nhau
+    return sorted(range(len(sequences)), key=lambda idx: -len(sequences[idx]))
+
+
+class OnnxM3Embedder:
+    def __init__(self, model_name: str = "BAAI/bge-m3", use_gpu: bool = False) -> None:
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.session = create_session(prepare_model(model_name, export_embedder, use_gpu), use_gpu)
+        self.unused_tokens = {
+            self.tokenizer.cls_token_id,
+            self.tokenizer.eos_token_id,
+            self.tokenizer.pad_token_id,
+            self.tokenizer.unk_token_id,
+        }
+
+    def _lexical_weights(self, input_ids: np.ndarray, weights: np.ndarray) -> dict:
+        """Trọng số lớn nhất của mỗi token id (bỏ token đặc biệt), khóa là chuỗi như FlagEmbedding"""
+        result = {}
+        for token_id, weight in zip(input_ids.tolist(), weights.tolist()):
+            if token_id in self.unused_tokens or weight <= 0:
+                continue
+            key = str(token_id)
+            if weight > result.get(key, 0):
+                result[key] = weight
+        return result
+
+    def _encode_rows(self,
+                     input_ids: List[List[int]],
+                     rows: List[int],
+                     results: dict,
+                     return_sparse: bool,
+                     return_colbert_vecs: bool) -> None:
+        """Một lượt forward cho các câu đã tokenize, ghi kết quả vào vị trí rows của results"""
+        encoded = self.tokenizer.pad({"input_ids": input_ids}, padding=True, return_tensors="np")
+        input_ids = encoded["input_ids"].astype(np.int64)
+        attention_mask = encoded["attention_mask"].astype(np.int64)
+        dense, sparse, colbert = self.session.run(
+            EMBED_OUTPUT_NAMES, {"input_ids": input_ids, "attention_mask": attention_mask}
+        )
+        for row, idx in enumerate(rows):
+            token_count = int(attention_mask[row].sum())
+            results["dense_vecs"][idx] = dense[row]
+            if return_sparse:
+                results["lexical_weights"][idx] = self._lexical_weights(input_ids[row][:token_count], sparse[row][:token_count])
+            if return_colbert_vecs:
+                results["colbert_vecs"][idx] = colbert[row][:token_count - 1]
+
+    @staticmethod
+    def _empty_results(size: int) -> dict:
+        return {"dense_vecs": [None] * size, "lexical_weights": [None] * size, "colbert_vecs": [None] * size}
+
+    @staticmethod
+    def _finish(results: dict, return_dense: bool, return_sparse: bool, return_colbert_vecs: bool) -> dict:
+        return {
+            "dense_vecs": np.stack(results["dense_vecs"]) if return_dense and results["dense_vecs"] else None,
+            "lexical_weights": results["lexical_weights"] if return_sparse else None,
+            "colbert_vecs": results["colbert_vecs"] if return_colbert_vecs else None,
+        }
+
+    def encode(self,
+               sentences: List[str],
+               batch_size: int = 64,
+               max_length: int = 8192,
+               return_dense: bool = True,
+               return_sparse: bool = False,
+               return_colbert_vecs: bool = False) -> dict:
+        input_ids = self.tokenizer(sentences, truncation=True, max_length=max_length)["input_ids"]
+        order = _length_order(input_ids)
+        results = self._empty_results(len(sentences))
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            self._encode_rows([input_ids[idx] for idx in rows], rows, results, return_sparse, return_colbert_vecs)
+        return self._finish(results, return_dense, return_sparse, return_colbert_vecs)
+
+    def encode_ids(self,
+                   input_ids: List[List[int]],
+                   return_dense: bool = True,
+                   return_sparse: bool = False,
+                   return_colbert_vecs: bool = False) -> dict:
+        """Giống encode cho các câu đã tokenize sẵn (token id kèm token đặc biệt), chạy một lượt forward"""
+        results = self._empty_results(len(input_ids))
+        if input_ids:
+            self._encode_rows(input_ids, list(range(len(input_ids))), results, return_sparse, return_colbert_vecs)
+        return self._finish(results, return_dense, return_sparse, return_colbert_vecs)
+
+
+class OnnxReranker:
+    def __init__(self, model_name: str = "BAAI/bge-reranker-v2-m3", use_gpu: bool = False) -> None:
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.session = create_session(prepare_model(model_name, export_reranker, use_gpu), use_gpu)
+
+    def compute_score(self,
+                      sentence_pairs: list,
+                      batch_size: int = 256,
+                      max_length: int = 512,
+                      normalize: bool = False):
+        scores = [None] * len(sentence_pairs)
+        order = _length_order([pair[0] + pair[1] for pair in sentence_pairs])
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            encoded = self.tokenizer(
+                [sentence_pairs[idx][0] for idx in indices],
+                [sentence_pairs[idx][1] for idx in indices],
+                padding=True,
+                truncation="only_second",
+                max_length=max_length,
+                return_tensors="np",
+            )
+            (logits,) = self.session.run(["scores"], {
+                "input_ids": encoded["input_ids"].astype(np.int64),
+                "attention_mask": encoded["attention_mask"].astype(np.int64),
+            })
+            for row, idx in enumerate(indices):
+                scores[idx] = float(logits[row])
+        if normalize:
+            scores = [float(1 / (1 + np.exp(-score))) for score in scores]
+        # Giống FlagReranker: trả về một số khi chỉ có một cặp
+        return scores[0] if len(scores) == 1 else scores
+
+    def compute_score_ids(self, input_ids: List[List[int]], batch_size: int = 256) -> List[float]:
+        """Điểm thô của các cặp đã tokenize sẵn (token id kèm token đặc biệt)"""
+        scores = []
+        for start in range(0, len(input_ids), batch_size):
+            encoded = self.tokenizer.pad(
+                {"input_ids": input_ids[start:start + batch_size]}, padding=True, return_tensors="np"
+            )
+            (logits,) = self.session.run(["scores"], {
+                "input_ids": encoded["input_ids"].astype(np.int64),
+                "attention_mask": encoded["attention_mask"].astype(np.int64),
+            })
+            scores.extend(float(score) for score in logits)
+        return scores
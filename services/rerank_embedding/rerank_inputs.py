@@ -0,0 +1,56 @@
+"""
+Tokenize đầu vào cho reranker: câu truy vấn được tokenize một lần cho mỗi request, token của tài liệu được
+cache theo content_hash (LRU, giới hạn số tài liệu) để các ứng viên lặp lại giữa các request bỏ qua bước
+tokenize. Cặp (query, tài liệu) được ghép trực tiếp từ token id theo định dạng của tokenizer.
+"""
+import threading
+from typing import List, Optional
+import numpy as np
+from cachetools import LRUCache
+from serving_metrics import RERANK_TOKEN_CACHE_LOOKUPS
+
+
+class PairTokenizer:
+    def __init__(self, tokenizer, max_length: int, cache_size: int) -> None:
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.special_tokens = tokenizer.num_special_tokens_to_add(pair=True)
+        # Câu truy vấn được giữ tối đa 3/4 số token còn lại sau các token đặc biệt
+        self.max_query_tokens = (max_length - self.special_tokens) * 3 // 4
+        self.document_cache = LRUCache(maxsize=cache_size)
+        self.lock = threading.Lock()
+
+    def text_ids(self, texts: List[str]) -> List[np.ndarray]:
+        encoded = self.tokenizer(
+            texts, add_special_tokens=False, truncation=True, max_length=self.max_length
+        )["input_ids"]
+        return [np.asarray(ids, dtype=np.int32) for ids in encoded]
+
+    def document_ids(self, texts: List[Optional[str]], content_hashes: List[Optional[str]]) -> List[Optional[np.ndarray]]:
+        """
+        Token của các tài liệu, đọc cache theo content_hash trước khi tokenize. Tài liệu không có text
+        và chưa có trong cache trả về None.
+        """
+        result = [None] * len(texts)
+        with self.lock:
+            for idx, content_hash in enumerate(content_hashes):
+                if content_hash:
+                    result[idx] = self.document_cache.get(content_hash)
+        hits = sum(1 for ids in result if ids is not None)
+        missing = [idx for idx in range(len(texts)) if result[idx] is None and texts[idx] is not None]
+        if missing:
+            for idx, ids in zip(missing, self.text_ids([texts[idx] for idx in missing])):
+                result[idx] = ids
+        RERANK_TOKEN_CACHE_LOOKUPS.labels("hit").inc(hits)
+        RERANK_TOKEN_CACHE_LOOKUPS.labels("miss").inc(len(missing))
+        with self.lock:
+            for idx in missing:
+                if content_hashes[idx]:
+                    self.document_cache[content_hashes[idx]] = result[idx]
+        return result
+
+    def pair_ids(self, query_ids: np.ndarray, document_ids: np.ndarray) -> List[int]:
+        """Token id của cặp (query, tài liệu) kèm token đặc biệt, cắt tài liệu để vừa max_length"""
+        query_ids = query_ids[:self.max_query_tokens]
+        document_ids = document_ids[:self.max_length - self.special_tokens - len(query_ids)]
+        return self.tokenizer.build_inputs_with_special_tokens(query_ids.tolist(), document_ids.tolist())
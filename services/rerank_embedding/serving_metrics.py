@@ -0,0 +1,81 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# Thời gian một request nằm trong hàng đợi trước khi batch chứa nó bắt đầu chạy
+BATCH_QUEUE_WAIT_SECONDS = Histogram(
+    "inference_batch_queue_wait_seconds",
+    "Thời gian request chờ trong hàng đợi micro-batch",
+    ["endpoint", "priority"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+BATCH_SIZE = Histogram(
+    "inference_batch_size",
+    "Số câu/cặp câu trong mỗi lượt forward",
+    ["endpoint"],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+BATCH_REQUESTS = Histogram(
+    "inference_batch_requests",
+    "Số request được gộp vào mỗi lượt forward",
+    ["endpoint"],
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+BATCH_TOKENS = Histogram(
+    "inference_batch_tokens",
+    "Tổng số token của mỗi lượt forward",
+    ["endpoint"],
+    buckets=(64, 256, 1024, 4096, 8192, 16384, 32768, 65536),
+)
+BATCH_RUN_SECONDS = Histogram(
+    "inference_batch_run_seconds",
+    "Thời gian chạy một lượt forward",
+    ["endpoint"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+BATCH_EXPIRED = Counter(
+    "inference_batch_expired",
+    "Số request bị bỏ vì quá deadline trước khi được đưa vào batch",
+    ["endpoint", "priority"],
+)
+BATCH_REJECTED = Counter(
+    "inference_batch_rejected",
+    "Số request bị từ chối (503) vì hàng đợi đầy",
+    ["endpoint", "priority"],
+)
+BATCH_QUEUE_ITEMS = Gauge(
+    "inference_batch_queue_items",
+    "Số câu/cặp câu đang chờ trong hàng đợi micro-batch",
+    ["endpoint", "priority"],
+)
+BATCH_INFLIGHT_REQUESTS = Gauge(
+    "inference_batch_inflight_requests",
+    "Số request đang xử lý (chờ trong hàng đợi hoặc đang chạy) theo lớp ưu tiên",
+    ["endpoint", "priority"],
+)
+RERANK_TOKEN_CACHE_LOOKUPS = Counter(
+    "rerank_token_cache_lookups",
+    "Số lần tra cache token tài liệu của reranker theo content_hash",
+    ["result"],
+)
+BATCH_PADDING_RATIO = Histogram(
+    "inference_batch_padding_ratio",
+    "Tỷ lệ token padding trong mỗi lượt forward",
+    ["endpoint"],
+    buckets=(0, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1),
+)
+BATCH_PEAK_MEMORY_BYTES = Histogram(
+    "inference_batch_peak_memory_bytes",
+    "Bộ nhớ GPU đỉnh (max_memory_allocated) của mỗi lượt forward",
+    ["endpoint"],
+    buckets=tuple(2 ** exponent for exponent in range(26, 37)),
+)
+BATCH_PEAK_RSS_GROWTH_BYTES = Histogram(
+    "inference_batch_peak_rss_growth_bytes",
+    "Mức tăng RSS đỉnh (ru_maxrss) của tiến trình trong mỗi lượt forward trên CPU",
+    ["endpoint"],
+    buckets=(0,) + tuple(2 ** exponent for exponent in range(20, 35, 2)),
+)
+BATCH_TOKEN_BUDGET = Gauge(
+    "inference_batch_token_budget",
+    "Ngân sách token (sau padding) của lượt forward gần nhất, tính từ bộ nhớ còn trống",
+    ["endpoint"],
+)
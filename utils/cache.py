@@ -0,0 +1,173 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+from cachetools import TTLCache
+from utils.monitor_log import logger
+
+# Bật/tắt tầng Redis dùng chung cho tất cả các cache
+CACHE_USE_REDIS = os.getenv("CACHE_USE_REDIS", "True").lower() in ("1", "true", "yes")
+# Thời gian tạm ngưng gọi Redis sau khi gặp lỗi kết nối (giây)
+REDIS_RETRY_AFTER = float(os.getenv("CACHE_REDIS_RETRY_AFTER", 30))
+
+_MISSING = object()
+
+
+class TwoTierCache:
+    """
+    Cache hai tầng: LRU có giới hạn kích thước và TTL trong tiến trình,
+    phía sau là Redis (tùy chọn) để các worker backend dùng chung kết quả.
+    Lỗi Redis chỉ được log lại, cache vẫn hoạt động với tầng trong tiến trình.
+    """
+    def __init__(
+        self,
+        namespace: str,
+        maxsize: int = 1024,
+        ttl: float = 600,
+        redis_client=None,
+        redis_ttl: Optional[int] = None,
+        dumps: Callable[[Any], bytes] = lambda value: json.dumps(value).encode("utf-8"),
+        loads: Callable[[bytes], Any] = json.loads,
+    ) -> None:
+        self.namespace = namespace
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+        self.redis_client = redis_client
+        self.redis_ttl = int(redis_ttl or ttl)
+        self.dumps = dumps
+        self.loads = loads
+        self.redis_down_until = 0.0
+        self.stats = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+
+    def _redis_key(self, key: str) -> str:
+        return f"cache:{self.namespace}:{key}"
+
+    def _redis_available(self) -> bool:
+        return self.redis_client is not None and time.monotonic() >= self.redis_down_until
+
+    def _redis_failed(self, e: Exception) -> None:
+        logger.warning(f"Redis cache `{self.namespace}` lỗi, tạm dùng cache trong tiến trình: {str(e)}")
+        self.redis_down_until = time.monotonic() + REDIS_RETRY_AFTER
+
+    def _count(self, tier: Optional[str], n: int = 1) -> None:
+        with self.lock:
+            if tier == "local":
+                self.stats["local_hits"] += n
+            elif tier == "redis":
+                self.stats["redis_hits"] += n
+            else:
+                self.stats["misses"] += n
+
+    def lookup(self, key: str) -> Tuple[Any, Optional[str]]:
+        """Trả về (giá trị, tầng cache trúng: "local" | "redis" | None)"""
+        result = self.lookup_many([key])
+        return result.get(key, (None, None))
+
+    def lookup_many(self, keys: Iterable[str]) -> Dict[str, Tuple[Any, Optional[str]]]:
+        result: Dict[str, Tuple[Any, Optional[str]]] = {}
+        missing = []
+        with self.lock:
+            for key in keys:
+                value = self.local.get(key, _MISSING)
+                if value is _MISSING:
+                    missing.append(key)
+                else:
+                    result[key] = (value, "local")
+        self._count("local", len(result))
+
+        if missing and self._redis_available():
+            try:
+                raws = self.redis_client.mget([self._redis_key(key) for key in missing])
+            except Exception as e:
+                self._redis_failed(e)
+                raws = [None] * len(missing)
+            redis_hits = 0
+            for key, raw in zip(missing, raws):
+                if raw is None:
+                    continue
+                value = self.loads(raw)
+                with self.lock:
+                    self.local[key] = value
+                result[key] = (value, "redis")
+                redis_hits += 1
+            self._count("redis", redis_hits)
+
+        misses = [key for key in missing if key not in result]
+        self._count(None, len(misses))
+        for key in misses:
+            result[key] = (None, None)
+        return result
+
+    def get(self, key: str) -> Any:
+        return self.lookup(key)[0]
+
+    def set(self, key: str, value: Any) -> None:
+        self.set_many({key: value})
+
+    def set_many(self, items: Dict[str, Any]) -> None:
+        if not items:
+            return
+        with self.lock:
+            for key, value in items.items():
+                self.local[key] = value
+        if self._redis_available():
+            try:
+                pipeline = self.redis_client.pipeline(transaction=False)
+                for key, value in items.items():
+                    pipeline.setex(self._redis_key(key), self.redis_ttl, self.dumps(value))
+                pipeline.execute()
+            except Exception as e:
+                self._redis_failed(e)
+
+    def _needs_redis(self, keys: Iterable[str]) -> bool:
+        """Lượt tra cứu có phải gọi Redis không (tầng Redis đang dùng được và có khóa chưa nằm trong tiến trình)"""
+        if not self._redis_available():
+            return False
+        with self.lock:
+            return any(key not in self.local for key in keys)
+
+    async def alookup(self, key: str) -> Tuple[Any, Optional[str]]:
+        result = await self.alookup_many([key])
+        return result.get(key, (None, None))
+
+    async def alookup_many(self, keys: Iterable[str]) -> Dict[str, Tuple[Any, Optional[str]]]:
+        """
+        Phiên bản bất đồng bộ của lookup_many: Redis client là client đồng bộ nên lượt gọi Redis chạy trong
+        asyncio.to_thread để không chặn event loop; khi mọi khóa đều trúng tầng trong tiến trình thì trả về ngay.
+        """
+        keys = list(keys)
+        if self._needs_redis(keys):
+            return await asyncio.to_thread(self.lookup_many, keys)
+        return self.lookup_many(keys)
+
+    async def aset(self, key: str, value: Any) -> None:
+        await self.aset_many({key: value})
+
+    async def aset_many(self, items: Dict[str, Any]) -> None:
+        if items and self._redis_available():
+            await asyncio.to_thread(self.set_many, items)
+        else:
+            self.set_many(items)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.local.clear()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {**self.stats, "local_size": len(self.local)}
+
+
+_redis_client = None
+
+def shared_redis_client():
+    """Redis client dùng chung cho các cache, None nếu tầng Redis bị tắt"""
+    global _redis_client
+    if not CACHE_USE_REDIS:
+        return None
+    if _redis_client is None:
+        from utils.connect_redis import connect_redis
+        _redis_client = connect_redis()
+    return _redis_client
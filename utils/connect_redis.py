@@ -0,0 +1,16 @@
+import redis
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+def connect_redis():
+    # Client dùng cho cache ở backend: giữ nguyên bytes, timeout ngắn để Redis chậm không kéo theo request
+    redis_client = redis.Redis(
+        host=os.getenv("REDIS_HOST", "localhost"),
+        port=int(os.getenv("REDIS_PORT", 6379)),
+        password=os.getenv("REDIS_PASSWORD", "123456"),
+        socket_timeout=float(os.getenv("REDIS_SOCKET_TIMEOUT", 0.2)),
+        socket_connect_timeout=float(os.getenv("REDIS_SOCKET_TIMEOUT", 0.2)),
+    )
+    return redis_client
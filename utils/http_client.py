@@ -0,0 +1,159 @@
+import asyncio
+import os
+import random
+import threading
+import time
+import weakref
+from typing import Callable, Optional
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from utils.monitor_log import logger
+
+# Giới hạn connection tới các service nội bộ (embed, rerank), dùng chung cho client đồng bộ và bất đồng bộ
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 32))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", 16))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 2))
+# Backoff giữa các lần thử lại: ngẫu nhiên trong [0, min(max, base * 2^attempt)] (full jitter)
+HTTP_RETRY_BASE_DELAY = float(os.getenv("HTTP_RETRY_BASE_DELAY", 0.2))
+HTTP_RETRY_MAX_DELAY = float(os.getenv("HTTP_RETRY_MAX_DELAY", 5))
+
+# Ngoài lỗi 5xx, các mã này cũng được thử lại; các lỗi 4xx khác trả về ngay
+RETRY_STATUS_CODES = {408, 429}
+
+# AsyncClient gắn với event loop tạo ra nó: mỗi event loop (worker FastAPI, mỗi lần asyncio.run của Streamlit) một client
+_async_clients = weakref.WeakKeyDictionary()
+_sync_session: Optional[requests.Session] = None
+_sync_session_lock = threading.Lock()
+
+
+def retry_delay(attempt: int, base: float = None, maximum: float = None) -> float:
+    base = HTTP_RETRY_BASE_DELAY if base is None else base
+    maximum = HTTP_RETRY_MAX_DELAY if maximum is None else maximum
+    return random.uniform(0, min(maximum, base * (2 ** attempt)))
+
+
+def async_http_client() -> httpx.AsyncClient:
+    """httpx.AsyncClient dùng chung (keep-alive) của event loop hiện tại"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(30, connect=HTTP_CONNECT_TIMEOUT),
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def close_async_http_client() -> None:
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def sync_http_client() -> requests.Session:
+    """requests.Session dùng chung (keep-alive) cho các luồng đồng bộ"""
+    global _sync_session
+    with _sync_session_lock:
+        if _sync_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                pool_maxsize=HTTP_MAX_CONNECTIONS,
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sync_session = session
+    return _sync_session
+
+
+def _retry_after(response) -> Optional[float]:
+    """Số giây trong header Retry-After của response, None nếu không có hoặc không phải dạng số giây"""
+    if response is None:
+        return None
+    try:
+        return max(float(response.headers["Retry-After"]), 0.0)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _should_retry(status_code: int, retry_after: Optional[float]) -> bool:
+    if status_code == 503:
+        # Server embed/rerank trả 503 kèm Retry-After khi hàng đợi đầy; 503 không có header này
+        # (quá tải, đang dừng) không được thử lại để không dồn thêm tải lên server
+        return retry_after is not None
+    return status_code in RETRY_STATUS_CODES or status_code >= 500
+
+
+def _next_delay(attempt: int, base_delay: Optional[float], retry_after: Optional[float]) -> float:
+    """Backoff có jitter, không ngắn hơn Retry-After của server nếu có"""
+    delay = retry_delay(attempt, base_delay)
+    return max(delay, retry_after) if retry_after is not None else delay
+
+
+def post_json(url: str,
+              payload: dict,
+              timeout: float,
+              max_retries: int = 3,
+              base_delay: float = None,
+              name: str = "HTTP",
+              headers: dict = None,
+              parse: Callable = None
+              ) -> dict:
+    """
+    POST JSON qua session dùng chung, thử lại lỗi kết nối/timeout/5xx với backoff có jitter, tối đa max_retries
+    lần sau lần gọi đầu tiên (max_retries=0: chỉ gọi một lần). 503 chỉ được thử lại khi có Retry-After,
+    và không sớm hơn thời gian trong header. parse(response) đọc response (mặc định response.json()), dùng cho các response không phải JSON.
+    """
+    attempts = max(max_retries, 0) + 1
+    for attempt in range(attempts):
+        try:
+            response = sync_http_client().post(
+                url, json=payload, headers=headers, timeout=(HTTP_CONNECT_TIMEOUT, timeout)
+            )
+            response.raise_for_status()
+            return parse(response) if parse else response.json()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError) as e:
+            response = getattr(e, "response", None)
+            status_code = response.status_code if response is not None else None
+            retry_after = _retry_after(response)
+            if attempt >= attempts - 1 or (status_code is not None and not _should_retry(status_code, retry_after)):
+                raise
+            delay = _next_delay(attempt, base_delay, retry_after)
+            logger.warning(f"Lỗi khi gọi {name} (lần thử {attempt + 1}/{attempts}): {str(e)}, thử lại sau {delay:.2f}s")
+            time.sleep(delay)
+
+
+async def apost_json(url: str,
+                     payload: dict,
+                     timeout: float,
+                     max_retries: int = 3,
+                     base_delay: float = None,
+                     name: str = "HTTP",
+                     headers: dict = None,
+                     parse: Callable = None
+                     ) -> dict:
+    """Phiên bản bất đồng bộ của post_json, chờ giữa các lần thử bằng asyncio.sleep (không chặn event loop)"""
+    attempts = max(max_retries, 0) + 1
+    for attempt in range(attempts):
+        try:
+            response = await async_http_client().post(
+                url, json=payload, headers=headers, timeout=httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT)
+            )
+            response.raise_for_status()
+            return parse(response) if parse else response.json()
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            response = e.response if isinstance(e, httpx.HTTPStatusError) else None
+            status_code = response.status_code if response is not None else None
+            retry_after = _retry_after(response)
+            if attempt >= attempts - 1 or (status_code is not None and not _should_retry(status_code, retry_after)):
+                raise
+            delay = _next_delay(attempt, base_delay, retry_after)
+            logger.warning(f"Lỗi khi gọi {name} (lần thử {attempt + 1}/{attempts}): {str(e)}, thử lại sau {delay:.2f}s")
+            await asyncio.sleep(delay)
@@ -0,0 +1,31 @@
+from prometheus_client import Gauge, Histogram
+
+# Thời gian chờ lấy connection từ pool (bao gồm pre-ping và mở connection mới nếu cần)
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    "db_pool_checkout_seconds",
+    "Thời gian chờ checkout connection từ pool",
+    ["engine"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+DB_POOL_CONNECTIONS_IN_USE = Gauge(
+    "db_pool_connections_in_use",
+    "Số connection đang được checkout khỏi pool",
+    ["engine"],
+)
+DB_POOL_CONNECTIONS_IDLE = Gauge(
+    "db_pool_connections_idle",
+    "Số connection đang rảnh trong pool",
+    ["engine"],
+)
+DB_POOL_OVERFLOW = Gauge(
+    "db_pool_overflow",
+    "Số connection vượt pool_size (âm khi pool chưa mở hết)",
+    ["engine"],
+)
+
+
+def register_pool_metrics(name: str, pool) -> None:
+    """Gắn các gauge đọc trực tiếp trạng thái của pool SQLAlchemy mỗi lần được scrape"""
+    DB_POOL_CONNECTIONS_IN_USE.labels(name).set_function(pool.checkedout)
+    DB_POOL_CONNECTIONS_IDLE.labels(name).set_function(pool.checkedin)
+    DB_POOL_OVERFLOW.labels(name).set_function(pool.overflow)
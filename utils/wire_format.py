@@ -0,0 +1,139 @@
+"""
+Định dạng nhị phân cho response của `/embed`, dùng chung cho server (services/rerank_embedding) và client
+(services/chatbot/embedder.py). Chỉ phụ thuộc numpy để cả hai phía import được.
+
+Client gửi `Accept: application/x-embeddings; dtype=float16` (dtype mặc định float32) để nhận response nhị phân,
+không có header này server trả JSON như cũ. Bố cục (little-endian, mỗi phần được đệm tới bội số 8 byte):
+
+    header   : magic "EMB1", dtype (0: float32, 1: float16), cờ dense/sparse/colbert, số câu,
+               số chiều dense, số chiều colbert
+    dense    : số câu x số chiều dense (dtype)
+    sparse   : số token của từng câu (uint32), token id (uint32), trọng số (float32)
+    colbert  : số token của từng câu (uint32), các vector nối liền (tổng số token x số chiều colbert, dtype)
+
+Client đọc bằng np.frombuffer trên chính buffer của response, không sao chép dữ liệu vector.
+"""
+import struct
+from typing import Dict, List, Optional
+import numpy as np
+
+EMBEDDING_MEDIA_TYPE = "application/x-embeddings"
+
+MAGIC = b"EMB1"
+HEADER = struct.Struct("<4sBBHIII")
+DTYPES = {"float32": 0, "float16": 1}
+NUMPY_DTYPES = {0: np.dtype("<f4"), 1: np.dtype("<f2")}
+
+FLAG_DENSE = 1
+FLAG_SPARSE = 2
+FLAG_COLBERT = 4
+
+ALIGNMENT = 8
+
+
+def accept_header(dtype: str = "float32") -> str:
+    return f"{EMBEDDING_MEDIA_TYPE}; dtype={dtype}"
+
+
+def requested_dtype(accept: Optional[str]) -> Optional[str]:
+    """dtype client yêu cầu trong header Accept, None nếu client không nhận định dạng nhị phân"""
+    for media_range in (accept or "").split(","):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+        if media_type != EMBEDDING_MEDIA_TYPE:
+            continue
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "dtype" and value.strip() in DTYPES:
+                return value.strip()
+        return "float32"
+    return None
+
+
+def _padded(data: bytes) -> bytes:
+    return data + b"\0" * (-len(data) % ALIGNMENT)
+
+
+def encode_embeddings(count: int,
+                      dense_vecs=None,
+                      sparse_vecs: List[Dict[str, float]] = None,
+                      colbert_vecs: list = None,
+                      dtype: str = "float32") -> bytes:
+    """Đóng gói kết quả encode (mảng numpy, lexical weights dạng dict) thành response nhị phân"""
+    code = DTYPES[dtype]
+    np_dtype = NUMPY_DTYPES[code]
+    flags, dense_dim, colbert_dim, parts = 0, 0, 0, []
+
+    if dense_vecs is not None:
+        flags |= FLAG_DENSE
+        # Request rỗng không có vector để suy ra số chiều
+        dense = np.ascontiguousarray(dense_vecs, dtype=np_dtype).reshape(count, -1) if count \
+            else np.empty((0, 0), dtype=np_dtype)
+        dense_dim = dense.shape[1]
+        parts.append(_padded(dense.tobytes()))
+
+    if sparse_vecs is not None:
+        flags |= FLAG_SPARSE
+        lengths = np.array([len(weights) for weights in sparse_vecs], dtype="<u4")
+        token_ids = np.array([int(token_id) for weights in sparse_vecs for token_id in weights], dtype="<u4")
+        values = np.array([float(value) for weights in sparse_vecs for value in weights.values()], dtype="<f4")
+        parts.extend(_padded(array.tobytes()) for array in (lengths, token_ids, values))
+
+    if colbert_vecs is not None:
+        flags |= FLAG_COLBERT
+        lengths = np.array([len(vectors) for vectors in colbert_vecs], dtype="<u4")
+        non_empty = [np.asarray(vectors, dtype=np_dtype) for vectors in colbert_vecs if len(vectors)]
+        colbert_dim = non_empty[0].shape[1] if non_empty else 0
+        vectors = np.concatenate(non_empty) if non_empty else np.empty((0, 0), dtype=np_dtype)
+        parts.extend(_padded(array.tobytes()) for array in (lengths, vectors))
+
+    header = _padded(HEADER.pack(MAGIC, code, flags, 0, count, dense_dim, colbert_dim))
+    return b"".join([header] + parts)
+
+
+class _Reader:
+    def __init__(self, buffer) -> None:
+        self.buffer = buffer
+        self.offset = 0
+
+    def array(self, dtype, count: int) -> np.ndarray:
+        array = np.frombuffer(self.buffer, dtype=dtype, count=count, offset=self.offset)
+        self.offset += array.nbytes + (-array.nbytes % ALIGNMENT)
+        return array
+
+
+def decode_embeddings(buffer) -> dict:
+    """
+    Đọc response nhị phân thành dict cùng khóa với JSON `embeddings`: dense_vecs (mảng số câu x số chiều),
+    sparse_vecs (list dict {token_id: weight}), colbert_vecs (list mảng token x số chiều). Các mảng là
+    view chỉ đọc trên buffer.
+    """
+    magic, code, flags, _, count, dense_dim, colbert_dim = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError("Response nhị phân của /embed không hợp lệ")
+    np_dtype = NUMPY_DTYPES[code]
+    reader = _Reader(buffer)
+    reader.offset = HEADER.size + (-HEADER.size % ALIGNMENT)
+    embeddings = {}
+
+    if flags & FLAG_DENSE:
+        embeddings["dense_vecs"] = reader.array(np_dtype, count * dense_dim).reshape(count, dense_dim)
+
+    if flags & FLAG_SPARSE:
+        lengths = reader.array("<u4", count)
+        total = int(lengths.sum())
+        token_ids = reader.array("<u4", total).tolist()
+        values = reader.array("<f4", total).tolist()
+        sparse_vecs, start = [], 0
+        for length in lengths.tolist():
+            sparse_vecs.append({str(token_id): value for token_id, value in zip(token_ids[start:start + length], values[start:start + length])})
+            start += length
+        embeddings["sparse_vecs"] = sparse_vecs
+
+    if flags & FLAG_COLBERT:
+        lengths = reader.array("<u4", count)
+        vectors = reader.array(np_dtype, int(lengths.sum()) * colbert_dim).reshape(-1, colbert_dim) \
+            if colbert_dim else np.empty((0, 0), dtype=np_dtype)
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).tolist()
+        embeddings["colbert_vecs"] = [vectors[offsets[idx]:offsets[idx + 1]] for idx in range(count)]
+
+    return embeddings